@@ -2,7 +2,7 @@ import pandas as pd
 from datetime import datetime, timedelta
 
 
-def adjust_dates(df, date_column, base_date=None):
+def adjust_dates(df, date_column, base_date=None, date_format=None):
     """
     Adjusts all dates in the dataframe by adding the number of days between
     the maximum date in the specified column and today.
@@ -11,6 +11,7 @@ def adjust_dates(df, date_column, base_date=None):
     - df (pd.DataFrame): The DataFrame containing the dates.
     - date_column (str): The name of the column containing date values.
     - base_date (datetime, optional): The date to compare against the max date. Defaults to today.
+    - date_format (str, optional): The format of the date strings, if known, so it is not inferred.
 
     Returns:
     - pd.DataFrame: A DataFrame with adjusted dates.
@@ -22,7 +23,7 @@ def adjust_dates(df, date_column, base_date=None):
 
     # Ensure the date column is in datetime format
     if date_column in df.columns:
-        df[date_column] = pd.to_datetime(df[date_column])
+        df[date_column] = pd.to_datetime(df[date_column], format=date_format)
     else:
         return pd.DataFrame()
 
@@ -40,21 +41,23 @@ def adjust_dates(df, date_column, base_date=None):
 
 
 
-def adjust_transaction_dates(filename, date_col_name, base_date=None):
+def adjust_transaction_dates(filename, date_col_name, base_date=None, date_format=None):
     relpath_filename = f'../data/{filename}'
     t = pd.read_csv(relpath_filename)
-    t_adjusted = adjust_dates(t, date_col_name, base_date)
+    t_adjusted = adjust_dates(t, date_col_name, base_date, date_format)
     return t_adjusted
 
 
 def write_adjusted_dates_to_file(input_filename, 
                                  output_filename, 
                                  date_col_name,
-                                 base_date=None):
+                                 base_date=None,
+                                 date_format=None):
     relpath_output_filename = f'../data/{output_filename}'
     output_df = adjust_transaction_dates(input_filename, 
                                          date_col_name,
-                                         base_date)
+                                         base_date,
+                                         date_format)
     output_df.to_csv(relpath_output_filename, index=False)
 
 
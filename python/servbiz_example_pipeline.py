@@ -10,112 +10,153 @@ import pandas as pd
 import configparser
 import tvc_transform as tvct
 import tvc_load_service_account as tvcload
+import tvc_cache as tvccache
+import tvc_parallel as tvcpar
+import tvc_load_local as tvcloadlocal
 
 ### Set up Python output to show every dataframe column
 pd.set_option('display.max_columns', 500)
 
-
-### Set variables by reading from the config.ini file
-company_name = 'ServBiz'
-config = configparser.ConfigParser()
-config.read('config.ini')
-GOOGLE_CREDENTIALS_FILE = config[company_name]['GOOGLE_CREDENTIALS_FILE']
-GOOGLE_SPREADSHEET_KEY = config[company_name]['GOOGLE_SPREADSHEET_KEY']
-RAW_DATAFILE = config[company_name]['RAW_DATAFILE']
-
-### Extract raw data
-t = pd.read_csv(RAW_DATAFILE)
-
-### Instantiate TVCLoad object with Google credentials file to write to Google Sheets
-tvcl = tvcload.TVCLoad(GOOGLE_CREDENTIALS_FILE)
-
-
-### Define segments. Each Segment name maps to a segment_col name
-segments = {'Unsegmented' : None,
-            'Channel' : 'segment'
-            }
-
-
-for seg in segments:
-    print('Processing the', seg, 'segment')
-    
-    seg_col = segments[seg]
-    if seg_col is None:
-        use_seg = False
+### Run in memory-lean mode: with pandas Copy-on-Write on, the tvc_transform
+### functions skip the defensive copies of their input dataframes
+pd.set_option('mode.copy_on_write', True)
+
+
+### The pipeline runs under the main guard, so that the worker processes
+### started by tvc_parallel do not run it again when they import this file
+if __name__ == '__main__':
+
+    ### Set variables by reading from the config.ini file
+    company_name = 'ServBiz'
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    RAW_DATAFILE = config[company_name]['RAW_DATAFILE']
+    CACHE_DIR = config[company_name].get('CACHE_DIR', '.tvc_cache')
+    # The format of the raw data's dates, if known (e.g. DATE_FORMAT = %%Y-%%m-%%d,
+    # with each % doubled in config.ini), so they are not parsed by inference
+    DATE_FORMAT = config[company_name].get('DATE_FORMAT')
+    # Where the results are loaded: 'sheets' (Google Sheets, the default),
+    # or local 'parquet', 'feather', 'sqlite' or 'duckdb' files at SINK_PATH
+    # (by default tvcloadlocal.DEFAULT_SINK_PATHS, e.g. output/tvc.sqlite)
+    SINK = config[company_name].get('SINK', 'sheets')
+    SINK_PATH = config[company_name].get('SINK_PATH')
+
+    ### Instantiate TVCCache object so that the DAU Decorated dataframes built
+    ### from the raw data are cached on disk and reused until the raw data changes
+    tvcc = tvccache.TVCCache(CACHE_DIR)
+
+    ### Instantiate the sink the results are written to. For Google Sheets, 
+    ### instantiate TVCLoad object with Google credentials file. It keeps 
+    ### hashes of what it uploaded in the cache directory, so that only the
+    ### rows that changed since the last run are written, and the sink 
+    ### uploads them in the background within the Sheets API quota.
+    if SINK == 'sheets':
+        tvcl = tvcload.TVCLoad(config[company_name]['GOOGLE_CREDENTIALS_FILE'], 
+                               hash_file = os.path.join(CACHE_DIR, 'sheet_hashes.json'))
+        sink = tvcloadlocal.create_sink('sheets', 
+                                        tvcl = tvcl,
+                                        spreadsheet_key = config[company_name]['GOOGLE_SPREADSHEET_KEY'],
+                                        requests_per_minute = config[company_name].getint('SHEETS_REQUESTS_PER_MINUTE', 60))
     else:
-        use_seg = True
-    
-    ### Transform the raw data into dau_decorated
-    dau = tvct.create_dau_df(t, 
-                             user_id = 'client_id', 
-                             activity_date = 'date', 
-                             inc_amt = 'value_usd',
-                             segment_col = seg_col
-                            )
-    
-    dau_decorated = tvct.create_dau_decorated_df(dau)
-    
-    
-    ### Calculate Weekly Growth Accounting and Cohort Analysis based on wau_decorated
-    # WAU Decorated
-    wau_decorated = tvct.create_xau_decorated_df(dau_decorated, 'week', use_segment=use_seg)
-    
-    # Weekly Growth Accounting
-    w_ga = tvct.consolidate_all_ga(wau_decorated, 'week', 
-                                     use_segment = use_seg, 
-                                     growth_rate_periods = 12, 
-                                     keep_last_period = False)
-    tvcl.write_to_google_sheet(w_ga, seg + ' Weekly Growth Accounting', GOOGLE_SPREADSHEET_KEY)
-    
-    # Weekly Cohorts
-    wau_cohorts = tvct.create_xau_cohort_df(wau_decorated, 'week', use_segment = use_seg)
-    tvcl.write_to_google_sheet(wau_cohorts, seg + ' Weekly Cohorts', GOOGLE_SPREADSHEET_KEY)
-    
-    
-    
-    ### Calculate Monthly Growth Accounting and Cohort Analysis based on mau_decorated
-    # MAU Decorated
-    mau_decorated = tvct.create_xau_decorated_df(dau_decorated, 'month', use_segment=use_seg)
-    
-    # Monthly Growth Accounting
-    m_ga = tvct.consolidate_all_ga(mau_decorated, 'month', 
-                                     use_segment = use_seg, 
-                                     growth_rate_periods = 12, 
-                                     keep_last_period = False)
-    tvcl.write_to_google_sheet(m_ga, seg + ' Monthly Growth Accounting', GOOGLE_SPREADSHEET_KEY)
-    
-    # Monthly Cohorts
-    mau_cohorts = tvct.create_xau_cohort_df(mau_decorated, 'month', use_segment=use_seg)
-    tvcl.write_to_google_sheet(mau_cohorts, seg + ' Monthly Cohorts', GOOGLE_SPREADSHEET_KEY)
-    
-    
-    
-    ### Calculate the Rolling 28-Day DAU/MAU ratios
-    rolling_dau_mau = tvct.create_xau_window_df(dau_decorated, 
-                                              time_period = 'day',
-                                              window_days = 28, 
-                                              breakouts = [2, 4, 8, 12, 16, 20],
-                                              use_segment = use_seg,
-                                              use_final_day = False)
-    tvcl.write_to_google_sheet(rolling_dau_mau, seg + ' Rolling DAU/MAU', GOOGLE_SPREADSHEET_KEY)
-    
-    
-    ### Calculate the Rolling 28-Day WAU/MAU ratios
-    rolling_wau_mau = tvct.create_xau_window_df(dau_decorated, 
-                                              time_period = 'week',
-                                              window_days = 28, 
-                                              breakouts = [2, 3, 4],
-                                              use_segment = use_seg,
-                                              use_final_day = False)
-    tvcl.write_to_google_sheet(rolling_wau_mau, seg + ' Rolling WAU/MAU', GOOGLE_SPREADSHEET_KEY)
-
-
-
-
-
-
-
-
-
-
-
+        sink = tvcloadlocal.create_sink(SINK, SINK_PATH)
+
+
+    ### Define segments. Each Segment name maps to a segment_col name
+    segments = {'Unsegmented' : None,
+                'Channel' : 'segment'
+                }
+
+
+    ### Extract the raw data and transform it into a DAU dataframe with every
+    ### segment column, or read it from the cache. The user IDs are stored as
+    ### integer codes and the segments as categoricals, which takes far less
+    ### memory; none of the outputs below list users, so the user_id_lookup
+    ### is not needed to decode them. Then stack the DAU rows of all the 
+    ### segmentations into one DAU Decorated dataframe, so each stage below 
+    ### runs once for all of them.
+    segment_cols = [c for c in segments.values() if c is not None]
+    dau, user_id_lookup = tvcc.get_dau_df(RAW_DATAFILE, 
+                                          user_id = 'client_id', 
+                                          activity_date = 'date', 
+                                          inc_amt = 'value_usd',
+                                          segment_col = segment_cols,
+                                          compact_dtypes = True,
+                                          date_format = DATE_FORMAT
+                                         )
+    dau_decorated = tvct.create_multi_segment_dau_decorated_df(dau, segments)
+
+
+    ### Define the transform stages. Each stage names the tvc_transform function
+    ### it runs, the dataframes it takes (the DAU Decorated dataframe or another
+    ### stage's result) and its other parameters. Stages that do not depend on
+    ### each other run at the same time, each on its own core.
+    stages = {
+        # WAU Decorated, Weekly Growth Accounting and Weekly Cohorts
+        'wau_decorated' : {'function' : 'create_xau_decorated_df',
+                           'inputs' : ['dau_decorated'],
+                           'kwargs' : {'time_period' : 'week', 'use_segment' : True}},
+        'w_ga' : {'function' : 'consolidate_all_ga_multi_segment',
+                  'inputs' : ['wau_decorated'],
+                  'kwargs' : {'time_period' : 'week', 
+                              'segmentations' : segments,
+                              'growth_rate_periods' : 12, 
+                              'keep_last_period' : False}},
+        'wau_cohorts' : {'function' : 'create_xau_cohort_df_multi_segment',
+                         'inputs' : ['wau_decorated'],
+                         'kwargs' : {'time_period' : 'week', 'segmentations' : segments}},
+    
+        # MAU Decorated, Monthly Growth Accounting and Monthly Cohorts
+        'mau_decorated' : {'function' : 'create_xau_decorated_df',
+                           'inputs' : ['dau_decorated'],
+                           'kwargs' : {'time_period' : 'month', 'use_segment' : True}},
+        'm_ga' : {'function' : 'consolidate_all_ga_multi_segment',
+                  'inputs' : ['mau_decorated'],
+                  'kwargs' : {'time_period' : 'month', 
+                              'segmentations' : segments,
+                              'growth_rate_periods' : 12, 
+                              'keep_last_period' : False}},
+        'mau_cohorts' : {'function' : 'create_xau_cohort_df_multi_segment',
+                         'inputs' : ['mau_decorated'],
+                         'kwargs' : {'time_period' : 'month', 'segmentations' : segments}},
+    
+        # The Rolling 28-Day DAU/MAU and WAU/MAU ratios
+        'rolling_dau_mau' : {'function' : 'create_xau_window_df_multi_segment',
+                             'inputs' : ['dau_decorated'],
+                             'kwargs' : {'segmentations' : segments,
+                                         'time_period' : 'day',
+                                         'window_days' : 28, 
+                                         'breakouts' : [2, 4, 8, 12, 16, 20],
+                                         'use_final_day' : False}},
+        'rolling_wau_mau' : {'function' : 'create_xau_window_df_multi_segment',
+                             'inputs' : ['dau_decorated'],
+                             'kwargs' : {'segmentations' : segments,
+                                         'time_period' : 'week',
+                                         'window_days' : 28, 
+                                         'breakouts' : [2, 3, 4],
+                                         'use_final_day' : False}}
+        }
+
+
+    ### The output (worksheet, file or table) each stage's results are 
+    ### written to, after the name of each segmentation
+    sheet_suffixes = {'w_ga' : ' Weekly Growth Accounting',
+                      'wau_cohorts' : ' Weekly Cohorts',
+                      'm_ga' : ' Monthly Growth Accounting',
+                      'mau_cohorts' : ' Monthly Cohorts',
+                      'rolling_dau_mau' : ' Rolling DAU/MAU',
+                      'rolling_wau_mau' : ' Rolling WAU/MAU'}
+
+
+    ### Run the stages in parallel. As soon as a stage finishes, each 
+    ### segmentation's results are written to their own output (for Google
+    ### Sheets, uploading in the background while the other stages keep 
+    ### running). Leaving the with block waits for the last uploads.
+    with sink:
+        for stage_name, result in tvcpar.run_stages(stages, 
+                                                    {'dau_decorated' : dau_decorated},
+                                                    share_dir = CACHE_DIR):
+            if stage_name not in sheet_suffixes:
+                continue
+            
+            for seg, seg_df in tvct.split_segmentation_dfs(result, segments):
+                sink.write(seg_df, seg + sheet_suffixes[stage_name])
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+### An index of who was active on which day, built once from the DAU
+### Decorated dataframe, so that the engagement functions in tvc_transform
+### do not have to filter, merge and group the whole dataframe for every
+### window. For each user (or user and segment pair, with use_segment) it
+### holds:
+###   - a bitset of active days, one bit per day from the first activity_date
+###     to the last, packed eight days to a byte
+###   - the user's daily inc_amt, stored as a sparse row (CSR style: the days
+###     and amounts of all users one after the other, in user order, with
+###     indptr marking where each user's days start)
+### "Active days in [a, b]" is then a popcount over a range of bits, and
+### "active weeks in the window" is a popcount per week. Pass the index as
+### activity_index to calc_engagement_ratios_for_window, calc_xau_hist,
+### calc_inc_dist or calc_inc_concentration, built with the same use_segment
+### as the call:
+###   tvcai = TVCActivityIndex(dau_decorated, use_segment = False)
+###   hist = tvct.calc_xau_hist(dau_decorated, 'day', last_date, 28, False,
+###                             activity_index = tvcai)
+
+import numpy as np
+import pandas as pd
+import tvc_transform as tvct
+
+### The number of set bits in each possible byte value
+POPCOUNT_TABLE = np.array([bin(b).count('1') for b in range(256)], dtype = np.uint8)
+
+
+class TVCActivityIndex:
+    def __init__(self, dau_decorated_df, use_segment = False):
+        tvct.log_progress('Creating activity index')
+
+        self.use_segment = use_segment
+
+        # Number the users (and segments) in sorted order, so that the keys
+        # come out in the same order as a groupby on user_id and segment
+        day_ordinals = tvct.to_day_ordinals(dau_decorated_df['activity_date']).astype(np.int64)
+        user_codes, user_labels = pd.factorize(dau_decorated_df['user_id'], sort = True)
+        if use_segment:
+            seg_codes, seg_labels = pd.factorize(dau_decorated_df['segment'], sort = True)
+        else:
+            seg_codes = np.zeros(len(dau_decorated_df), dtype = np.int64)
+            seg_labels = pd.Index(['All'])
+
+        # Like groupby, rows with a missing user_id or segment are left out
+        keep = (user_codes >= 0) & (seg_codes >= 0)
+        user_seg = user_codes[keep].astype(np.int64) * len(seg_labels) + seg_codes[keep]
+        key_values, row_keys = np.unique(user_seg, return_inverse = True)
+
+        self.user_ids = np.asarray(user_labels)[key_values // len(seg_labels)]
+        self.segments = np.asarray(seg_labels, dtype = object)[key_values % len(seg_labels)]
+        self.n_keys = len(key_values)
+
+        if len(day_ordinals) > 0:
+            self.first_day = int(day_ordinals.min())
+            self.n_days = int(day_ordinals.max()) - self.first_day + 1
+        else:
+            self.first_day = 0
+            self.n_days = 0
+        days = day_ordinals[keep] - self.first_day
+
+        # The daily inc_amt of each key, summed over any rows of the same key
+        # and day, sorted by key and then day
+        key_days = row_keys.astype(np.int64) * max(self.n_days, 1) + days
+        unique_key_days, key_day_idx = np.unique(key_days, return_inverse = True)
+        self.inc_amt = np.bincount(key_day_idx,
+                                   weights = dau_decorated_df['inc_amt'].values[keep].astype(np.float64),
+                                   minlength = len(unique_key_days))
+        self.row_keys = unique_key_days // max(self.n_days, 1)
+        self.days = (unique_key_days % max(self.n_days, 1)).astype(np.int32)
+        self.indptr = np.searchsorted(self.row_keys, np.arange(self.n_keys + 1))
+        self.key_days = unique_key_days
+
+        # The packed bitsets of active days. Each key and day sets one bit
+        # of one byte, and the bits that land in the same byte are OR-ed.
+        n_bytes = (self.n_days + 7) // 8
+        byte_idx = self.row_keys * n_bytes + self.days // 8
+        day_bits = (0x80 >> (self.days % 8)).astype(np.uint8)
+        self.bits = np.zeros(self.n_keys * n_bytes, dtype = np.uint8)
+        if len(byte_idx) > 0:
+            starts = np.flatnonzero(np.r_[True, byte_idx[1:] != byte_idx[:-1]])
+            self.bits[byte_idx[starts]] = np.bitwise_or.reduceat(day_bits, starts)
+        self.bits = self.bits.reshape(self.n_keys, n_bytes)
+
+
+
+    ### Converts a date to the day number used by the index (days since the
+    ### first activity_date)
+    def day_number(self, date):
+        return int(tvct.to_day_ordinals([date])[0]) - self.first_day
+
+
+
+    ### The number of active days of every key from day number start_day to
+    ### day number end_day, both included
+    def count_active_days(self, start_day, end_day):
+
+        start_day = max(start_day, 0)
+        end_day = min(end_day, self.n_days - 1)
+        if start_day > end_day:
+            return np.zeros(self.n_keys, dtype = np.int64)
+
+        first_byte = start_day // 8
+        last_byte = end_day // 8
+        block = self.bits[:, first_byte:last_byte + 1].copy()
+
+        # Clear the bits of the first and last bytes that are outside the
+        # range. The first day of a byte is its highest bit.
+        block[:, 0] &= np.uint8(0xFF >> (start_day % 8))
+        block[:, -1] &= np.uint8((0xFF << (7 - end_day % 8)) & 0xFF)
+
+        return POPCOUNT_TABLE[block].sum(axis = 1, dtype = np.int64)
+
+
+
+    ### The number of periods of period_days days, counted from start_day,
+    ### in which each key has at least one active day
+    def count_active_periods(self, start_day, end_day, period_days = 1):
+
+        if period_days == 1:
+            return self.count_active_days(start_day, end_day)
+
+        active_periods = np.zeros(self.n_keys, dtype = np.int64)
+        for period_start in range(start_day, end_day + 1, period_days):
+            period_end = min(period_start + period_days - 1, end_day)
+            active_periods += self.count_active_days(period_start, period_end) > 0
+
+        return active_periods
+
+
+
+    ### The sum of inc_amt of every key from day number start_day to day
+    ### number end_day, both included. Each key's days in the range are one
+    ### contiguous run of its sparse row, found with a binary search. The
+    ### amounts are summed per period of period_days days and then over the
+    ### periods, with the same pandas groupby sums as calc_user_periodic_usage,
+    ### so that the totals (and the order of users with equal totals) match.
+    def sum_inc_amt(self, start_day, end_day, period_days = 1):
+
+        window_start = start_day
+        start_day = max(start_day, 0)
+        end_day = min(end_day, self.n_days - 1)
+        if start_day > end_day:
+            return np.zeros(self.n_keys, dtype = np.float64)
+
+        keys = np.arange(self.n_keys, dtype = np.int64) * self.n_days
+        lo = np.searchsorted(self.key_days, keys + start_day, side = 'left')
+        hi = np.searchsorted(self.key_days, keys + end_day, side = 'right')
+
+        # The positions of all the rows in the runs, and the key of each
+        lengths = hi - lo
+        run_keys = np.repeat(np.arange(self.n_keys), lengths)
+        rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - lo, lengths)
+
+        window_rows = pd.DataFrame({'key' : run_keys,
+                                    'period' : (self.days[rows] - window_start) // period_days,
+                                    'inc_amt' : self.inc_amt[rows]})
+        key_sums = (window_rows.groupby(['key', 'period'], as_index = False)['inc_amt'].sum()
+                    .groupby('key')['inc_amt'].sum())
+
+        inc_amt = np.zeros(self.n_keys, dtype = np.float64)
+        inc_amt[key_sums.index.values] = key_sums.values
+
+        return inc_amt
+
+
+
+    ### The dataframe calc_user_periodic_usage builds before its breakouts:
+    ### one row per user (and segment) active in the window ending on
+    ### last_date, with the number of active periods and the sum of inc_amt
+    def user_periodic_usage(self, time_period, last_date, window_days):
+
+        time_fields = tvct.get_time_period_dict(time_period)
+        if time_fields is None:
+            period_days = 1
+        else:
+            period_days = time_fields['days']
+        active_col_name = 'active_' + time_period + 's'
+
+        end_day = self.day_number(last_date)
+        start_day = end_day - window_days + 1
+        active_periods = self.count_active_periods(start_day, end_day, period_days)
+        is_active = active_periods > 0
+
+        return pd.DataFrame({'user_id' : self.user_ids[is_active],
+                             'segment' : self.segments[is_active],
+                             active_col_name : active_periods[is_active],
+                             'inc_amt' : self.sum_inc_amt(start_day, end_day, period_days)[is_active]})
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+### Benchmarks for the tvc_transform stages on synthetic event logs of any
+### size. generate_transactions builds a seeded transaction log with a given
+### number of events, users, days and segments, with users who churn and
+### sometimes come back, and heavy-tailed (Pareto) revenue per transaction.
+### run_benchmarks times each stage, and measures its peak memory with
+### tracemalloc, at each scale point, and returns the results as a dict that
+### write_results saves as JSON. Each stage is timed repeat times after a
+### warm-up run, and the fastest time is recorded along with the median and
+### the slowest, since two runs of the same code can easily be 15% apart.
+### compare_results lines up two JSON files (e.g. from two versions of the
+### code) and reports the stages that got slower or bigger. From the
+### command line:
+###
+###   python tvc_benchmark.py --events 100000 1000000 --output before.json
+###   python tvc_benchmark.py --events 100000 1000000 --output after.json
+###   python tvc_benchmark.py --compare before.json after.json
+###
+### Add --fast to run the stages with their opt-in fast paths
+### (use_vectorized, use_incremental). The default paths of
+### calc_rolling_qr_window and create_xau_window_df go day by day, so the
+### larger scale points are only practical with --fast.
+
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import tvc_transform as tvct
+
+DEFAULT_SCALE_POINTS = [10**5, 10**6, 10**7, 10**8]
+
+### The stages in the order they run. Each one names its tvc_transform
+### function, the earlier result it takes as input ('transactions' is the
+### generated log), its keyword arguments, and the extra keyword arguments
+### that switch on its fast path.
+STAGES = [{'name' : 'create_dau_df',
+           'function' : 'create_dau_df',
+           'input' : 'transactions',
+           'kwargs' : {'segment_col' : 'segment'},
+           'fast_kwargs' : {}},
+          {'name' : 'create_dau_decorated_df',
+           'function' : 'create_dau_decorated_df',
+           'input' : 'create_dau_df',
+           'kwargs' : {},
+           'fast_kwargs' : {}},
+          {'name' : 'create_xau_decorated_df',
+           'function' : 'create_xau_decorated_df',
+           'input' : 'create_dau_decorated_df',
+           'kwargs' : {'time_period' : 'month', 'use_segment' : True},
+           'fast_kwargs' : {}},
+          {'name' : 'consolidate_all_ga',
+           'function' : 'consolidate_all_ga',
+           'input' : 'create_xau_decorated_df',
+           'kwargs' : {'time_period' : 'month', 'use_segment' : True},
+           'fast_kwargs' : {'use_vectorized' : True}},
+          {'name' : 'create_xau_cohort_df',
+           'function' : 'create_xau_cohort_df',
+           'input' : 'create_xau_decorated_df',
+           'kwargs' : {'time_period' : 'month', 'use_segment' : True},
+           'fast_kwargs' : {}},
+          {'name' : 'create_xau_window_df',
+           'function' : 'create_xau_window_df',
+           'input' : 'create_dau_decorated_df',
+           'kwargs' : {'time_period' : 'day', 'window_days' : 28, 'breakouts' : [2, 4],
+                       'use_segment' : True},
+           'fast_kwargs' : {'use_incremental' : True}},
+          {'name' : 'calc_rolling_qr_window',
+           'function' : 'calc_rolling_qr_window',
+           'input' : 'create_dau_decorated_df',
+           'kwargs' : {'window_days' : 28, 'use_segment' : True},
+           'fast_kwargs' : {'use_vectorized' : True}},
+          {'name' : 'calc_inc_dist',
+           'function' : 'calc_inc_dist',
+           'input' : 'create_dau_decorated_df',
+           'kwargs' : {'window_days' : 28, 'use_segment' : True},
+           'fast_kwargs' : {}}]
+
+
+
+### Generates a synthetic transaction log with the columns create_dau_df
+### expects by default (user_id, activity_date, inc_amt and segment).
+###   - Each user signs up on a random day and stays active for a number of
+###     days drawn so that a share churn_rate of active users churns every 30
+###     days. A share resurrection_rate of the churned users comes back after
+###     a gap and stays for another such spell.
+###   - Each user has their own lognormal activity level, and the n_events
+###     events are spread over the users' active days in proportion to it.
+###   - Each event's inc_amt is revenue_scale times a Pareto draw with shape
+###     revenue_alpha, so a few transactions are very large.
+### The same seed always gives the same log.
+def generate_transactions(n_events,
+                          n_users = None,
+                          n_days = 365,
+                          segments = ['B2B', 'B2C'],
+                          churn_rate = 0.1,
+                          resurrection_rate = 0.2,
+                          revenue_alpha = 1.5,
+                          revenue_scale = 10.0,
+                          start_date = '2023-01-01',
+                          seed = 0):
+
+    rng = np.random.default_rng(seed)
+    n_events = int(n_events)
+    if n_users is None:
+        n_users = max(n_events // 20, 1)
+
+    # The first active spell of each user, cut off at the last day
+    daily_churn = 1 - (1 - churn_rate) ** (1 / 30)
+    signup_day = rng.integers(0, n_days, n_users)
+    first_end = np.minimum(signup_day + rng.geometric(daily_churn, n_users) - 1, n_days - 1)
+
+    # The second spell of the users who come back, if it starts in time
+    comes_back = rng.random(n_users) < resurrection_rate
+    second_start = first_end + 1 + rng.geometric(daily_churn, n_users)
+    second_end = np.minimum(second_start + rng.geometric(daily_churn, n_users) - 1, n_days - 1)
+    comes_back &= second_start < n_days
+
+    spell_user = np.concatenate([np.arange(n_users), np.flatnonzero(comes_back)])
+    spell_start = np.concatenate([signup_day, second_start[comes_back]])
+    spell_days = np.concatenate([first_end, second_end[comes_back]]) - spell_start + 1
+
+    # Spread the events over the spells by length and activity level
+    activity_level = rng.lognormal(0, 1, n_users)
+    weights = spell_days * activity_level[spell_user]
+    spell_events = rng.multinomial(n_events, weights / weights.sum())
+
+    event_spell = np.repeat(np.arange(len(spell_user)), spell_events)
+    event_day = spell_start[event_spell] + (rng.random(n_events) * spell_days[event_spell]).astype(np.int64)
+    event_user = spell_user[event_spell]
+
+    # The user IDs and segments are made once per user and shared by the
+    # user's events
+    user_ids = np.array(['U%09d' % u for u in range(n_users)], dtype = object)
+    user_segments = np.array(segments, dtype = object)[rng.integers(0, len(segments), n_users)]
+
+    transactions = pd.DataFrame({'user_id' : user_ids[event_user],
+                                 'activity_date' : (np.datetime64(start_date, 'D') + event_day).astype('datetime64[ns]'),
+                                 'inc_amt' : np.round(revenue_scale * (rng.pareto(revenue_alpha, n_events) + 1), 2),
+                                 'segment' : user_segments[event_user]})
+
+    # Shuffle the rows, as a real event log is not sorted by user
+    return transactions.iloc[rng.permutation(n_events)].reset_index(drop = True)
+
+
+
+### Runs function once to warm up (imports, caches, memory allocation), then
+### repeat more times to time it and, with profile_memory, once more under
+### tracemalloc to measure its peak memory (tracemalloc slows it down, so the
+### two are measured separately). Returns the result of the warm-up run and
+### the times of the timed runs.
+def measure_stage(function, args, kwargs, repeat = 3, profile_memory = True, verbose = False):
+
+    stdout = sys.stdout if verbose else io.StringIO()
+
+    with redirect_stdout(stdout):
+        result = function(*args, **kwargs)
+        times = []
+        for r in range(repeat):
+            start = time.perf_counter()
+            function(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+
+    peak_memory_mb = None
+    if profile_memory:
+        tracemalloc.start()
+        try:
+            with redirect_stdout(stdout):
+                function(*args, **kwargs)
+            peak_memory_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+
+    return result, times, peak_memory_mb
+
+
+
+### Times (and memory-profiles) every stage at every scale point. stages
+### is a list of stage names from STAGES (all of them by default); stages
+### whose input is not run are skipped. generator_kwargs go to
+### generate_transactions. Returns a dict ready for write_results.
+def run_benchmarks(scale_points = DEFAULT_SCALE_POINTS,
+                   stages = None,
+                   fast = False,
+                   repeat = 3,
+                   profile_memory = True,
+                   generator_kwargs = {},
+                   verbose = False):
+
+    if repeat < 1:
+        raise ValueError('repeat must be at least 1.')
+    if stages is None:
+        stages = [s['name'] for s in STAGES]
+    unknown = set(stages) - set(s['name'] for s in STAGES)
+    if len(unknown) > 0:
+        raise ValueError('Unknown stages %s. Use %s.' % (sorted(unknown), [s['name'] for s in STAGES]))
+
+    results = []
+    for n_events in scale_points:
+        n_events = int(n_events)
+        tvct.log_progress('Generating %s events' % n_events)
+        outputs = {'transactions' : generate_transactions(n_events, **generator_kwargs)}
+
+        for stage in STAGES:
+            if stage['name'] not in stages or stage['input'] not in outputs:
+                continue
+
+            kwargs = dict(stage['kwargs'])
+            if fast:
+                kwargs.update(stage['fast_kwargs'])
+            input_df = outputs[stage['input']]
+
+            tvct.log_progress('Running %s on %s events' % (stage['name'], n_events))
+            result, times, peak_memory_mb = measure_stage(getattr(tvct, stage['function']),
+                                                          [input_df], kwargs, repeat,
+                                                          profile_memory, verbose)
+            outputs[stage['name']] = result
+
+            results.append({'n_events' : n_events,
+                            'stage' : stage['name'],
+                            'kwargs' : kwargs,
+                            'seconds' : min(times),
+                            'seconds_median' : float(np.median(times)),
+                            'seconds_max' : max(times),
+                            'times' : times,
+                            'peak_memory_mb' : peak_memory_mb,
+                            'input_rows' : len(input_df),
+                            'output_rows' : len(result)})
+            tvct.log_progress('  %.3f s (%.3f to %.3f s over %s runs), %s MB peak' %
+                              (min(times), min(times), max(times), repeat,
+                               'n/a' if peak_memory_mb is None else '%.1f' % peak_memory_mb))
+
+        del outputs
+
+    return {'created' : datetime.now().isoformat(timespec = 'seconds'),
+            'environment' : get_environment(),
+            'generator' : dict(generator_kwargs),
+            'fast' : fast,
+            'repeat' : repeat,
+            'results' : results}
+
+
+
+### The versions and machine the results were measured with
+def get_environment():
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True,
+                                text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'git_commit' : commit,
+            'python' : platform.python_version(),
+            'pandas' : pd.__version__,
+            'numpy' : np.__version__,
+            'platform' : platform.platform(),
+            'processor' : platform.processor()}
+
+
+
+def write_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+
+
+def read_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+
+### Lines up the results of two benchmark runs by scale point and stage, as
+### a dataframe with the fastest time and peak memory of each and their
+### ratios (new / old). A stage's time has regressed if its fastest new run
+### took more than 1 + threshold times as long as its fastest old run, and
+### longer than the slowest old run as well, so that a difference within
+### the spread of the old runs is not taken for one. Its memory has
+### regressed if it took more than 1 + threshold times as much. Results
+### from before the runs were repeated count their one time as the fastest
+### and the slowest.
+def compare_results(old_results, new_results, threshold = 0.1):
+
+    def to_df(results):
+        results_df = pd.DataFrame(results['results'])
+        if 'seconds_max' not in results_df.columns:
+            results_df['seconds_max'] = results_df['seconds']
+        return (results_df.set_index(['n_events', 'stage'])
+                [['seconds', 'seconds_max', 'peak_memory_mb']])
+
+    comparison = to_df(old_results).join(to_df(new_results), how = 'inner',
+                                         lsuffix = '_old', rsuffix = '_new')
+    comparison['time_ratio'] = comparison['seconds_new'] / comparison['seconds_old']
+    comparison['memory_ratio'] = comparison['peak_memory_mb_new'] / comparison['peak_memory_mb_old']
+    comparison['regression'] = (((comparison['time_ratio'] > 1 + threshold) &
+                                 (comparison['seconds_new'] > comparison['seconds_max_old'])) |
+                                (comparison['memory_ratio'] > 1 + threshold))
+
+    return comparison.reset_index()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the tvc_transform stages on synthetic event logs.')
+    parser.add_argument('--events', type = float, nargs = '+', default = DEFAULT_SCALE_POINTS,
+                        help = 'number of events at each scale point')
+    parser.add_argument('--stages', nargs = '+', default = None,
+                        help = 'stages to run (default: all)')
+    parser.add_argument('--fast', action = 'store_true',
+                        help = 'use the opt-in fast paths of the stages')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'timed runs of each stage, after a warm-up run')
+    parser.add_argument('--no-memory', action = 'store_true',
+                        help = 'skip the tracemalloc memory measurements')
+    parser.add_argument('--users', type = int, default = None)
+    parser.add_argument('--days', type = int, default = 365)
+    parser.add_argument('--segments', type = int, default = 2)
+    parser.add_argument('--churn-rate', type = float, default = 0.1)
+    parser.add_argument('--resurrection-rate', type = float, default = 0.2)
+    parser.add_argument('--revenue-alpha', type = float, default = 1.5)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'tvc_benchmark_results.json')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'),
+                        help = 'compare two results files instead of running')
+    parser.add_argument('--threshold', type = float, default = 0.1)
+    parser.add_argument('--verbose', action = 'store_true')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        comparison = compare_results(read_results(args.compare[0]),
+                                     read_results(args.compare[1]),
+                                     args.threshold)
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+            print(comparison)
+        sys.exit(1 if comparison['regression'].any() else 0)
+
+    generator_kwargs = {'n_users' : args.users,
+                        'n_days' : args.days,
+                        'segments' : ['Segment %s' % (i + 1) for i in range(args.segments)],
+                        'churn_rate' : args.churn_rate,
+                        'resurrection_rate' : args.resurrection_rate,
+                        'revenue_alpha' : args.revenue_alpha,
+                        'seed' : args.seed}
+    results = run_benchmarks(args.events, args.stages, args.fast, args.repeat, not args.no_memory,
+                             generator_kwargs, args.verbose)
+    write_results(results, args.output)
+    print('Wrote %s' % args.output)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+### A persistent on-disk cache for the DAU and DAU Decorated dataframes, so
+### that repeated pipeline runs and notebooks do not re-read the raw
+### transaction file and rebuild them every time. Each dataframe is stored in
+### a columnar file (Feather by default, or Parquet) whose name is a hash of
+### the source file's fingerprint and of the parameters passed to
+### create_dau_df. If the source file changes, or the same file is read with
+### different column names, segment_col or include_zero_inc, the hash changes
+### and the dataframes are rebuilt. Reading and writing these files needs the
+### pyarrow library. With compact_dtypes = True the dataframes are cached with
+### user_id codes and categorical segments (see tvct.compact_dau_df), the
+### user_id lookup is cached next to them, and both are returned.
+###
+### Feather files are read without copying: the numeric, date and category
+### code columns of the returned dataframes point straight into the
+### memory-mapped file, and are read-only. The tvc_transform functions never
+### change their inputs in place; copy() a cached dataframe before changing
+### its columns in place yourself. String columns (user_id and segment
+### without compact_dtypes) are always copied into Python objects.
+
+import os
+import io
+import json
+import hashlib
+import urllib.error
+import urllib.request
+import pandas as pd
+import tvc_transform as tvct
+
+CACHE_FILE_FORMATS = ['feather', 'parquet']
+
+
+class TVCCache:
+    def __init__(self, cache_dir = '.tvc_cache', file_format = 'feather'):
+        if file_format not in CACHE_FILE_FORMATS:
+            raise ValueError("Invalid file_format specified. Use 'feather' or 'parquet'.")
+
+        self.cache_dir = cache_dir
+        self.file_format = file_format
+        os.makedirs(cache_dir, exist_ok = True)
+
+
+
+    ### Fingerprint of the raw data source. For a local file it is the size,
+    ### modification time, and a SHA-256 hash of the contents. For a URL it
+    ### is the ETag, Last-Modified and Content-Length headers of a HEAD
+    ### request, so a cache hit does not download the file. Only if the
+    ### server sends neither an ETag nor a Last-Modified header (or refuses
+    ### HEAD requests) are the contents downloaded and hashed, and then they
+    ### are returned as well so that a cache miss does not have to download
+    ### them a second time.
+    def fingerprint_source(self, source):
+
+        sha = hashlib.sha256()
+        if os.path.exists(source):
+            stat = os.stat(source)
+            with open(source, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            fingerprint = {'source' : os.path.abspath(source),
+                           'size' : stat.st_size,
+                           'mtime' : stat.st_mtime,
+                           'sha256' : sha.hexdigest()}
+            return fingerprint, None
+
+        fingerprint = {'source' : source}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(source, method = 'HEAD')) as response:
+                for header in ['ETag', 'Last-Modified', 'Content-Length']:
+                    if response.headers.get(header) is not None:
+                        fingerprint[header.lower()] = response.headers.get(header)
+        except urllib.error.HTTPError:
+            pass
+        if 'etag' in fingerprint or 'last-modified' in fingerprint:
+            return fingerprint, None
+
+        with urllib.request.urlopen(source) as response:
+            contents = response.read()
+        sha.update(contents)
+        fingerprint = {'source' : source,
+                       'size' : len(contents),
+                       'sha256' : sha.hexdigest()}
+
+        return fingerprint, contents
+
+
+
+    ### The cache key is a hash of the source fingerprint and the parameters
+    def cache_key(self, fingerprint, params):
+        key_json = json.dumps({'fingerprint' : fingerprint, 'params' : params},
+                              sort_keys = True)
+        return hashlib.sha256(key_json.encode('utf-8')).hexdigest()[:32]
+
+
+
+    def cache_path(self, name, key):
+        return os.path.join(self.cache_dir, '%s_%s.%s' % (name, key, self.file_format))
+
+
+
+    ### Reads a cached dataframe. Uncompressed Feather files are memory-mapped,
+    ### and with split_blocks each column is converted on its own, so the
+    ### numeric columns of a file written in one record batch are not copied
+    ### at all: the pages of the file are only read in when they are used.
+    def read_cached_df(self, path):
+        if self.file_format == 'feather':
+            import pyarrow.feather as feather
+            return feather.read_table(path, memory_map = True).to_pandas(split_blocks = True,
+                                                                         self_destruct = True)
+        else:
+            return pd.read_parquet(path)
+
+
+
+    ### Writes to a temporary file first and then renames it, so an
+    ### interrupted run never leaves a partial file under the final name.
+    ### Feather files are written as a single record batch, since columns
+    ### split across batches have to be copied to be joined up when read.
+    def write_cached_df(self, dataframe, path):
+        tmp_path = path + '.tmp'
+        if self.file_format == 'feather':
+            dataframe.reset_index(drop = True).to_feather(tmp_path,
+                                                          compression = 'uncompressed',
+                                                          chunksize = max(len(dataframe), 1))
+        else:
+            dataframe.to_parquet(tmp_path, index = False)
+        os.replace(tmp_path, path)
+
+
+
+    ### Returns the DAU dataframe for the source file, as create_dau_df would
+    ### build it from the file's transactions, reading it from the cache if
+    ### it is there and building and caching it if not. Set refresh = True to
+    ### rebuild it regardless.
+    def get_dau_df(self,
+                   source,
+                   user_id = 'user_id',
+                   activity_date = 'activity_date',
+                   inc_amt = 'inc_amt',
+                   segment_col = None,
+                   include_zero_inc = False,
+                   refresh = False,
+                   compact_dtypes = False,
+                   date_format = None):
+
+        params = self.dau_params(user_id, activity_date, inc_amt, segment_col,
+                                 include_zero_inc, compact_dtypes, date_format)
+        fingerprint, contents = self.fingerprint_source(source)
+
+        return self.load_or_create_dau(source, params, fingerprint, contents, refresh)
+
+
+
+    ### Returns the DAU Decorated dataframe for the source file, as
+    ### create_dau_decorated_df would build it from the DAU dataframe above,
+    ### reading it from the cache if it is there and building and caching it
+    ### (and the DAU dataframe) if not.
+    def get_dau_decorated_df(self,
+                             source,
+                             user_id = 'user_id',
+                             activity_date = 'activity_date',
+                             inc_amt = 'inc_amt',
+                             segment_col = None,
+                             include_zero_inc = False,
+                             refresh = False,
+                             compact_dtypes = False,
+                             date_format = None):
+
+        params = self.dau_params(user_id, activity_date, inc_amt, segment_col,
+                                 include_zero_inc, compact_dtypes, date_format)
+        fingerprint, contents = self.fingerprint_source(source)
+        key = self.cache_key(fingerprint, params)
+        path = self.cache_path('dau_decorated', key)
+
+        if os.path.exists(path) and not refresh:
+            tvct.log_progress('Reading DAU Decorated dataframe from cache')
+            if compact_dtypes:
+                return self.read_cached_df(path), self.read_user_id_lookup(key)
+            return self.read_cached_df(path)
+
+        if compact_dtypes:
+            dau, user_id_lookup = self.load_or_create_dau(source, params, fingerprint, contents, refresh)
+        else:
+            dau = self.load_or_create_dau(source, params, fingerprint, contents, refresh)
+        dau_decorated = tvct.create_dau_decorated_df(dau)
+        self.write_cached_df(dau_decorated, path)
+
+        if compact_dtypes:
+            self.write_user_id_lookup(user_id_lookup, key)
+            return dau_decorated, user_id_lookup
+        return dau_decorated
+
+
+
+    ### The create_dau_df parameters that go into the cache key. 
+    ### compact_dtypes and date_format are only added when they are set, so
+    ### that the keys of dataframes cached before they existed do not change.
+    def dau_params(self, user_id, activity_date, inc_amt, segment_col,
+                   include_zero_inc, compact_dtypes, date_format = None):
+
+        params = {'user_id' : user_id,
+                  'activity_date' : activity_date,
+                  'inc_amt' : inc_amt,
+                  'segment_col' : segment_col,
+                  'include_zero_inc' : include_zero_inc}
+        if compact_dtypes:
+            params['compact_dtypes'] = True
+        if date_format is not None:
+            params['date_format'] = date_format
+
+        return params
+
+
+
+    def read_user_id_lookup(self, key):
+        return self.read_cached_df(self.cache_path('user_ids', key))['user_id'].values
+
+
+
+    def write_user_id_lookup(self, user_id_lookup, key):
+        self.write_cached_df(pd.DataFrame({'user_id' : user_id_lookup}),
+                             self.cache_path('user_ids', key))
+
+
+
+    def load_or_create_dau(self, source, params, fingerprint, contents, refresh):
+
+        key = self.cache_key(fingerprint, params)
+        path = self.cache_path('dau', key)
+        compact_dtypes = params.get('compact_dtypes', False)
+
+        if os.path.exists(path) and not refresh:
+            tvct.log_progress('Reading DAU dataframe from cache')
+            if compact_dtypes:
+                return self.read_cached_df(path), self.read_user_id_lookup(key)
+            return self.read_cached_df(path)
+
+        # Read a local file from disk or a URL directly, or a downloaded file
+        # from memory
+        if contents is None:
+            csv_source = source
+        else:
+            csv_source = io.BytesIO(contents)
+
+        tvct.log_progress('Creating DAU dataframe')
+        if compact_dtypes:
+            dau, user_id_lookup = tvct.create_dau_df_from_csv(csv_source, **params)
+            self.write_user_id_lookup(user_id_lookup, key)
+            self.write_cached_df(dau, path)
+            return dau, user_id_lookup
+
+        dau = tvct.create_dau_df_from_csv(csv_source, **params)
+        self.write_cached_df(dau, path)
+
+        return dau
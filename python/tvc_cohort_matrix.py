@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+### Cohort triangles as 2-D NumPy arrays. create_xau_cohort_df returns one
+### row per cohort, period (and segment); charts and LTV models usually want
+### the same numbers as a matrix instead, with one row per cohort (the
+### period in which its users first appeared) and one column per age (the
+### number of periods since then). TVCCohortMatrix builds those matrices
+### directly from the cohort sums of tvct.calc_xau_cohort_base, for every
+### segment at once, as arrays of shape (segments, cohorts, ages):
+###   - cust_ct: the number of the cohort's users active at each age
+###   - inc_amt: the cohort's inc_amt at each age
+### and from them the triangles create_xau_cohort_df reports:
+###   - retention(): cust_ret_pct, cust_ct / the cohort's size
+###   - cum_ltv(): cum_inc_per_cohort_cust, the cumulative inc_amt up to each
+###     age / the cohort's size
+### Ages after the last period in the data are NaN, so each segment's matrix
+### is a triangle. Ages with no active users within it are 0 (retention) or
+### carry the cumulative inc_amt forward (LTV). A single 'All' segment is
+### used without use_segment.
+###
+###   tvccm = TVCCohortMatrix(mau_decorated, 'month', use_segment = True)
+###   ltv = tvccm.to_frame('cum_ltv', segment = 'B2B')
+###   with tvcloadlocal.create_sink('parquet', 'output') as sink:
+###       tvccm.write_to_sink(sink, 'Monthly Cohort')
+
+import numpy as np
+import pandas as pd
+import tvc_transform as tvct
+
+COHORT_MATRIX_VALUES = ['cust_ct', 'inc_amt', 'retention', 'cum_ltv']
+
+
+class TVCCohortMatrix:
+    def __init__(self, xau_decorated_df, time_period, use_segment = False):
+        tvct.log_progress('Creating cohort matrix')
+
+        time_fields = tvct.get_time_period_dict(time_period)
+        self.time_period = time_period
+        self.unit = time_fields['unit']
+        self.use_segment = use_segment
+
+        cohort_base = tvct.calc_xau_cohort_base(xau_decorated_df, time_period, use_segment).reset_index()
+
+        # The cohorts and periods as ordinals, and the age of each cohort sum
+        cohort_ordinals = tvct.to_period_ordinals(cohort_base[time_fields['first_period_col']],
+                                                  time_period).astype(np.int64)
+        period_ordinals = tvct.to_period_ordinals(cohort_base[time_fields['grouping_col']],
+                                                  time_period).astype(np.int64)
+        ages = period_ordinals - cohort_ordinals
+
+        if use_segment:
+            seg_codes, seg_labels = pd.factorize(cohort_base['segment'], sort = True)
+        else:
+            seg_codes = np.zeros(len(cohort_base), dtype = np.int64)
+            seg_labels = pd.Index(['All'])
+        self.segments = pd.Index(seg_labels, name = 'segment')
+
+        if len(cohort_base) > 0:
+            self.first_cohort = int(cohort_ordinals.min())
+            self.last_period = int(period_ordinals.max())
+        else:
+            self.first_cohort = 0
+            self.last_period = -1
+        n_cohorts = self.last_period - self.first_cohort + 1
+        cohort_idx = cohort_ordinals - self.first_cohort
+        self.cohorts = pd.Index(tvct.ordinals_to_periods(self.first_cohort + np.arange(n_cohorts),
+                                                         time_period),
+                                name = time_fields['first_period_col'])
+        self.ages = pd.Index(np.arange(n_cohorts), name = '%ss Since First' % self.unit)
+
+        # The dense segment x cohort x age arrays, filled by placing each
+        # cohort sum in its cell
+        shape = (len(self.segments), n_cohorts, n_cohorts)
+        self.cust_ct = np.zeros(shape, dtype = np.int64)
+        self.inc_amt = np.zeros(shape, dtype = np.float64)
+        self.cust_ct[seg_codes, cohort_idx, ages] = cohort_base['cust_ct'].values
+        self.inc_amt[seg_codes, cohort_idx, ages] = cohort_base['inc_amt'].values
+
+        # The cells of each cohort up to the last period in the data
+        self.observed = (np.arange(n_cohorts)[None, :] <=
+                         (self.last_period - self.first_cohort - np.arange(n_cohorts))[:, None])
+
+        # The size of each cohort is its number of users in the first period
+        # it has any, as in create_xau_cohort_df (normally age 0)
+        has_users = self.cust_ct > 0
+        first_age = np.argmax(has_users, axis = 2)
+        self.cohort_cust_ct = np.take_along_axis(self.cust_ct, first_age[:, :, None], axis = 2)[:, :, 0]
+
+
+
+    ### The index of a segment label, for the methods that take a segment.
+    ### Without use_segment there is only the 'All' segment.
+    def segment_index(self, segment):
+        if segment is None:
+            if len(self.segments) != 1:
+                raise ValueError('Pass one of the segments %s.' % list(self.segments))
+            return 0
+        return self.segments.get_loc(segment)
+
+
+
+    ### Divides by the cohort sizes, with NaN for cohorts with no users and
+    ### for the cells after the last period
+    def per_cohort_cust(self, values):
+        cohort_cust_ct = self.cohort_cust_ct[:, :, None].astype(np.float64)
+        cohort_cust_ct[cohort_cust_ct == 0] = np.nan
+
+        return np.where(self.observed[None, :, :], values / cohort_cust_ct, np.nan)
+
+
+
+    ### The cumulative inc_amt of each cohort up to each age. pandas' groupby
+    ### cumsum in create_xau_cohort_df uses Kahan summation, so the sums are
+    ### accumulated the same way, one age at a time across all cohorts, 
+    ### skipping the ages with no active users as its rows do, to give the 
+    ### same results to the last bit.
+    def cum_inc_amt(self):
+
+        cum_inc_amt = np.empty_like(self.inc_amt)
+        total = np.zeros(self.inc_amt.shape[:2])
+        compensation = np.zeros(self.inc_amt.shape[:2])
+        for age in range(self.inc_amt.shape[2]):
+            present = self.cust_ct[:, :, age] > 0
+            y = self.inc_amt[:, :, age] - compensation
+            t = total + y
+            compensation = np.where(present, (t - total) - y, compensation)
+            total = np.where(present, t, total)
+            cum_inc_amt[:, :, age] = total
+
+        return cum_inc_amt
+
+
+
+    ### The retention triangles of all segments, or the 2-D triangle of one
+    def retention(self, segment = None, all_segments = False):
+        retention = self.per_cohort_cust(self.cust_ct)
+        if all_segments:
+            return retention
+        return retention[self.segment_index(segment)]
+
+
+
+    ### The cumulative LTV triangles of all segments, or the 2-D triangle of
+    ### one
+    def cum_ltv(self, segment = None, all_segments = False):
+        cum_ltv = self.per_cohort_cust(self.cum_inc_amt())
+        if all_segments:
+            return cum_ltv
+        return cum_ltv[self.segment_index(segment)]
+
+
+
+    def values(self, value, segment = None, all_segments = False):
+        if value not in COHORT_MATRIX_VALUES:
+            raise ValueError("Invalid value specified. Use 'cust_ct', 'inc_amt', 'retention' or 'cum_ltv'.")
+
+        if value == 'retention':
+            return self.retention(segment, all_segments)
+        if value == 'cum_ltv':
+            return self.cum_ltv(segment, all_segments)
+
+        array = np.where(self.observed[None, :, :], getattr(self, value), np.nan)
+        if all_segments:
+            return array
+        return array[self.segment_index(segment)]
+
+
+
+    ### Pivot: one segment's triangle as a dataframe, with a row per cohort
+    ### and a column per age
+    def to_frame(self, value = 'retention', segment = None):
+        return pd.DataFrame(self.values(value, segment),
+                            index = self.cohorts,
+                            columns = self.ages)
+
+
+
+    ### Export: every segment's triangle as one long dataframe, with a row per
+    ### segment, cohort and age in the data (the cohorts with no users are
+    ### left out) and a column per value
+    def to_long_frame(self):
+
+        n_segs, n_cohorts, n_ages = self.cust_ct.shape
+        seg_idx, cohort_idx, age_idx = np.nonzero(np.broadcast_to(self.observed, self.cust_ct.shape) &
+                                                  (self.cohort_cust_ct[:, :, None] > 0))
+
+        long_df = pd.DataFrame({'segment' : np.asarray(self.segments)[seg_idx],
+                                self.cohorts.name : self.cohorts[cohort_idx],
+                                self.ages.name : self.ages[age_idx],
+                                'cohort_cust_ct' : self.cohort_cust_ct[seg_idx, cohort_idx]})
+        for value in COHORT_MATRIX_VALUES:
+            long_df[value] = self.values(value, all_segments = True)[seg_idx, cohort_idx, age_idx]
+
+        return long_df
+
+
+
+    ### Writes each segment's retention and cumulative LTV triangles to a
+    ### tvc_load_local sink (or anything with a write(dataframe, name)
+    ### method), named e.g. 'Monthly Cohort Retention B2B'. The cohorts
+    ### become a column of strings, since the index is not written.
+    def write_to_sink(self, sink, name_prefix):
+
+        for value, value_name in [('retention', 'Retention'), ('cum_ltv', 'Cumulative LTV')]:
+            for segment in self.segments:
+                matrix_df = self.to_frame(value, segment)
+                matrix_df.columns = ['%s %s' % (self.unit, age) for age in self.ages]
+                matrix_df.insert(0, self.cohorts.name, self.cohorts.astype('str'))
+                sink.write(matrix_df.reset_index(drop = True),
+                           '%s %s %s' % (name_prefix, value_name, segment))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+### Typed loading of raw transaction files. The columns of a transaction
+### file are described by a column spec, a dictionary with the same keys as
+### the create_dau_df parameters that name them:
+###
+###   columns = {'user_id' : 'client_id',
+###              'activity_date' : 'date',
+###              'inc_amt' : 'value_usd',      # or None for no amount column
+###              'segment_col' : 'segment'}    # optional, a name or a list
+###
+### Only those columns are read, with explicit types (user_id and segments
+### as strings, inc_amt as a float, the dates as strings), so pandas does not
+### have to infer them. The dates are then parsed with
+### tvct.parse_activity_dates, once per distinct value, or with date_format
+### if it is known. engine = 'pyarrow' reads the file with pyarrow's
+### multithreaded CSV reader (needs the pyarrow library) instead of pandas'
+### own.
+###
+###   dau = tvce.read_dau_df('../data/ServBiz_transactions_2023.csv', columns)
+###
+### For files too big to read at once, tvct.create_dau_df_from_csv reads
+### them in chunks and takes the same date_format.
+
+import pandas as pd
+import tvc_transform as tvct
+
+CSV_ENGINES = ['c', 'pyarrow']
+
+### The strings pandas' read_csv reads as missing values by default. The 
+### pyarrow engine only applies them to numeric columns, so they are 
+### applied to its string columns afterwards.
+NA_STRINGS = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', 
+              '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 
+              'n/a', 'nan', 'null']
+
+
+### The names of the columns to read from a column spec, and their types
+def transaction_dtypes(columns):
+
+    dtypes = {columns['user_id'] : 'str',
+              columns['activity_date'] : 'str'}
+    if columns.get('inc_amt') is not None:
+        dtypes[columns['inc_amt']] = 'float64'
+
+    segment_col = columns.get('segment_col')
+    if isinstance(segment_col, list):
+        dtypes.update({c : 'str' for c in segment_col})
+    elif segment_col is not None:
+        dtypes[segment_col] = 'str'
+
+    return dtypes
+
+
+
+### Reads the columns of the column spec from a transaction file (or URL),
+### with activity_date parsed into datetime.date objects. The columns keep
+### their names in the file, so the result can be passed to create_dau_df
+### with the same column spec.
+def read_transactions(filepath, columns, date_format = None, engine = 'c'):
+
+    if engine not in CSV_ENGINES:
+        raise ValueError("Invalid engine specified. Use 'c' or 'pyarrow'.")
+
+    tvct.log_progress('Reading transactions')
+    dtypes = transaction_dtypes(columns)
+    transactions = pd.read_csv(filepath,
+                               usecols = list(dtypes),
+                               dtype = dtypes,
+                               engine = engine)
+    if engine == 'pyarrow':
+        for c, dtype in dtypes.items():
+            if dtype == 'str':
+                transactions[c] = transactions[c].where(~transactions[c].isin(NA_STRINGS))
+
+    activity_date = columns['activity_date']
+    transactions[activity_date] = tvct.parse_activity_dates(transactions[activity_date],
+                                                            date_format)
+
+    return transactions
+
+
+
+### Reads a transaction file (or URL) straight into the DAU dataframe that
+### create_dau_df returns. With compact_dtypes = True it returns the compact
+### DAU dataframe and the user_id lookup, as create_dau_df does.
+def read_dau_df(filepath,
+                columns,
+                date_format = None,
+                engine = 'c',
+                include_zero_inc = False,
+                compact_dtypes = False):
+
+    transactions = read_transactions(filepath, columns, date_format, engine)
+
+    return tvct.create_dau_df(transactions,
+                              user_id = columns['user_id'],
+                              activity_date = columns['activity_date'],
+                              inc_amt = columns.get('inc_amt'),
+                              segment_col = columns.get('segment_col'),
+                              include_zero_inc = include_zero_inc,
+                              compact_dtypes = compact_dtypes)
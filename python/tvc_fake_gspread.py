@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+### A small in-memory stand-in for the parts of gspread that TVCLoad uses, so
+### that the Google Sheets loading can be run and checked offline, e.g.
+###   fake = FakeClient()
+###   tvcl = TVCLoad(None, client = fake)
+###   ...
+###   fake.open_by_key(key).worksheet('Weekly Cohorts').get_all_values()
+### Every call that would be an API request is counted in request_counts.
+### To try out how a writer copes with a slow or busy API, every request can
+### be made to take latency seconds, and every rate_limit_every-th request
+### can be refused with a FakeAPIError with status 429, as gspread raises an
+### APIError when Google Sheets is over its quota.
+
+import re
+import time
+import threading
+from collections import Counter
+
+A1_RANGE = re.compile(r"^'?(.*?)'?!([A-Z]+)(\d+):([A-Z]+)(\d+)$")
+
+
+def column_number(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code):
+        super().__init__('Fake API error %s' % status_code)
+        self.response = FakeResponse(status_code)
+
+
+
+class FakeWorksheet:
+    def __init__(self, sheet_id, title, rows, cols):
+        self.id = sheet_id
+        self.title = title
+        self.cells = [['' for c in range(cols)] for r in range(rows)]
+
+    @property
+    def row_count(self):
+        return len(self.cells)
+
+    @property
+    def col_count(self):
+        return len(self.cells[0]) if len(self.cells) > 0 else 0
+
+    def resize(self, rows = None, cols = None):
+        if rows is None:
+            rows = self.row_count
+        if cols is None:
+            cols = self.col_count
+        self.cells = [(row + [''] * cols)[:cols] for row in self.cells[:rows]]
+        self.cells += [[''] * cols for r in range(rows - len(self.cells))]
+
+    def update_cells(self, first_row, first_col, values):
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                self.cells[first_row + i][first_col + j] = value
+
+    def get_all_values(self):
+        return [list(row) for row in self.cells]
+
+
+
+class FakeSpreadsheet:
+    def __init__(self, key, client):
+        self.id = key
+        self.client = client
+        self.request_counts = client.request_counts
+        self.sheets = []
+
+    def worksheets(self):
+        self.client.request('worksheets')
+        return list(self.sheets)
+
+    def worksheet(self, title):
+        for ws in self.sheets:
+            if ws.title == title:
+                return ws
+        raise KeyError(title)
+
+    def add_worksheet(self, title, rows, cols):
+        self.client.request('add_worksheet')
+        ws = FakeWorksheet(len(self.sheets), title, int(rows), int(cols))
+        self.sheets.append(ws)
+        return ws
+
+    def batch_update(self, body):
+        self.client.request('batch_update')
+        sheets_by_id = {ws.id : ws for ws in self.sheets}
+        for request in body['requests']:
+            properties = request['updateSheetProperties']['properties']
+            grid = properties['gridProperties']
+            sheets_by_id[properties['sheetId']].resize(grid.get('rowCount'), grid.get('columnCount'))
+
+    def values_batch_update(self, body):
+        self.client.request('values_batch_update')
+        for value_range in body['data']:
+            title, first_col, first_row, last_col, last_row = A1_RANGE.match(value_range['range']).groups()
+            ws = self.worksheet(title.replace("''", "'"))
+            if int(last_row) > ws.row_count or column_number(last_col) > ws.col_count:
+                raise ValueError('Range %s exceeds the grid limits' % value_range['range'])
+            ws.update_cells(int(first_row) - 1, column_number(first_col) - 1, value_range['values'])
+
+
+
+class FakeClient:
+    def __init__(self, latency = 0, rate_limit_every = None):
+        self.request_counts = Counter()
+        self.spreadsheets = {}
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.n_requests = 0
+        self.n_rate_limited = 0
+        self.lock = threading.Lock()
+
+    ### Counts a request, and refuses it before it does anything if it is
+    ### one of the rate-limited ones
+    def request(self, name):
+        with self.lock:
+            self.n_requests += 1
+            refused = (self.rate_limit_every is not None and 
+                       self.n_requests % self.rate_limit_every == 0)
+            if refused:
+                self.n_rate_limited += 1
+            else:
+                self.request_counts[name] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if refused:
+            raise FakeAPIError(429)
+
+    def open_by_key(self, key):
+        self.request('open_by_key')
+        with self.lock:
+            if key not in self.spreadsheets:
+                self.spreadsheets[key] = FakeSpreadsheet(key, self)
+        return self.spreadsheets[key]
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+### Approximate counts of distinct users with HyperLogLog sketches (Flajolet,
+### Fusy, Gandouet and Meunier, "HyperLogLog: the analysis of a near-optimal
+### cardinality estimation algorithm"), for top-line active user figures
+### over more events than are worth counting exactly. Each user_id is hashed
+### to 64 bits: the first p bits pick one of m = 2^p registers, and the
+### register keeps the largest number of leading zeros (plus one) seen in the
+### remaining bits. The number of distinct users is estimated from the
+### registers alone, so a sketch takes m bytes however many users it counts,
+### and the sketch of a union of users is the element-wise maximum of theirs.
+###
+### Error bounds: the relative standard error of an estimate is 1.04 / sqrt(m),
+### about 95% of estimates fall within twice that, and the error does not
+### depend on the number of users:
+###
+###   p      m        memory per sketch   standard error   95% within
+###   10     1024     1 KB                3.3%             6.5%
+###   12     4096     4 KB                1.6%             3.3%
+###   14     16384    16 KB               0.81%            1.6%
+###   16     65536    64 KB               0.41%            0.81%
+###
+### TVCActiveUserSketches keeps one dense sketch per segment and day, so it
+### takes segments x days x m bytes, whatever the number of events or users:
+###
+###   p      per segment-day   100 segments x 3 years
+###   10     1 KB              110 MB
+###   12     4 KB              450 MB
+###   14     16 KB             1.8 GB
+###   16     64 KB             7.2 GB
+###
+### When days are added a chunk at a time, the day axis grows by doubling,
+### so it can take up to twice that. For many segments over long spans of
+### days, pick a smaller p.
+###
+### Counts below 2.5 m are estimated by linear counting of the empty
+### registers, which is more accurate still for small groups. The same
+### user_id always hashes the same way (pandas' hash_pandas_object), so
+### sketches built from different chunks of data, or on different days, can
+### be merged.
+###
+### TVCActiveUserSketches keeps one sketch per segment and day of a DAU
+### Decorated dataframe. Unique users over any run of days are the union of
+### the days' sketches, so the rolling windows of create_xau_window_df, and
+### DAU / WAU / MAU for every day, come from sliding unions of the daily
+### sketches instead of rescanning the users of each window:
+###
+###   tvcaus = TVCActiveUserSketches(dau_decorated, use_segment = True)
+###   rolling_users = tvcaus.create_rolling_users_df()
+###   xau_window = tvct.create_xau_window_df(dau_decorated, 'day', 28,
+###                                          use_segment = True,
+###                                          user_sketches = tvcaus)
+
+import numpy as np
+import pandas as pd
+import tvc_transform as tvct
+
+### 2^-rank for every possible register value
+INVERSE_POWERS = 2.0 ** -np.arange(66)
+
+
+### The 64 bit hashes of a column of user_ids
+def hash_user_ids(user_ids):
+    return pd.util.hash_pandas_object(pd.Series(user_ids), index = False).values
+
+
+
+### The hashes of a column of user_ids, each distinct user_id hashed once,
+### and a mask of the rows with a user_id
+def hash_user_id_codes(user_ids):
+    codes, uniques = pd.factorize(user_ids)
+    return hash_user_ids(uniques)[codes], codes >= 0
+
+
+
+### The register each hash goes to (its first p bits) and its rank, the
+### number of leading zeros of the rest plus one. The leading zeros are
+### counted from the float exponent of the rest, cut to 52 bits so that it
+### converts to a float exactly.
+def register_ranks(hashes, p):
+
+    hashes = np.asarray(hashes, dtype = np.uint64)
+    registers = (hashes >> np.uint64(64 - p)).astype(np.int64)
+
+    bits = min(64 - p, 52)
+    rest = (hashes & np.uint64((1 << (64 - p)) - 1)) >> np.uint64(64 - p - bits)
+    ranks = bits + 1 - np.frexp(rest.astype(np.float64))[1]
+
+    return registers, ranks.astype(np.uint8)
+
+
+
+def alpha(m):
+    if m == 16:
+        return 0.673
+    elif m == 32:
+        return 0.697
+    elif m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+
+### The HyperLogLog estimate from the sum of 2^-rank over each sketch's
+### registers and its number of empty registers
+def estimate_from_sums(inverse_sums, n_empty, m):
+
+    inverse_sums = np.asarray(inverse_sums, dtype = np.float64)
+    n_empty = np.asarray(n_empty, dtype = np.float64)
+    raw = alpha(m) * m * m / inverse_sums
+
+    with np.errstate(divide = 'ignore'):
+        linear = m * np.log(m / n_empty)
+
+    return np.where((raw <= 2.5 * m) & (n_empty > 0), linear, raw)
+
+
+
+### The estimates of an array of sketches, registers along the last axis.
+### The registers are summed a block of sketches at a time, to keep the
+### array of 2^-rank floats small.
+def estimate_counts(registers, block_size = 64):
+
+    m = registers.shape[-1]
+    flat = registers.reshape(-1, m)
+    estimates = np.empty(len(flat))
+
+    for start in range(0, len(flat), block_size):
+        block = flat[start:start + block_size]
+        estimates[start:start + block_size] = estimate_from_sums(INVERSE_POWERS[block].sum(axis = 1),
+                                                                 (block == 0).sum(axis = 1),
+                                                                 m)
+
+    return estimates.reshape(registers.shape[:-1])
+
+
+
+### A single sketch, for counting the distinct users of anything
+class TVCHyperLogLog:
+    def __init__(self, p = 14):
+        if p < 4 or p > 18:
+            raise ValueError('p must be between 4 and 18.')
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype = np.uint8)
+
+
+
+    def add(self, user_ids):
+        user_ids = pd.Series(user_ids).dropna()
+        registers, ranks = register_ranks(hash_user_ids(user_ids), self.p)
+        np.maximum.at(self.registers, registers, ranks)
+
+
+
+    ### Adds the users of another sketch with the same p to this one
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('Only sketches with the same p can be merged.')
+        np.maximum(self.registers, other.registers, out = self.registers)
+
+
+
+    def count(self):
+        return float(estimate_counts(self.registers))
+
+
+
+### One sketch per segment and day of a DAU Decorated dataframe (a single
+### 'All' segment without use_segment). More days of data, or the sketches
+### of another TVCActiveUserSketches, can be added later. The sketches are
+### kept in register_buffer, which has room for more days than n_days so
+### that adding a day at a time does not copy them all every time;
+### registers is the part in use.
+class TVCActiveUserSketches:
+    def __init__(self, dau_decorated_df = None, use_segment = False, p = 14):
+        if p < 4 or p > 18:
+            raise ValueError('p must be between 4 and 18.')
+        self.use_segment = use_segment
+        self.p = p
+        self.m = 1 << p
+        self.segments = [] if use_segment else ['All']
+        self.first_day = 0
+        self.n_days = 0
+        self.register_buffer = np.zeros((len(self.segments), 0, self.m), dtype = np.uint8)
+
+        if dau_decorated_df is not None:
+            self.add(dau_decorated_df)
+
+
+
+    @property
+    def registers(self):
+        return self.register_buffer[:, :self.n_days]
+
+
+
+    ### Grows the registers to cover the segments and the days from first_day
+    ### to last_day (day ordinals), keeping the sketches already there. The
+    ### segments are kept in sorted order, as groupby would list them. Days
+    ### after the last one go into the spare room of register_buffer if
+    ### they fit, and otherwise the buffer is reallocated with twice the
+    ### room, so adding days one at a time copies each sketch a constant
+    ### number of times on average.
+    def extend(self, segments, first_day, last_day):
+
+        new_segments = [s for s in segments if s not in self.segments]
+        if self.n_days == 0:
+            self.first_day = first_day
+        new_first_day = min(self.first_day, first_day)
+        new_n_days = max(self.first_day + self.n_days, last_day + 1) - new_first_day
+        capacity = self.register_buffer.shape[1]
+
+        if len(new_segments) > 0 or new_first_day != self.first_day or new_n_days > capacity:
+            all_segments = sorted(self.segments + new_segments)
+            if new_n_days > capacity:
+                capacity = max(new_n_days, 2 * capacity)
+            register_buffer = np.zeros((len(all_segments), capacity, self.m), dtype = np.uint8)
+            seg_index = [all_segments.index(s) for s in self.segments]
+            shift = self.first_day - new_first_day
+            register_buffer[seg_index, shift:shift + self.n_days] = self.registers
+            self.register_buffer = register_buffer
+            self.segments = all_segments
+            self.first_day = new_first_day
+
+        self.n_days = new_n_days
+
+
+
+    ### Adds the users of a DAU Decorated dataframe (or a chunk of one). Like
+    ### groupby, rows with a missing user_id or segment are left out. Each
+    ### distinct user_id and segment is hashed or looked up once, rather
+    ### than once per row.
+    def add(self, dau_decorated_df):
+
+        tvct.log_progress('Adding %s rows to active user sketches' % len(dau_decorated_df))
+
+        hashes, keep = hash_user_id_codes(dau_decorated_df['user_id'])
+        if self.use_segment:
+            seg_codes, seg_labels = pd.factorize(dau_decorated_df['segment'], sort = True)
+            keep &= seg_codes >= 0
+        else:
+            seg_codes = np.zeros(len(dau_decorated_df), dtype = np.int64)
+            seg_labels = ['All']
+        dates = dau_decorated_df['activity_date']
+
+        if not keep.all():
+            if not keep.any():
+                return
+            hashes = hashes[keep]
+            dates = dates[keep]
+            seg_codes, used = pd.factorize(seg_codes[keep], sort = True)
+            seg_labels = np.asarray(seg_labels, dtype = object)[used]
+
+        days = tvct.to_day_ordinals(dates).astype(np.int64)
+        self.extend(list(seg_labels), int(days.min()), int(days.max()))
+
+        seg_index = np.array([self.segments.index(s) for s in seg_labels], dtype = np.int64)
+        registers, ranks = register_ranks(hashes, self.p)
+        flat_index = ((seg_index[seg_codes] * self.register_buffer.shape[1] + days - self.first_day) * self.m +
+                      registers)
+        np.maximum.at(self.register_buffer.reshape(-1), flat_index, ranks)
+
+
+
+    ### Adds the sketches of another TVCActiveUserSketches with the same p
+    def merge(self, other):
+
+        if other.p != self.p:
+            raise ValueError('Only sketches with the same p can be merged.')
+        if other.n_days == 0:
+            return
+        self.extend(other.segments, other.first_day, other.first_day + other.n_days - 1)
+
+        seg_index = [self.segments.index(s) for s in other.segments]
+        shift = other.first_day - self.first_day
+        days = slice(shift, shift + other.n_days)
+        self.registers[seg_index, days] = np.maximum(self.registers[seg_index, days],
+                                                     other.registers)
+
+
+
+    ### The sketches of the window_days days up to each day, for one segment,
+    ### as the running maximum over days. Each window is split into the
+    ### part in one block of window_days days and the part in the next, and
+    ### those are read off running maximums within the blocks from the left
+    ### and from the right (van Herk / Gil-Werman), so it takes the same time
+    ### for any window length. Windows that start before the first day
+    ### cover the days there are. The running maximums step through the
+    ### days of all the blocks at once, which is much faster than
+    ### np.maximum.accumulate along the middle axis.
+    def rolling_registers(self, seg_index, window_days):
+
+        n_days = self.n_days
+        if window_days == 1:
+            return self.registers[seg_index]
+        n_blocks = (n_days + window_days - 1) // window_days + 1
+        from_left = np.zeros((n_blocks * window_days, self.m), dtype = np.uint8)
+        from_left[window_days - 1:window_days - 1 + n_days] = self.registers[seg_index]
+        from_right = from_left.copy()
+
+        left_blocks = from_left.reshape(n_blocks, window_days, self.m)
+        right_blocks = from_right.reshape(n_blocks, window_days, self.m)
+        for i in range(1, window_days):
+            np.maximum(left_blocks[:, i - 1], left_blocks[:, i], out = left_blocks[:, i])
+            np.maximum(right_blocks[:, window_days - i], right_blocks[:, window_days - i - 1],
+                       out = right_blocks[:, window_days - i - 1])
+
+        return np.maximum(from_right[:n_days], from_left[window_days - 1:window_days - 1 + n_days])
+
+
+
+    ### The estimated number of users of each segment in the window_days days
+    ### up to each day, as an array of segments x days
+    def rolling_counts(self, window_days):
+
+        counts = np.empty((len(self.segments), self.n_days))
+        for s in range(len(self.segments)):
+            counts[s] = estimate_counts(self.rolling_registers(s, window_days))
+
+        return counts
+
+
+
+    ### Picks the counts of the given days out of a segments x days array,
+    ### as dates x segments, with 0 for days outside the sketches
+    def counts_on_days(self, counts, days):
+
+        days = np.asarray(days, dtype = np.int64)
+        in_range = (days >= 0) & (days < self.n_days)
+        picked = np.zeros((len(days), len(self.segments)))
+        picked[in_range] = counts[:, days[in_range]].T
+
+        return picked
+
+
+
+    ### The window figures of create_xau_window_df for the windows that end
+    ### on each date of date_range, in the form calc_window_counts returns
+    ### them. The users in a window are the union of its days, and the sum of
+    ### active periods is the sum of the users of each period of the window,
+    ### numbered from the window's first day as in calc_user_periodic_usage.
+    ### The breakouts need each user's number of active periods, which the
+    ### sketches do not keep, so they are NaN.
+    def window_counts(self, date_range, time_period = 'day', window_days = 28, breakouts = [2, 4],
+                      use_segment = False):
+
+        if use_segment != self.use_segment:
+            raise ValueError('The sketches were built with use_segment = %s.' % self.use_segment)
+
+        time_fields = tvct.get_time_period_dict(time_period)
+        if time_fields is None:
+            period_days = 1
+        else:
+            period_days = time_fields['days']
+        n_periods = (window_days - 1) // period_days + 1
+        last_period_days = window_days - (n_periods - 1) * period_days
+
+        end_days = (tvct.to_day_ordinals(pd.DatetimeIndex(date_range)).astype(np.int64) -
+                    self.first_day)
+
+        # The rolling counts of each window length are only worked out once,
+        # e.g. for time_period = 'day' the last period and the other periods
+        # are all single days
+        rolling_counts = {}
+        for days in {window_days, last_period_days, period_days}:
+            rolling_counts[days] = self.rolling_counts(days)
+
+        users_by_seg = self.counts_on_days(rolling_counts[window_days], end_days)
+        active_by_seg = self.counts_on_days(rolling_counts[last_period_days], end_days)
+        if n_periods > 1:
+            period_counts = rolling_counts[period_days]
+            for j in range(n_periods - 1):
+                period_end_days = end_days - window_days + (j + 1) * period_days
+                active_by_seg += self.counts_on_days(period_counts, period_end_days)
+
+        breakouts_by_seg = np.full((len(breakouts), len(date_range), len(self.segments)), np.nan)
+
+        return date_range, pd.Index(self.segments), active_by_seg, users_by_seg, breakouts_by_seg
+
+
+
+    ### Estimated active users per day and segment over the rolling windows
+    ### of windows (by default DAU, WAU and MAU), with one row per day and
+    ### segment with users, and the DAU / MAU ratio
+    def create_rolling_users_df(self, windows = {'DAU' : 1, 'WAU' : 7, 'MAU' : 28}):
+
+        days = np.arange(self.n_days)
+        seg_idx, day_idx = np.meshgrid(np.arange(len(self.segments)), days, indexing = 'ij')
+        rolling_users_df = pd.DataFrame({'activity_date' : tvct.day_ordinals_to_dates(self.first_day + day_idx.ravel()),
+                                         'segment' : np.asarray(self.segments, dtype = object)[seg_idx.ravel()]})
+        for name, window_days in windows.items():
+            rolling_users_df[name] = self.rolling_counts(window_days).ravel()
+
+        if 'DAU' in windows and 'MAU' in windows:
+            rolling_users_df['DAU/MAU'] = rolling_users_df['DAU'] / rolling_users_df['MAU']
+
+        first_window = list(windows)[0]
+        return rolling_users_df[rolling_users_df[first_window] > 0].reset_index(drop = True)
+
+
+
+    ### Estimated active users per calendar week or month (and segment), as
+    ### the union of the days of each period
+    def period_counts(self, time_period):
+
+        time_fields = tvct.get_time_period_dict(time_period)
+        if self.n_days == 0:
+            return pd.DataFrame(columns = [time_fields['grouping_col'], 'segment', 'users'])
+        period_ordinals = tvct.day_ordinals_to_periods(self.first_day + np.arange(self.n_days),
+                                                       time_period)
+        period_starts = np.flatnonzero(np.diff(period_ordinals, prepend = period_ordinals[:1] - 1))
+
+        counts = np.empty((len(self.segments), len(period_starts)))
+        for s in range(len(self.segments)):
+            counts[s] = estimate_counts(np.maximum.reduceat(self.registers[s], period_starts, axis = 0))
+
+        seg_idx, period_idx = np.meshgrid(np.arange(len(self.segments)), np.arange(len(period_starts)),
+                                          indexing = 'ij')
+        period_counts_df = pd.DataFrame({time_fields['grouping_col'] :
+                                             tvct.ordinals_to_periods(period_ordinals[period_starts][period_idx.ravel()],
+                                                                      time_period),
+                                         'segment' : np.asarray(self.segments, dtype = object)[seg_idx.ravel()],
+                                         'users' : counts.ravel()})
+
+        return period_counts_df[period_counts_df['users'] > 0].reset_index(drop = True)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+### Approximate revenue concentration in bounded memory, for more users than
+### fit in memory at once. tvct.calc_inc_concentration sorts one inc_amt per
+### user; here the users' inc_amt values are fed in chunks to a sketch per
+### segment instead, which keeps:
+###   - the top_k largest values exactly, since with revenue a few users
+###     often make up much of the total
+###   - a quantile sketch of all the others: a small weighted sample of them
+###     (each kept value stands for 1, 2, 4, 8, ... users) whose size grows
+###     only with the logarithm of the number of users
+### The concentration and Lorenz curve dataframes are then computed from the
+### kept values with tvct.summarize_inc_concentration, the same way as the
+### exact ones.
+###
+### The quantile sketch is laid out like a KLL sketch (Karnin, Lang and
+### Liberty, "Optimal Quantile Approximation in Streams"): level h holds
+### values of weight 2^h. When a level is over its capacity, its values are
+### sorted, and each pair of neighbours moves up a level as one value of
+### twice the weight. KLL keeps one of the two at random; here the pair's
+### mean is kept, so the sketch keeps the exact sum of the values as well as
+### their number, and a user's share of inc_amt is never put on the wrong
+### side of the total. Levels further below the top have geometrically
+### smaller capacities, so the sketch holds about 3 * k values.
+###
+### A user's inc_amt must be complete before it is added, so the
+### transactions are fed in chunks that each hold all the rows of their
+### users. partition_transactions_csv splits a transaction file into
+### n_partitions such files on disk by a hash of user_id, reading it a chunk
+### at a time, and sketch_inc_concentration then takes the DAU dataframe of
+### one partition at a time. Memory is bounded by the largest partition and
+### the sketches, not by the whole data set:
+###
+###   paths = partition_transactions_csv('transactions.csv', 'partitions',
+###                                      n_partitions = 64,
+###                                      user_id = 'client_id')
+###   daus = (tvct.create_dau_df_from_csv(path, 'client_id', 'date',
+###                                       'value_usd', 'segment')
+###           for path in paths)
+###   concentration_df, lorenz_df = sketch_inc_concentration(daus, 28, True,
+###                                                          last_date = '2024-04-30')
+
+import os
+import numpy as np
+import pandas as pd
+import tvc_transform as tvct
+
+
+class TVCQuantileSketch:
+    def __init__(self, k = 1000):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.n = 0
+
+
+
+    ### The number of values level h may hold before it is compacted: k at
+    ### the top level, 2/3 of that at the level below, and so on, but at
+    ### least 2
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+
+
+    def update(self, values):
+
+        values = np.asarray(values, dtype = np.float64)
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compact()
+
+
+
+    ### Compacts every level over its capacity, from the bottom up, so the
+    ### values moved up from one level are compacted with the next. With an
+    ### odd number of values, the largest stays behind.
+    def compact(self):
+
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(self.levels[level])
+                n_pairs = len(values) // 2
+                pair_means = (values[0:2 * n_pairs:2] + values[1:2 * n_pairs:2]) / 2
+                self.levels[level] = values[2 * n_pairs:]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], pair_means])
+            level += 1
+
+
+
+    ### The kept values and the number of values each stands for
+    def weighted_values(self):
+
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(v), 2.0 ** h) for h, v in enumerate(self.levels)])
+
+        return values, weights
+
+
+
+    ### The approximate q-quantiles (0 <= q <= 1) of the values added
+    def quantiles(self, q):
+
+        values, weights = self.weighted_values()
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan)
+        order = np.argsort(values, kind = 'stable')
+        values = values[order]
+        cum_weights = np.cumsum(weights[order])
+
+        ranks = np.asarray(q, dtype = np.float64) * cum_weights[-1]
+        positions = np.searchsorted(cum_weights, ranks, side = 'left')
+
+        return values[np.minimum(positions, len(values) - 1)]
+
+
+
+### The users' inc_amt of each segment: the top_k largest exactly, and a
+### TVCQuantileSketch of the rest
+class TVCIncSketch:
+    def __init__(self, k = 1000, top_k = 1000):
+        self.k = k
+        self.top_k = top_k
+        self.top_values = {}
+        self.sketches = {}
+
+
+
+    ### Adds the inc_amt of some users (one value per user, each user only
+    ### once over all the updates) and their segments
+    def update(self, inc_amt, segments):
+
+        inc_amt = np.nan_to_num(np.asarray(inc_amt, dtype = np.float64))
+        seg_codes, seg_labels = pd.factorize(pd.Series(segments))
+
+        for s, segment in enumerate(seg_labels):
+            if segment not in self.sketches:
+                self.sketches[segment] = TVCQuantileSketch(self.k)
+                self.top_values[segment] = np.empty(0)
+
+            # The values that drop out of the top_k go to the sketch
+            values = np.concatenate([self.top_values[segment], inc_amt[seg_codes == s]])
+            if len(values) > self.top_k:
+                split = np.argpartition(values, len(values) - self.top_k)
+                self.sketches[segment].update(values[split[:len(values) - self.top_k]])
+                values = values[split[len(values) - self.top_k:]]
+            self.top_values[segment] = values
+
+
+
+    ### The concentration and Lorenz curve dataframes of
+    ### tvct.summarize_inc_concentration, from the top values (of weight 1)
+    ### and the sketches. total_inc_amt and total_user_count are exact.
+    def concentration(self, n_quantiles = 10, lorenz_points = 100):
+
+        inc_amt = []
+        segments = []
+        user_weights = []
+        for segment, sketch in self.sketches.items():
+            values, weights = sketch.weighted_values()
+            top_values = self.top_values[segment]
+            inc_amt += [values, top_values]
+            user_weights += [weights, np.ones(len(top_values))]
+            segments.append(np.full(len(values) + len(top_values), segment, dtype = object))
+
+        if len(inc_amt) == 0:
+            return tvct.summarize_inc_concentration([], [], None, n_quantiles, lorenz_points)
+
+        return tvct.summarize_inc_concentration(np.concatenate(inc_amt),
+                                                np.concatenate(segments),
+                                                np.concatenate(user_weights),
+                                                n_quantiles,
+                                                lorenz_points)
+
+
+
+### Splits a transaction CSV file into n_partitions CSV files in out_dir by a
+### hash of user_id, so that all of each user's rows are in the same file,
+### reading chunksize rows at a time. Returns the paths of the files, in
+### partition order; a partition with no users has a file with only the
+### header.
+def partition_transactions_csv(filepath,
+                               out_dir,
+                               n_partitions = 16,
+                               user_id = 'user_id',
+                               chunksize = 1000000):
+
+    tvct.log_progress('Partitioning transactions by user_id')
+
+    os.makedirs(out_dir, exist_ok = True)
+    paths = [os.path.join(out_dir, 'partition_%s.csv' % p) for p in range(n_partitions)]
+    header_written = False
+
+    for chunk in pd.read_csv(filepath, dtype = {user_id : 'str'}, chunksize = chunksize):
+        partitions = (pd.util.hash_pandas_object(chunk[user_id], index = False).values %
+                      np.uint64(n_partitions)).astype(np.int64)
+        order = np.argsort(partitions, kind = 'stable')
+        bounds = np.searchsorted(partitions[order], np.arange(n_partitions + 1))
+        for p in range(n_partitions):
+            chunk.iloc[order[bounds[p]:bounds[p + 1]]].to_csv(paths[p], index = False,
+                                                              mode = 'a' if header_written else 'w',
+                                                              header = not header_written)
+        header_written = True
+
+    return paths
+
+
+
+### The approximate revenue concentration of the window, computed through a
+### TVCIncSketch from dau_chunks: an iterable of DAU (or DAU Decorated)
+### dataframes, each holding all the rows of its users, such as the
+### partitions of partition_transactions_csv. Only one chunk is held at a
+### time, so the chunks can be read from disk as they are needed. The window
+### ends on last_date, which has to be given, as no single chunk knows the
+### last date of them all. A single dataframe is taken as one chunk, and
+### then last_date defaults to its last activity_date.
+def sketch_inc_concentration(dau_chunks,
+                             window_days,
+                             use_segment,
+                             last_date = None,
+                             k = 1000,
+                             top_k = 1000,
+                             n_quantiles = 10,
+                             lorenz_points = 100):
+
+    if isinstance(dau_chunks, pd.DataFrame):
+        if last_date is None:
+            last_date = dau_chunks['activity_date'].max()
+        dau_chunks = [dau_chunks]
+    elif last_date is None:
+        raise ValueError('Pass last_date when the users come in several chunks.')
+
+    tvct.log_progress('Sketching revenue concentration')
+
+    tvcis = TVCIncSketch(k, top_k)
+    for dau_chunk in dau_chunks:
+        user_inc = tvct.calc_user_window_inc(dau_chunk, window_days, use_segment, last_date)
+        tvcis.update(user_inc['inc_amt'].values, user_inc['segment'].values)
+
+    return tvcis.concentration(n_quantiles, lorenz_points)
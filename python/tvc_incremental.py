@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+### An append-only, incremental version of the pipeline. Instead of
+### rebuilding the growth accounting, cohorts and rolling windows from the
+### whole transaction history on every run, TVCIncrementalPipeline keeps its
+### state in state_dir between runs and is only handed the transactions that
+### arrived since the last one. The state is:
+###   - the first_dt table (every user's first activity date, week and month)
+###   - the DAU rows of the last history_days days (the "tail"), which is
+###     enough to rebuild the xAU rows of the periods that new data can touch
+###   - the growth accounting and cohort sums per period, before the ratios
+###     and presentation options are applied
+###   - the rolling window rows computed so far
+### On each update, the periods and window end dates on or after the earliest
+### newly arrived day are recomputed from the tail and replace the stored
+### rows. Everything before them is left as it is, so a nightly run takes time
+### proportional to the new data and the tail, not to the total history.
+###
+### Typical use:
+###   tvci = TVCIncrementalPipeline('.tvc_state', user_id = 'client_id',
+###                                 activity_date = 'date', inc_amt = 'value_usd')
+###   tvci.update(new_transactions)
+###   w_ga = tvci.get_growth_accounting('week', keep_last_period = False)
+
+import os
+import pickle
+import pandas as pd
+import tvc_transform as tvct
+
+INCREMENTAL_TIME_PERIODS = ['week', 'month']
+STATE_FILE_NAME = 'tvc_incremental_state.pkl'
+
+
+class TVCIncrementalPipeline:
+    def __init__(self,
+                 state_dir,
+                 user_id = 'user_id',
+                 activity_date = 'activity_date',
+                 inc_amt = 'inc_amt',
+                 segment_col = None,
+                 include_zero_inc = False,
+                 history_days = 120,
+                 time_periods = ['week', 'month'],
+                 windows = [{'time_period' : 'day', 'window_days' : 28, 'breakouts' : [2, 4]}]):
+
+        for time_period in time_periods:
+            if time_period not in INCREMENTAL_TIME_PERIODS:
+                raise ValueError("Invalid time_period specified. Use 'week' or 'month'.")
+
+        self.state_dir = state_dir
+        self.state_path = os.path.join(state_dir, STATE_FILE_NAME)
+        self.params = {'user_id' : user_id,
+                       'activity_date' : activity_date,
+                       'inc_amt' : inc_amt,
+                       'segment_col' : segment_col,
+                       'include_zero_inc' : include_zero_inc}
+        self.use_segment = segment_col is not None
+        self.history_days = history_days
+        self.time_periods = list(time_periods)
+        self.windows = [dict(w) for w in windows]
+        self.max_window_days = max([w['window_days'] for w in self.windows], default = 1)
+
+        os.makedirs(state_dir, exist_ok = True)
+        self.state = self.read_state()
+
+
+
+    ### Reads the state saved by a previous run, or starts with an empty one.
+    ### The state can only be reused with the same columns and options.
+    def read_state(self):
+
+        if not os.path.exists(self.state_path):
+            return {'params' : self.params,
+                    'first_dt' : None,
+                    'dau_tail' : None,
+                    'first_day' : None,
+                    'last_day' : None,
+                    'ga' : {},
+                    'cohort_base' : {},
+                    'windows' : {}}
+
+        with open(self.state_path, 'rb') as f:
+            state = pickle.load(f)
+
+        if state['params'] != self.params:
+            raise ValueError('The state in %s was built with different parameters: %s'
+                             % (self.state_dir, state['params']))
+
+        return state
+
+
+
+    ### Writes to a temporary file first and then renames it, so an
+    ### interrupted run leaves the previous state in place
+    def write_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.state, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.state_path)
+
+
+
+    ### The earliest day the tail must hold for new data starting on day d0
+    ### (a day ordinal): the start of the period before d0's period, for the
+    ### growth accounting, and the first day of a window ending on d0
+    def required_start_day(self, d0):
+
+        start_day = d0 - self.max_window_days + 1
+        for time_period in self.time_periods:
+            period = tvct.day_ordinals_to_periods([d0], time_period)[0]
+            start_day = min(start_day, tvct.period_ordinals_to_start_days([period - 1], time_period)[0])
+
+        return int(start_day)
+
+
+
+    ### Processes a dataframe of newly arrived transactions, with the columns
+    ### passed to the constructor
+    def update(self, transactions):
+        new_dau = tvct.create_dau_df(transactions, **self.params)
+        return self.update_dau(new_dau)
+
+
+
+    ### Same as update, reading the new transactions from a CSV file or URL
+    def update_from_csv(self, filepath, chunksize = 1000000):
+        new_dau = tvct.create_dau_df_from_csv(filepath, chunksize = chunksize, **self.params)
+        return self.update_dau(new_dau)
+
+
+
+    ### Adds the DAU rows of the new transactions to the state and recomputes
+    ### the periods and windows they affect
+    def update_dau(self, new_dau):
+
+        state = self.state
+        if len(new_dau) == 0:
+            tvct.log_progress('No new transactions to process')
+            return
+
+        new_days = tvct.to_day_ordinals(new_dau['activity_date'])
+        d0 = int(new_days.min())
+
+        # The periods and windows to recompute start on d0, or on the day
+        # after the last saved day if the new data starts after a gap, since
+        # the windows ending on the days in between have not been computed
+        if state['last_day'] is not None:
+            d0 = min(d0, state['last_day'] + 1)
+
+        # The new data must not start before the data the tail was trimmed
+        # to, and the tail must still hold all the days that the recomputed
+        # periods and windows need
+        if state['dau_tail'] is not None:
+            tail_days = tvct.to_day_ordinals(state['dau_tail']['activity_date'])
+            tail_start = int(tail_days.min())
+            if tail_start > state['first_day'] and self.required_start_day(d0) < tail_start:
+                raise ValueError('The new transactions start on %s, but the saved history only goes back to %s. Rebuild the state from the full transaction history.'
+                                 % (tvct.day_ordinals_to_dates([d0])[0],
+                                    tvct.day_ordinals_to_dates([tail_start])[0]))
+
+        tvct.log_progress('Updating incremental state from %s' % tvct.day_ordinals_to_dates([d0])[0])
+
+        # Merge the new DAU rows into the tail. A user's activity on a day that
+        # is already in the tail is added to it.
+        groupby_cols = ['user_id', 'activity_date']
+        if self.use_segment:
+            groupby_cols += ['segment']
+        if state['dau_tail'] is None:
+            dau_tail = new_dau
+        else:
+            dau_tail = (pd.concat([state['dau_tail'], new_dau], ignore_index = True)
+                        .groupby(groupby_cols, as_index = False)
+                        .agg({'inc_amt' : 'sum'})
+                        )
+
+        # Update the first_dt table for the users in the new data only: their
+        # first activity date is the earlier of the one we had and the new one
+        if state['first_dt'] is None:
+            first_dt = tvct.create_first_dt_df(new_dau)
+        else:
+            new_user_ids = new_dau['user_id'].unique()
+            is_new_user = state['first_dt']['user_id'].isin(new_user_ids)
+            known_first_dts = (state['first_dt'].loc[is_new_user, ['user_id', 'first_dt']]
+                               .rename(columns = {'first_dt' : 'activity_date'}))
+            updated_first_dt = tvct.create_first_dt_df(pd.concat([known_first_dts,
+                                                                  new_dau[['user_id', 'activity_date']]],
+                                                                 ignore_index = True))
+            first_dt = pd.concat([state['first_dt'][~is_new_user], updated_first_dt],
+                                 ignore_index = True)
+
+        if state['first_day'] is None:
+            first_day = d0
+        else:
+            first_day = min(state['first_day'], d0)
+        last_day = int(tvct.to_day_ordinals(dau_tail['activity_date']).max())
+
+        dau_decorated = tvct.create_dau_decorated_df(dau_tail, first_dt)
+
+        for time_period in self.time_periods:
+            self.update_period_state(dau_decorated, time_period, d0)
+
+        for window in self.windows:
+            self.update_window_state(dau_decorated, window, d0, first_day)
+
+        # Trim the tail to the last history_days days, keeping at least the
+        # days a run whose new data starts on the last day would need
+        keep_from = min(last_day - self.history_days + 1, self.required_start_day(last_day))
+        tail_days = tvct.to_day_ordinals(dau_tail['activity_date'])
+
+        state['dau_tail'] = dau_tail[tail_days >= keep_from].reset_index(drop = True)
+        state['first_dt'] = first_dt
+        state['first_day'] = first_day
+        state['last_day'] = last_day
+        self.write_state()
+        tvct.log_progress('Incremental state updated through %s' % tvct.day_ordinals_to_dates([last_day])[0])
+
+
+
+    ### Recomputes the growth accounting and cohort sums of the periods from
+    ### d0's period onwards, from the xAU rows of the tail
+    def update_period_state(self, dau_decorated, time_period, d0):
+
+        state = self.state
+        grouping_col = tvct.get_time_period_dict(time_period)['grouping_col']
+        p0 = tvct.day_ordinals_to_periods([d0], time_period)[0]
+        p0_start = pd.Timestamp(tvct.day_ordinals_to_dates(tvct.period_ordinals_to_start_days([p0],
+                                                                                               time_period))[0])
+
+        xau_decorated = tvct.create_xau_decorated_df(dau_decorated, time_period, self.use_segment)
+        xau_periods = tvct.to_period_ordinals(xau_decorated[grouping_col], time_period)
+
+        # Growth accounting for a period looks at the users of the period
+        # before it as well. The figures are kept with every period, even the
+        # ones with only churned users, and the filters and presentation 
+        # options are applied by get_growth_accounting, so the rows come out
+        # as a full run gives them.
+        user_xga, rev_xga = tvct.calc_growth_accounting_base(xau_decorated[xau_periods >= p0 - 1].copy(),
+                                                             time_period,
+                                                             use_segment = self.use_segment,
+                                                             use_vectorized = True)
+
+        ga_dfs = []
+        for k, new_xga in enumerate([user_xga, rev_xga]):
+            new_xga = new_xga[tvct.to_period_ordinals(new_xga[grouping_col], time_period) >= p0]
+            if time_period in state['ga']:
+                old_xga = state['ga'][time_period][k]
+                old_xga = old_xga[tvct.to_period_ordinals(old_xga[grouping_col], time_period) < p0]
+                new_xga = pd.concat([old_xga, new_xga], ignore_index = True)
+            ga_dfs.append(new_xga.reset_index(drop = True))
+        state['ga'][time_period] = tuple(ga_dfs)
+
+        # The cohort sums of a period only depend on that period's users
+        cohort_base = tvct.calc_xau_cohort_base(xau_decorated[xau_periods >= p0],
+                                                time_period,
+                                                self.use_segment)
+        if time_period in state['cohort_base']:
+            old_base = state['cohort_base'][time_period]
+            old_base = old_base[old_base.index.get_level_values(grouping_col) < p0_start]
+            cohort_base = pd.concat([old_base, cohort_base]).sort_index()
+        state['cohort_base'][time_period] = cohort_base
+
+
+
+    ### Recomputes the rolling windows that end on or after d0, starting
+    ### with the first window that has window_days days of data before it
+    def update_window_state(self, dau_decorated, window, d0, first_day):
+
+        state = self.state
+        window_days = window['window_days']
+        window_key = (window['time_period'], window_days)
+        start_day = max(d0, first_day + window_days)
+        start_dt = tvct.day_ordinals_to_dates([start_day])[0]
+
+        new_windows = tvct.create_xau_window_df_incremental(dau_decorated,
+                                                            time_period = window['time_period'],
+                                                            window_days = window_days,
+                                                            breakouts = window.get('breakouts', [2, 4]),
+                                                            use_segment = self.use_segment,
+                                                            use_final_day = True,
+                                                            start_dt = start_dt)
+
+        if window_key in state['windows']:
+            old_windows = state['windows'][window_key]
+            old_windows = old_windows[old_windows['window_end_dt'] < pd.Timestamp(start_dt)]
+            new_windows = pd.concat([old_windows, new_windows])
+        state['windows'][window_key] = new_windows
+
+
+
+    ### Returns the growth accounting dataframe that consolidate_all_ga would
+    ### return for the whole transaction history
+    def get_growth_accounting(self,
+                              time_period,
+                              growth_rate_periods = 12,
+                              keep_last_period = True,
+                              date_limit = None,
+                              add_hours = False,
+                              use_standard_col_names = True):
+
+        user_xga, rev_xga = self.state['ga'][time_period]
+        user_ga, rev_ga = tvct.finish_growth_accounting_dfs(user_xga.copy(),
+                                                            rev_xga.copy(),
+                                                            time_period,
+                                                            keep_last_period,
+                                                            date_limit,
+                                                            add_hours,
+                                                            self.params['include_zero_inc'])
+
+        return tvct.consolidate_ga_with_ratios(user_ga, rev_ga, time_period,
+                                               self.use_segment, growth_rate_periods,
+                                               use_standard_col_names, 
+                                               use_vectorized = True)
+
+
+
+    ### Returns the cohort dataframe that create_xau_cohort_df would return
+    ### for the whole transaction history
+    def get_cohorts(self,
+                    time_period,
+                    recent_periods_back_to_exclude = 1,
+                    create_period_n_inc_cols = False,
+                    date_limit = None,
+                    add_hours = False,
+                    use_standard_col_names = False):
+
+        grouping_col = tvct.get_time_period_dict(time_period)['grouping_col']
+        cohort_base = self.state['cohort_base'][time_period]
+        if date_limit is not None:
+            cohort_base = cohort_base[cohort_base.index.get_level_values(grouping_col) <= date_limit]
+
+        return tvct.finish_xau_cohort_df(cohort_base.copy(),
+                                         time_period,
+                                         self.use_segment,
+                                         recent_periods_back_to_exclude,
+                                         create_period_n_inc_cols,
+                                         add_hours,
+                                         use_standard_col_names)
+
+
+
+    ### Returns the rolling window dataframe that create_xau_window_df would
+    ### return for the whole transaction history
+    def get_window_df(self, time_period = 'day', window_days = 28, use_final_day = True):
+
+        window_df = self.state['windows'][(time_period, window_days)]
+        if not use_final_day:
+            last_dt = pd.Timestamp(tvct.day_ordinals_to_dates([self.state['last_day']])[0])
+            window_df = window_df[window_df['window_end_dt'] < last_dt]
+
+        return window_df.copy()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+### Structured timing and memory measurements of the tvc_transform functions.
+### Inside a TVCInstrument block, every function of tvc_transform is
+### temporarily replaced by a wrapper that records, for each call:
+###   - the wall time and CPU time it took
+###   - the number of rows of the dataframes passed in and returned
+###   - the peak memory it allocated (with track_memory = True, using
+###     tracemalloc, which slows the functions down)
+###   - how deep in the calls to other tvc_transform functions it was made
+### The functions call each other through the module, so the functions
+### called inside other functions are measured too. Each record is logged to
+### the 'tvc_instrument' logger, passed to callback if one is given, and kept
+### in records, which summary() totals per function and write_chrome_trace()
+### writes as a trace that chrome://tracing or https://ui.perfetto.dev can
+### show as a timeline.
+###
+###   with tvci.TVCInstrument(track_memory = True) as instrument:
+###       mau_decorated = tvct.create_xau_decorated_df(dau_decorated, 'month')
+###       mau_ga = tvct.create_growth_accounting_dfs(mau_decorated, 'month')
+###   print(instrument.summary())
+###   instrument.write_chrome_trace('tvc_trace.json')
+###
+### Blocks of other code can be measured with instrument.span('name'), and
+### other functions with the instrument.wrap decorator. Calls made in the
+### worker processes of tvc_parallel are not measured, only the calls that
+### start them.
+
+import os
+import json
+import time
+import logging
+import threading
+import functools
+import tracemalloc
+import inspect
+import numpy as np
+import pandas as pd
+import tvc_transform as tvct
+
+logger = logging.getLogger('tvc_instrument')
+
+### Functions that are not wrapped by default: the helpers that are applied
+### to every user or row, which would be measured thousands of times per
+### call of the function applying them, and the small utility functions
+DEFAULT_EXCLUDE = ['get_time_period_dict',
+                   'log_progress',
+                   'memory_lean_mode',
+                   'copy_unless_cow',
+                   'calc_user_qr',
+                   'calc_rev_qr',
+                   'calc_user_ga',
+                   'calc_rev_ga',
+                   'assign_ga_date_range',
+                   'assign_user_status',
+                   'classify_users_and_revenue']
+
+
+### The number of rows of a dataframe, series or array, or the total rows of a
+### tuple or list of them (e.g. the user and revenue dataframes returned by
+### create_growth_accounting_dfs). None if there are no dataframes.
+def count_rows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        counts = [count_rows(v) for v in value]
+        counts = [c for c in counts if c is not None]
+        if counts:
+            return sum(counts)
+    return None
+
+
+
+class TVCInstrument:
+    def __init__(self,
+                 modules = [tvct],
+                 track_memory = False,
+                 callback = None,
+                 log_level = logging.INFO,
+                 exclude = DEFAULT_EXCLUDE):
+
+        self.modules = modules
+        self.track_memory = track_memory
+        self.callback = callback
+        self.log_level = log_level
+        self.exclude = set(exclude)
+        self.records = []
+        self.originals = []
+        self.local = threading.local()
+        self.started_tracemalloc = False
+        self.origin = time.perf_counter()
+
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+
+    ### Wraps the functions defined in each module (not the ones it imports)
+    ### and starts tracemalloc if memory is tracked and it is not already on
+    def start(self):
+
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+        for module in self.modules:
+            for name, function in list(vars(module).items()):
+                if (inspect.isfunction(function) and
+                    function.__module__ == module.__name__ and
+                    name not in self.exclude):
+                    self.originals.append((module, name, function))
+                    setattr(module, name, self.wrap(function))
+
+
+
+    ### Puts the original functions back
+    def stop(self):
+
+        for module, name, function in reversed(self.originals):
+            setattr(module, name, function)
+        self.originals = []
+
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+
+
+    ### Decorator that measures every call of function
+    def wrap(self, function, name = None):
+
+        name = name or function.__name__
+
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            input_rows = count_rows(list(args) + list(kwargs.values()))
+            with self.span(name, input_rows = input_rows) as span:
+                result = function(*args, **kwargs)
+                span['output_rows'] = count_rows(result)
+            return result
+
+        return instrumented
+
+
+
+    ### Context manager that measures the code inside it as one call of name.
+    ### It yields the record, so the code can fill in output_rows or other
+    ### values that are not known in advance.
+    def span(self, name, input_rows = None):
+        return TVCSpan(self, name, input_rows)
+
+
+
+    ### The open spans of the current thread, outermost first
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+
+
+    ### Called when a span ends, with its finished record
+    def report(self, record):
+
+        self.records.append(record)
+
+        if self.log_level is not None:
+            message = '%s%s: %.3f s wall, %.3f s CPU' % ('  ' * record['depth'],
+                                                        record['name'],
+                                                        record['wall_seconds'],
+                                                        record['cpu_seconds'])
+            if record['input_rows'] is not None or record['output_rows'] is not None:
+                message += ', %s -> %s rows' % (record['input_rows'], record['output_rows'])
+            if record['peak_memory_mb'] is not None:
+                message += ', %.1f MB peak' % record['peak_memory_mb']
+            logger.log(self.log_level, message)
+
+        if self.callback is not None:
+            self.callback(record)
+
+
+
+    ### The records as a dataframe, in the order the calls finished
+    def records_df(self):
+        return pd.DataFrame(self.records,
+                            columns = ['name', 'depth', 'parent', 'start_seconds',
+                                       'wall_seconds', 'cpu_seconds', 'input_rows',
+                                       'output_rows', 'peak_memory_mb', 'pid', 'tid'])
+
+
+
+    ### The number of calls, total wall and CPU time, and largest peak memory
+    ### of each function, slowest first. The time of a function includes the
+    ### time of the functions it calls.
+    def summary(self):
+
+        records = self.records_df()
+        summary = records.groupby('name').agg(calls = ('name', 'size'),
+                                              wall_seconds = ('wall_seconds', 'sum'),
+                                              cpu_seconds = ('cpu_seconds', 'sum'),
+                                              peak_memory_mb = ('peak_memory_mb', 'max'))
+
+        return summary.sort_values('wall_seconds', ascending = False)
+
+
+
+    ### The records in the Chrome Trace Event format, as complete ("X")
+    ### events with the times in microseconds
+    def chrome_trace(self):
+
+        events = []
+        for record in self.records:
+            args = {k : record[k] for k in ['input_rows', 'output_rows',
+                                            'cpu_seconds', 'peak_memory_mb']
+                    if record[k] is not None}
+            events.append({'name' : record['name'],
+                           'cat' : 'tvc',
+                           'ph' : 'X',
+                           'ts' : round(record['start_seconds'] * 1e6, 3),
+                           'dur' : round(record['wall_seconds'] * 1e6, 3),
+                           'pid' : record['pid'],
+                           'tid' : record['tid'],
+                           'args' : args})
+
+        return {'traceEvents' : sorted(events, key = lambda e: e['ts']),
+                'displayTimeUnit' : 'ms'}
+
+
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        tvct.log_progress('Wrote trace of %s calls to %s' % (len(self.records), path))
+
+
+
+### One measured call. tracemalloc has a single peak for the whole process,
+### so each span resets it when it starts, after passing the peak so far on
+### to the spans it is nested in, and passes its own peak on to its parent
+### when it ends. The peak is reported relative to the memory in use when
+### the span started.
+class TVCSpan:
+    def __init__(self, instrument, name, input_rows = None):
+        self.instrument = instrument
+        self.record = {'name' : name,
+                       'input_rows' : input_rows,
+                       'output_rows' : None}
+
+
+
+    def __enter__(self):
+
+        stack = self.instrument.stack()
+        self.record['depth'] = len(stack)
+        self.record['parent'] = stack[-1].record['name'] if stack else None
+
+        self.tracing = tracemalloc.is_tracing() and self.instrument.track_memory
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            for span in stack:
+                span.peak = max(span.peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+            self.peak = current
+
+        stack.append(self)
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+
+        return self.record
+
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        wall_seconds = time.perf_counter() - self.start_wall
+        cpu_seconds = time.process_time() - self.start_cpu
+
+        stack = self.instrument.stack()
+        stack.pop()
+
+        if self.tracing:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+            peak_memory_mb = (self.peak - self.start_memory) / 1e6
+        else:
+            peak_memory_mb = None
+
+        self.record.update({'start_seconds' : self.start_wall - self.instrument.origin,
+                            'wall_seconds' : wall_seconds,
+                            'cpu_seconds' : cpu_seconds,
+                            'peak_memory_mb' : peak_memory_mb,
+                            'pid' : os.getpid(),
+                            'tid' : threading.get_ident()})
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        self.instrument.report(self.record)
+
+        return False
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+### Loads the transformed dataframes into local files instead of Google
+### Sheets, for BI tools that read local files and for runs without a
+### network connection. Every sink has the same contract:
+###
+###   sink.write(dataframe, name)   # writes (or replaces) the output name
+###   sink.close()                  # finishes writing, e.g. waits for uploads
+###
+### and can be used as a context manager that closes it at the end. The
+### sinks are:
+###   - TVCParquetSink: one Parquet file per name, or with partition_cols a
+###     directory of Parquet files partitioned by those columns
+###   - TVCFeatherSink: one Arrow IPC (Feather) file per name
+###   - TVCSQLiteSink: one table per name in a SQLite database file
+###   - TVCDuckDBSink: one table per name in a DuckDB database file (needs
+###     the duckdb library)
+###   - TVCSheetsSink: one worksheet per name in a Google Sheets spreadsheet,
+###     uploaded in the background by a tvc_upload.TVCUploader
+### Parquet and Feather need the pyarrow library.
+###
+### A name is replaced all at once: files and directories are written under
+### a temporary name and then renamed, and tables are written as a temporary
+### table that replaces the old one in a single transaction, so a reader
+### never sees a half-written output. create_sink builds a sink from the
+### SINK and SINK_PATH settings of a config.ini section.
+
+import os
+import re
+import shutil
+import sqlite3
+import pandas as pd
+import tvc_transform as tvct
+
+SINK_TYPES = ['sheets', 'parquet', 'feather', 'sqlite', 'duckdb']
+
+### Where each type of sink writes when no path is given: a directory of
+### files for Parquet and Feather, a database file in it for SQLite and DuckDB
+DEFAULT_SINK_PATHS = {'parquet' : 'output',
+                      'feather' : 'output',
+                      'sqlite' : os.path.join('output', 'tvc.sqlite'),
+                      'duckdb' : os.path.join('output', 'tvc.duckdb')}
+
+
+### Output names are worksheet names like 'Channel Rolling DAU/MAU'. As
+### file names, everything but letters, digits, dashes and dots becomes '_'.
+def file_name(name):
+    return re.sub(r'[^A-Za-z0-9.\-]+', '_', name).strip('_')
+
+
+
+def quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+
+### Databases have no Period type, so Period columns are stored as their
+### string labels (e.g. '2023-06' or '2023-06-05/2023-06-11')
+def periods_to_str(dataframe):
+
+    period_cols = [c for c in dataframe.columns
+                   if isinstance(dataframe[c].dtype, pd.PeriodDtype)]
+    if len(period_cols) == 0:
+        return dataframe
+
+    return dataframe.assign(**{c : dataframe[c].astype('str') for c in period_cols})
+
+
+
+### Moves a file or directory written under tmp_path to path, replacing
+### whatever was there. A directory cannot be replaced in a single rename,
+### so the old one is moved aside first and deleted afterwards.
+def replace_path(tmp_path, path):
+
+    if os.path.isdir(path):
+        old_path = path + '.old'
+        shutil.rmtree(old_path, ignore_errors = True)
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors = True)
+    else:
+        os.replace(tmp_path, path)
+
+
+
+class TVCSink:
+    def write(self, dataframe, name):
+        raise NotImplementedError
+
+
+
+    def close(self):
+        pass
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+
+class TVCParquetSink(TVCSink):
+    def __init__(self, output_dir, partition_cols = None, compression = 'snappy'):
+        self.output_dir = output_dir
+        self.partition_cols = partition_cols
+        self.compression = compression
+        os.makedirs(output_dir, exist_ok = True)
+
+
+
+    def write(self, dataframe, name):
+
+        if self.partition_cols is None:
+            path = os.path.join(self.output_dir, file_name(name) + '.parquet')
+        else:
+            path = os.path.join(self.output_dir, file_name(name))
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors = True)
+
+        dataframe.to_parquet(tmp_path,
+                             index = False,
+                             compression = self.compression,
+                             partition_cols = self.partition_cols)
+        replace_path(tmp_path, path)
+        tvct.log_progress('Wrote %s rows to %s' % (len(dataframe), path))
+
+
+
+class TVCFeatherSink(TVCSink):
+    def __init__(self, output_dir, compression = 'lz4'):
+        self.output_dir = output_dir
+        self.compression = compression
+        os.makedirs(output_dir, exist_ok = True)
+
+
+
+    def write(self, dataframe, name):
+
+        path = os.path.join(self.output_dir, file_name(name) + '.feather')
+        tmp_path = path + '.tmp'
+
+        dataframe.reset_index(drop = True).to_feather(tmp_path, compression = self.compression)
+        replace_path(tmp_path, path)
+        tvct.log_progress('Wrote %s rows to %s' % (len(dataframe), path))
+
+
+
+class TVCSQLiteSink(TVCSink):
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if os.path.dirname(db_path) != '':
+            os.makedirs(os.path.dirname(db_path), exist_ok = True)
+        # Autocommit mode, so the transaction below is the only one
+        self.connection = sqlite3.connect(db_path, isolation_level = None)
+
+
+
+    def write(self, dataframe, name):
+
+        tmp_name = name + '.tmp'
+        periods_to_str(dataframe).to_sql(tmp_name, self.connection,
+                                         if_exists = 'replace', index = False)
+
+        self.connection.execute('BEGIN')
+        try:
+            self.connection.execute('DROP TABLE IF EXISTS %s' % quote_identifier(name))
+            self.connection.execute('ALTER TABLE %s RENAME TO %s' % (quote_identifier(tmp_name),
+                                                                   quote_identifier(name)))
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        tvct.log_progress('Wrote %s rows to table %s of %s' % (len(dataframe), name, self.db_path))
+
+
+
+    def close(self):
+        self.connection.close()
+
+
+
+class TVCDuckDBSink(TVCSink):
+    def __init__(self, db_path):
+        import duckdb
+        self.db_path = db_path
+        if os.path.dirname(db_path) != '':
+            os.makedirs(os.path.dirname(db_path), exist_ok = True)
+        self.connection = duckdb.connect(db_path)
+
+
+
+    def write(self, dataframe, name):
+
+        # CREATE OR REPLACE swaps in the new table in one transaction
+        self.connection.register('tvc_output', periods_to_str(dataframe))
+        try:
+            self.connection.execute('CREATE OR REPLACE TABLE %s AS SELECT * FROM tvc_output'
+                                    % quote_identifier(name))
+        finally:
+            self.connection.unregister('tvc_output')
+        tvct.log_progress('Wrote %s rows to table %s of %s' % (len(dataframe), name, self.db_path))
+
+
+
+    def close(self):
+        self.connection.close()
+
+
+
+### Writes each output to its own worksheet of one spreadsheet, through a
+### TVCUploader that uploads them in the background. close waits for the
+### uploads to finish.
+class TVCSheetsSink(TVCSink):
+    def __init__(self, tvcl, spreadsheet_key, **uploader_kwargs):
+        import tvc_upload as tvcup
+        self.spreadsheet_key = spreadsheet_key
+        self.uploader = tvcup.TVCUploader(tvcl, **uploader_kwargs)
+
+
+
+    def write(self, dataframe, name):
+        self.uploader.submit(dataframe, name, self.spreadsheet_key)
+
+
+
+    def close(self):
+        self.uploader.close()
+
+
+
+### Builds the sink of the given type. path is the output directory for
+### Parquet and Feather, and the database file for SQLite and DuckDB, with
+### the DEFAULT_SINK_PATHS if not given. The Sheets sink takes a TVCLoad and
+### a spreadsheet key instead.
+def create_sink(sink_type,
+                path = None,
+                tvcl = None,
+                spreadsheet_key = None,
+                **kwargs):
+
+    if path is None:
+        path = DEFAULT_SINK_PATHS.get(sink_type)
+
+    if sink_type == 'sheets':
+        return TVCSheetsSink(tvcl, spreadsheet_key, **kwargs)
+    elif sink_type == 'parquet':
+        return TVCParquetSink(path, **kwargs)
+    elif sink_type == 'feather':
+        return TVCFeatherSink(path, **kwargs)
+    elif sink_type == 'sqlite':
+        return TVCSQLiteSink(path, **kwargs)
+    elif sink_type == 'duckdb':
+        return TVCDuckDBSink(path, **kwargs)
+    else:
+        raise ValueError("Invalid sink_type specified. Use 'sheets', 'parquet', 'feather', 'sqlite' or 'duckdb'.")
@@ -1,51 +1,282 @@
 # -*- coding: utf-8 -*-
 
-import gspread
-from gspread_dataframe import set_with_dataframe
-# from oauth2client.service_account import ServiceAccountCredentials
-from google.oauth2 import service_account
+import os
+import json
+import hashlib
+import pandas as pd
+import tvc_transform as tvct
 
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets'] 
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
 class TVCLoad:
-    def __init__(self, credentials_file):
-        self.gc = self.init_gsheets_client(credentials_file, SCOPES)
+    ### Pass a client (for example a tvc_fake_gspread.FakeClient) to use it
+    ### instead of authorizing gspread with the credentials file. hash_file
+    ### is where the batched writer keeps the row block hashes of what it
+    ### uploaded last, so that it can skip unchanged rows on the next run.
+    def __init__(self, credentials_file, client = None, hash_file = None, block_rows = 500):
+        if client is None:
+            self.gc = self.init_gsheets_client(credentials_file, SCOPES)
+        else:
+            self.gc = client
+
+        self.hash_file = hash_file
+        self.block_rows = block_rows
+        self.spreadsheets = {}
+        self.worksheets = {}
+        self.queue = {}
+        self.block_hashes = self.read_block_hashes()
 
 
 
     def init_gsheets_client(self, credentials_file, scopes,  **kwargs):
-        # creds = ServiceAccountCredentials.from_json_keyfile_name(credentials_file, 
+        import gspread
+        # from oauth2client.service_account import ServiceAccountCredentials
+        from google.oauth2 import service_account
+
+        # creds = ServiceAccountCredentials.from_json_keyfile_name(credentials_file,
         #                                                          scopes)
         creds = service_account.Credentials.from_service_account_file(
            credentials_file, scopes=scopes
         )
         client = gspread.authorize(creds)
-        
+
         return client
 
-    
-    
+
+
     def write_to_google_sheet(self, dataframe, worksheet_name, spreadsheet_key):
-      
-      sh = self.gc.open_by_key(spreadsheet_key)
-      
-      ws = None
-      worksheet_list = sh.worksheets()
-      for worksheet in worksheet_list:
-        if worksheet.title == worksheet_name:
-          ws = worksheet
-      if ws is None:
-        ws = sh.add_worksheet(title = worksheet_name, rows="1", cols = "1")
-        
-      set_with_dataframe(ws, 
-                         dataframe, 
-                         row=1, 
+      from gspread_dataframe import set_with_dataframe
+
+      ws = self.get_worksheet(spreadsheet_key, worksheet_name)
+
+      set_with_dataframe(ws,
+                         dataframe,
+                         row=1,
                          col=1,
-                         include_index=False, 
-                         include_column_header=True, 
-                         resize=True, 
+                         include_index=False,
+                         include_column_header=True,
+                         resize=True,
                          allow_formulas=True
-                         )    
-    
+                         )
+
+      # The sheet no longer holds what the batched writer last uploaded
+      self.block_hashes.pop(self.hash_key(spreadsheet_key, worksheet_name), None)
+
+
+
+    ### Opens each spreadsheet, and lists its worksheets, only once. Neither
+    ### is kept unless both requests succeed, so a failed call can be retried.
+    def get_spreadsheet(self, spreadsheet_key):
+        if spreadsheet_key not in self.spreadsheets:
+            sh = self.gc.open_by_key(spreadsheet_key)
+            worksheets = {ws.title : ws for ws in sh.worksheets()}
+            self.spreadsheets[spreadsheet_key] = sh
+            self.worksheets[spreadsheet_key] = worksheets
+
+        return self.spreadsheets[spreadsheet_key]
+
+
+
+    ### Returns the cached worksheet handle, adding the worksheet if the
+    ### spreadsheet does not have it yet
+    def get_worksheet(self, spreadsheet_key, worksheet_name):
+        sh = self.get_spreadsheet(spreadsheet_key)
+        worksheets = self.worksheets[spreadsheet_key]
+        if worksheet_name not in worksheets:
+            worksheets[worksheet_name] = sh.add_worksheet(title = worksheet_name, rows = "1", cols = "1")
+
+        return worksheets[worksheet_name]
+
+
+
+    ### Adds a dataframe to the queue of worksheets to write. Nothing is sent
+    ### until flush is called. Queueing the same worksheet again replaces the
+    ### dataframe queued before.
+    def queue_dataframe(self, dataframe, worksheet_name, spreadsheet_key):
+        self.queue.setdefault(spreadsheet_key, {})[worksheet_name] = dataframe_to_values(dataframe)
+
+
+
+    ### Writes every queued dataframe, with one request per spreadsheet to
+    ### resize the worksheets whose size changed and as few value-update
+    ### requests as max_batch_cells allows. With only_changed = True, only the
+    ### blocks of block_rows rows whose hash differs from the last upload are
+    ### sent. Set it to False if the sheets may have been edited by hand.
+    ### A spreadsheet stays queued until all of its requests succeed, so if
+    ### flush fails it can be called again to retry.
+    def flush(self, only_changed = True, max_batch_cells = 200000):
+
+        for spreadsheet_key in list(self.queue):
+            queued = self.queue[spreadsheet_key]
+            sh = self.get_spreadsheet(spreadsheet_key)
+            resize_requests = []
+            value_ranges = []
+            new_hashes = {}
+
+            for worksheet_name, values in queued.items():
+                resize_request, worksheet_ranges, block_hashes = self.worksheet_updates(spreadsheet_key, 
+                                                                                        worksheet_name, 
+                                                                                        values, 
+                                                                                        only_changed)
+                if resize_request is not None:
+                    resize_requests.append(resize_request)
+                value_ranges += worksheet_ranges
+                new_hashes[self.hash_key(spreadsheet_key, worksheet_name)] = block_hashes
+
+            try:
+                if len(resize_requests) > 0:
+                    sh.batch_update({'requests' : resize_requests})
+
+                for batch in batch_value_ranges(value_ranges, max_batch_cells):
+                    sh.values_batch_update({'valueInputOption' : 'USER_ENTERED', 'data' : batch})
+            except Exception:
+                # The sheets may be partly written, so forget their hashes
+                # and write all of them next time
+                for key in new_hashes:
+                    self.block_hashes.pop(key, None)
+                self.write_block_hashes()
+                raise
+
+            self.block_hashes.update(new_hashes)
+            del self.queue[spreadsheet_key]
+            tvct.log_progress('Wrote %s worksheets, %s ranges to spreadsheet %s' % (len(queued), len(value_ranges), spreadsheet_key))
+
+        self.write_block_hashes()
+
+
+
+    ### What it takes to bring one worksheet up to date with values: the 
+    ### request to resize it if its size changed (or None), the value ranges
+    ### of the blocks that changed, and the block hashes of values. The
+    ### caller stores the block hashes in self.block_hashes once the requests
+    ### have succeeded.
+    def worksheet_updates(self, spreadsheet_key, worksheet_name, values, only_changed = True):
+
+        ws = self.get_worksheet(spreadsheet_key, worksheet_name)
+        key = self.hash_key(spreadsheet_key, worksheet_name)
+
+        # A worksheet has at least one column, so a dataframe with no 
+        # columns is written as one column of empty cells
+        if len(values[0]) == 0:
+            values = [[''] for row in values]
+        n_rows = len(values)
+        n_cols = len(values[0])
+
+        # The header row is its own block, followed by blocks of
+        # block_rows data rows
+        blocks = [(0, values[:1])]
+        for start in range(1, n_rows, self.block_rows):
+            blocks.append((start, values[start:start + self.block_rows]))
+        hashes = [hash_values(block) for start, block in blocks]
+
+        previous = self.block_hashes.get(key)
+        if not only_changed or previous is None or previous['cols'] != n_cols:
+            previous = {'rows' : None, 'cols' : None, 'hashes' : []}
+
+        resize_request = None
+        if previous['rows'] != n_rows or previous['cols'] != n_cols:
+            resize_request = {'updateSheetProperties' :
+                                 {'properties' : {'sheetId' : ws.id,
+                                                  'gridProperties' : {'rowCount' : n_rows,
+                                                                      'columnCount' : n_cols}},
+                                  'fields' : 'gridProperties(rowCount,columnCount)'}}
+
+        value_ranges = []
+        for k, (start, block) in enumerate(blocks):
+            if k < len(previous['hashes']) and previous['hashes'][k] == hashes[k]:
+                continue
+            value_ranges.append({'range' : a1_range(worksheet_name, start, len(block), n_cols),
+                                 'values' : block})
+
+        block_hashes = {'rows' : n_rows, 'cols' : n_cols, 'hashes' : hashes}
+
+        return resize_request, value_ranges, block_hashes
+
+
+
+    def hash_key(self, spreadsheet_key, worksheet_name):
+        return spreadsheet_key + '/' + worksheet_name
+
+
+
+    def read_block_hashes(self):
+        if self.hash_file is None or not os.path.exists(self.hash_file):
+            return {}
+        with open(self.hash_file) as f:
+            return json.load(f)
+
+
+
+    def write_block_hashes(self):
+        if self.hash_file is None:
+            return
+        tmp_path = self.hash_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.block_hashes, f)
+        os.replace(tmp_path, self.hash_file)
+
+
+
+### Converts a dataframe to a list of rows of cell strings, header first, in
+### the same way gspread_dataframe's set_with_dataframe does: missing values
+### are empty cells and floats are written with repr
+def dataframe_to_values(dataframe):
+
+    def cell_value(value):
+        if pd.isnull(value) is True:
+            return ''
+        if isinstance(value, float):
+            return repr(float(value))
+        return str(value)
+
+    values = [[cell_value(c) for c in dataframe.columns]]
+    rows = dataframe.astype(object).itertuples(index = False, name = None)
+    if len(dataframe.columns) == 0:
+        # itertuples gives no rows at all when there are no columns
+        rows = [()] * len(dataframe)
+    for row in rows:
+        values.append([cell_value(v) for v in row])
+
+    return values
+
+
+
+### Splits value ranges into batches of at most max_batch_cells cells, one 
+### per request (a single larger range still goes in a batch of its own)
+def batch_value_ranges(value_ranges, max_batch_cells):
+
+    batches = []
+    batch = []
+    batch_cells = 0
+    for value_range in value_ranges:
+        range_cells = len(value_range['values']) * len(value_range['values'][0])
+        if len(batch) > 0 and batch_cells + range_cells > max_batch_cells:
+            batches.append(batch)
+            batch = []
+            batch_cells = 0
+        batch.append(value_range)
+        batch_cells += range_cells
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+
+def hash_values(values):
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+
+### The A1 notation of a block of cells, starting at row start_row (counting
+### from zero) and column A
+def a1_range(worksheet_name, start_row, n_rows, n_cols):
+
+    col_letters = ''
+    col = n_cols
+    while col > 0:
+        col, remainder = divmod(col - 1, 26)
+        col_letters = chr(ord('A') + remainder) + col_letters
 
-    
+    return "'%s'!A%s:%s%s" % (worksheet_name.replace("'", "''"), start_row + 1,
+                              col_letters, start_row + n_rows)
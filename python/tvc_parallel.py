@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+### Runs the tvc_transform stages of a pipeline in parallel. Most stages only
+### depend on the DAU Decorated dataframe (or on a WAU/MAU Decorated
+### dataframe built from it), so they can run at the same time on different
+### cores. The stages are described as a small DAG:
+###
+###   stages = {'wau_decorated' : {'function' : 'create_xau_decorated_df',
+###                                'inputs' : ['dau_decorated'],
+###                                'kwargs' : {'time_period' : 'week', 'use_segment' : True}},
+###             'w_ga' : {'function' : 'consolidate_all_ga',
+###                       'inputs' : ['wau_decorated'],
+###                       'kwargs' : {'time_period' : 'week', 'use_segment' : True}}}
+###
+### 'function' is the name of a tvc_transform function (or any module-level
+### function), called with the input dataframes as its first arguments and
+### then the kwargs. run_stages runs every stage whose inputs are ready in a
+### ProcessPoolExecutor and yields (stage name, result) as each one finishes.
+###
+### Dataframes are not pickled to the workers. Each input dataframe, and each
+### stage result that another stage needs, is written once to an uncompressed
+### Feather file in share_dir, and the workers memory-map it. Such a result
+### is not pickled back to the caller either: run_stages memory-maps the 
+### same file. This needs the pyarrow library.
+###
+### The workers run with the same pandas Copy-on-Write setting as the caller,
+### so a pipeline run inside tvct.memory_lean_mode() runs lean in the workers
+### too.
+
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import tvc_transform as tvct
+
+
+### Writes a dataframe to a Feather file that workers can memory-map
+def share_df(dataframe, path):
+    dataframe.reset_index(drop = True).to_feather(path, compression = 'uncompressed')
+    return path
+
+
+
+### Reads a dataframe shared with share_df, memory-mapping the file
+def read_shared_df(path):
+    import pyarrow.feather as feather
+    return feather.read_feather(path, memory_map = True)
+
+
+
+### Runs one stage in a worker process. If output_path is set, the result is
+### shared for the stages that depend on this one, and only the path is 
+### returned, so the result is not pickled back to the parent as well.
+def run_stage(function, input_paths, kwargs, output_path = None, copy_on_write = False):
+
+    if isinstance(function, str):
+        function = getattr(tvct, function)
+
+    with pd.option_context('mode.copy_on_write', copy_on_write):
+        inputs = [read_shared_df(path) for path in input_paths]
+        result = function(*inputs, **kwargs)
+
+    if output_path is not None:
+        return share_df(result, output_path)
+
+    return result
+
+
+
+### Checks that every stage's inputs are either initial inputs or other
+### stages, and that the stages have no cycles
+def check_stages(stages, input_names):
+
+    for name, stage in stages.items():
+        for input_name in stage.get('inputs', []):
+            if input_name not in stages and input_name not in input_names:
+                raise ValueError("Stage '%s' has an unknown input '%s'." % (name, input_name))
+        if name in input_names:
+            raise ValueError("Stage '%s' has the same name as an input." % name)
+
+    done = set(input_names)
+    remaining = dict(stages)
+    while len(remaining) > 0:
+        ready = [name for name, stage in remaining.items()
+                 if all(i in done for i in stage.get('inputs', []))]
+        if len(ready) == 0:
+            raise ValueError('The stages %s depend on each other in a cycle.' % sorted(remaining))
+        for name in ready:
+            done.add(name)
+            del remaining[name]
+
+
+
+### Runs the stages, yielding (stage name, result) as each stage finishes.
+### inputs is a dict of the dataframes the stages start from, e.g.
+### {'dau_decorated' : dau_decorated}. max_workers defaults to the number of
+### cores. The shared files go in a temporary directory inside share_dir
+### (or the system temporary directory), which is removed at the end.
+def run_stages(stages, inputs, max_workers = None, share_dir = None):
+
+    check_stages(stages, set(inputs))
+
+    if share_dir is not None:
+        os.makedirs(share_dir, exist_ok = True)
+    tmp_dir = tempfile.mkdtemp(prefix = 'tvc_share_', dir = share_dir)
+
+    # The stages whose results other stages read
+    needed = set()
+    for stage in stages.values():
+        needed.update(stage.get('inputs', []))
+
+    try:
+        shared = {name : share_df(df, os.path.join(tmp_dir, name + '.feather'))
+                  for name, df in inputs.items() if name in needed}
+
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            waiting = dict(stages)
+            running = {}
+
+            while len(waiting) > 0 or len(running) > 0:
+
+                # Start every stage whose inputs are all shared
+                for name in [n for n, s in waiting.items()
+                             if all(i in shared for i in s.get('inputs', []))]:
+                    stage = waiting.pop(name)
+                    if name in needed:
+                        output_path = os.path.join(tmp_dir, name + '.feather')
+                    else:
+                        output_path = None
+                    tvct.log_progress('Starting stage %s' % name)
+                    future = executor.submit(run_stage,
+                                             stage['function'],
+                                             [shared[i] for i in stage.get('inputs', [])],
+                                             stage.get('kwargs', {}),
+                                             output_path,
+                                             pd.get_option('mode.copy_on_write'))
+                    running[future] = (name, output_path)
+
+                finished, not_finished = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    name, output_path = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        for f in running:
+                            f.cancel()
+                        raise
+                    if output_path is not None:
+                        shared[name] = output_path
+                        result = read_shared_df(output_path)
+                    tvct.log_progress('Finished stage %s' % name)
+                    yield name, result
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
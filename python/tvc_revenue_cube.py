@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+### Prefix sums of inc_amt, built once from the DAU Decorated dataframe, so
+### that the revenue of any window can be read as the difference of two
+### prefix values instead of rescanning the DAU rows. This makes it cheap to
+### try out different window sizes (7, 14, 28, 90 days...) interactively.
+###
+### The cube holds:
+###   - a dense segment x day array of cumulative inc_amt (a single 'All'
+###     segment without use_segment), with one column per day from the
+###     first activity_date to the last
+###   - optionally (include_users = True) a sparse user x day version in CSR
+###     form: the active days and cumulative inc_amt of every user (or user
+###     and segment pair) one after the other, with indptr marking where
+###     each user's row starts. The cumulative sums restart for each user.
+###
+### The differences of prefix sums can differ from summing the same rows
+### directly (as the groupby sums in tvc_transform do) in the last bits of
+### the floating point result.
+###
+###   tvcrc = TVCRevenueCube(dau_decorated, use_segment = True)
+###   for window_days in [7, 14, 28, 90]:
+###       rolling = tvcrc.rolling_segment_revenue(window_days)
+
+import numpy as np
+import pandas as pd
+import tvc_transform as tvct
+
+
+class TVCRevenueCube:
+    def __init__(self, dau_decorated_df, use_segment = False, include_users = False):
+        tvct.log_progress('Creating revenue cube')
+
+        self.use_segment = use_segment
+
+        day_ordinals = tvct.to_day_ordinals(dau_decorated_df['activity_date']).astype(np.int64)
+        if use_segment:
+            seg_codes, seg_labels = pd.factorize(dau_decorated_df['segment'], sort = True)
+        else:
+            seg_codes = np.zeros(len(dau_decorated_df), dtype = np.int64)
+            seg_labels = pd.Index(['All'])
+        self.segments = pd.Index(seg_labels, name = 'segment')
+
+        # Like groupby, rows with a missing segment are left out
+        keep = seg_codes >= 0
+        inc_amt = dau_decorated_df['inc_amt'].values.astype(np.float64)
+
+        if len(day_ordinals) > 0:
+            self.first_day = int(day_ordinals.min())
+            self.n_days = int(day_ordinals.max()) - self.first_day + 1
+        else:
+            self.first_day = 0
+            self.n_days = 0
+        days = day_ordinals - self.first_day
+        self.dates = pd.DatetimeIndex((self.first_day + np.arange(self.n_days)).astype('datetime64[D]'))
+
+        # The segment x day cube: the daily sums, then the prefix sums along
+        # the days, with a leading column of zeros so that the revenue of days
+        # a to b (both included) is cum[:, b + 1] - cum[:, a]
+        daily = np.zeros((len(self.segments), self.n_days), dtype = np.float64)
+        np.add.at(daily, (seg_codes[keep], days[keep]), inc_amt[keep])
+        self.segment_cum = np.zeros((len(self.segments), self.n_days + 1), dtype = np.float64)
+        np.cumsum(daily, axis = 1, out = self.segment_cum[:, 1:])
+
+        if include_users:
+            self.build_user_prefix_sums(dau_decorated_df, seg_codes, days, inc_amt, keep)
+        else:
+            self.user_days = None
+
+
+
+    ### The sparse user x day prefix sums. Each user's daily inc_amt is summed
+    ### over any rows of the same day, sorted by day, and accumulated.
+    def build_user_prefix_sums(self, dau_decorated_df, seg_codes, days, inc_amt, keep):
+
+        user_codes, user_labels = pd.factorize(dau_decorated_df['user_id'], sort = True)
+        keep = keep & (user_codes >= 0)
+        n_segs = len(self.segments)
+        user_seg = user_codes[keep].astype(np.int64) * n_segs + seg_codes[keep]
+        key_values, row_keys = np.unique(user_seg, return_inverse = True)
+
+        self.user_ids = np.asarray(user_labels)[key_values // n_segs]
+        self.user_segments = np.asarray(self.segments, dtype = object)[key_values % n_segs]
+        n_keys = len(key_values)
+
+        key_days, key_day_idx = np.unique(row_keys.astype(np.int64) * max(self.n_days, 1) + days[keep],
+                                          return_inverse = True)
+        daily = np.bincount(key_day_idx, weights = inc_amt[keep], minlength = len(key_days))
+
+        self.user_key_days = key_days
+        self.user_days = (key_days % max(self.n_days, 1)).astype(np.int32)
+        self.user_indptr = np.searchsorted(key_days // max(self.n_days, 1), np.arange(n_keys + 1))
+
+        # Cumulative sums that restart at the start of each user's row. Each
+        # user's prefix before its first day is zero.
+        cum = np.cumsum(daily)
+        row_start_cum = np.concatenate([[0.0], cum])[self.user_indptr[:-1]]
+        self.user_cum = cum - np.repeat(row_start_cum, np.diff(self.user_indptr))
+        self.user_cum_before = np.concatenate([[0.0], self.user_cum])
+
+
+
+    ### Converts a date to the day number used by the cube (days since the
+    ### first activity_date)
+    def day_number(self, date):
+        return int(tvct.to_day_ordinals([date])[0]) - self.first_day
+
+
+
+    ### The prefix sums of every segment up to (but not including) day
+    ### numbers days, clipped to the days in the cube
+    def segment_prefix(self, days):
+        return self.segment_cum[:, np.clip(days, 0, self.n_days)]
+
+
+
+    ### The revenue of every segment from start_date to end_date, both
+    ### included
+    def segment_revenue(self, start_date, end_date):
+
+        start_day = self.day_number(start_date)
+        end_day = self.day_number(end_date)
+        revenue = self.segment_prefix(end_day + 1) - self.segment_prefix(start_day)
+
+        return pd.Series(revenue, index = self.segments, name = 'inc_amt')
+
+
+
+    ### The revenue of every segment in the window of window_days days ending
+    ### on each day, as a dataframe with one row per window end date and one
+    ### column per segment. The windows that start before the first day are
+    ### left out unless include_partial is True.
+    def rolling_segment_revenue(self, window_days, include_partial = False):
+
+        end_days = np.arange(self.n_days)
+        if not include_partial:
+            end_days = end_days[end_days >= window_days - 1]
+        revenue = (self.segment_prefix(end_days + 1) -
+                   self.segment_prefix(end_days - window_days + 1))
+
+        return pd.DataFrame(revenue.T,
+                            index = pd.Index(self.dates[end_days], name = 'window_end_dt'),
+                            columns = self.segments)
+
+
+
+    ### The revenue of every segment in each week or month, read from the
+    ### prefix sums at the period boundaries
+    def period_segment_revenue(self, time_period):
+
+        first_period, last_period = tvct.day_ordinals_to_periods([self.first_day,
+                                                                   self.first_day + self.n_days - 1],
+                                                                  time_period)
+        periods = np.arange(first_period, last_period + 2)
+        boundaries = tvct.period_ordinals_to_start_days(periods, time_period).astype(np.int64) - self.first_day
+        prefix = self.segment_prefix(boundaries)
+        grouping_col = tvct.get_time_period_dict(time_period)['grouping_col']
+
+        return pd.DataFrame((prefix[:, 1:] - prefix[:, :-1]).T,
+                            index = pd.Index(tvct.ordinals_to_periods(periods[:-1], time_period),
+                                             name = grouping_col),
+                            columns = self.segments)
+
+
+
+    ### The revenue of every user (and segment) from start_date to end_date,
+    ### both included. Needs include_users = True.
+    def user_revenue(self, start_date, end_date):
+
+        if self.user_days is None:
+            raise ValueError('The revenue cube was built without include_users = True.')
+
+        start_day = max(self.day_number(start_date), 0)
+        end_day = min(self.day_number(end_date), self.n_days - 1)
+        row_days = np.arange(len(self.user_indptr) - 1, dtype = np.int64) * max(self.n_days, 1)
+
+        # The position of each user's last day before the window and last day
+        # in the window. user_cum_before is shifted by one, so a user with no
+        # days before the window reads a prefix of zero.
+        lo = np.searchsorted(self.user_key_days, row_days + start_day, side = 'left')
+        hi = np.searchsorted(self.user_key_days, row_days + end_day, side = 'right')
+        before = np.where(lo > self.user_indptr[:-1], self.user_cum_before[lo], 0.0)
+        through = np.where(hi > self.user_indptr[:-1], self.user_cum_before[hi], 0.0)
+
+        revenue = pd.DataFrame({'user_id' : self.user_ids,
+                                'segment' : self.user_segments,
+                                'inc_amt' : through - before})
+        if start_day > end_day:
+            revenue['inc_amt'] = 0.0
+
+        return revenue
@@ -11,6 +11,10 @@ from datetime import timedelta
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import math
+import os
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 ### For discrete time period calculations, this helps set the variable names
 ### in the different dataframes 
@@ -53,6 +57,42 @@ def get_time_period_dict(time_period):
     return time_fields
 
 
+### Progress messages go to the 'tvc_transform' logger: what each function is
+### creating at INFO, and the per-window messages of the rolling window loops
+### at DEBUG. Until logging is set up (e.g. with logging.basicConfig), the
+### INFO messages are printed instead, as they always were, so notebooks 
+### still show them. See tvc_instrument for timings of each function.
+logger = logging.getLogger('tvc_transform')
+
+def log_progress(message, level = logging.INFO):
+    if logger.hasHandlers():
+        logger.log(level, message)
+    elif level >= logging.INFO:
+        print(message)
+
+
+### Memory-lean mode. With pandas' Copy-on-Write mode on, column subsets, 
+### filters and renames share their data with the dataframe they came from
+### until one of them is modified, so the defensive copies the functions 
+### below take of their inputs are not needed and are skipped. Run a 
+### pipeline inside memory_lean_mode(), or turn Copy-on-Write on for the 
+### whole session with pd.set_option('mode.copy_on_write', True). In either
+### mode the functions never modify the dataframes passed in.
+@contextmanager
+def memory_lean_mode():
+    with pd.option_context('mode.copy_on_write', True):
+        yield
+
+
+
+### Returns df itself under Copy-on-Write, where whichever of the two is 
+### modified first gets copied then, or a copy of df otherwise
+def copy_unless_cow(df):
+    if pd.get_option('mode.copy_on_write'):
+        return df
+    return df.copy()
+
+
 def date_difference(start, end, timeframe):
     """Ensure both start and end are converted to Timestamp if they are Periods."""
     start = pd.to_datetime(start) if isinstance(start, pd.Period) else start
@@ -71,6 +111,128 @@ def date_difference(start, end, timeframe):
         raise ValueError("Invalid timeframe specified. Use 'day', 'week', 'month', or 'year'.")
 
 
+### Days, weeks and months are handled internally as integer ordinals rather
+### than datetime.date objects, Timestamps or Periods. A day is its number of
+### days since 1970-01-01. A week or month is the ordinal pandas itself uses
+### for a 'W' (Monday to Sunday) or 'M' Period, which is the number of weeks
+### or months since the one containing 1970-01-01 (for months, that is
+### (year - 1970) * 12 + month - 1). "Next period" is then ordinal + 1 and
+### "periods since first" is a subtraction. The helpers below convert into
+### and out of ordinals, and the labels are only converted back to dates or
+### Periods when a function returns its dataframe.
+
+### Converts a column of dates (datetime.date objects, strings, Timestamps or
+### Periods) to int32 day ordinals. Object columns are converted one distinct
+### value at a time, since a DAU dataframe repeats each date many times.
+def to_day_ordinals(dates):
+    
+    dates = pd.Series(dates)
+    
+    if isinstance(dates.dtype, pd.PeriodDtype):
+        day_ordinals = pd.PeriodIndex(dates).asfreq('D', how = 'start').asi8
+    elif pd.api.types.is_datetime64_any_dtype(dates.dtype):
+        day_ordinals = dates.values.astype('datetime64[D]').astype(np.int64)
+    else:
+        codes, uniques = pd.factorize(dates)
+        if (codes < 0).any():
+            raise ValueError("Missing dates cannot be converted to day ordinals.")
+        unique_ordinals = pd.to_datetime(uniques).values.astype('datetime64[D]').astype(np.int64)
+        day_ordinals = unique_ordinals[codes]
+    
+    return day_ordinals.astype(np.int32)
+
+
+
+### Converts day ordinals to the ordinals of the days, weeks or months that 
+### contain them
+def day_ordinals_to_periods(day_ordinals, time_period):
+    
+    day_ordinals = np.asarray(day_ordinals, dtype = np.int64)
+    
+    if time_period == 'week':
+        # 1970-01-01 is a Thursday, so week 0 (the week ending on Sunday 
+        # 1970-01-04) starts on day -10 + 7 = -3
+        period_ordinals = (day_ordinals + 10) // 7
+    elif time_period == 'month':
+        period_ordinals = day_ordinals.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    else:
+        period_ordinals = day_ordinals
+    
+    return period_ordinals.astype(np.int32)
+
+
+
+### Converts day, week or month ordinals to the day ordinal of the first day 
+### of each period
+def period_ordinals_to_start_days(period_ordinals, time_period):
+    
+    period_ordinals = np.asarray(period_ordinals, dtype = np.int64)
+    
+    if time_period == 'week':
+        start_days = period_ordinals * 7 - 10
+    elif time_period == 'month':
+        start_days = period_ordinals.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    else:
+        start_days = period_ordinals
+    
+    return start_days.astype(np.int32)
+
+
+
+### Converts a column of Periods, or of dates, to the ordinals of the periods
+### of type time_period
+def to_period_ordinals(values, time_period):
+    
+    values = pd.Series(values)
+    
+    if isinstance(values.dtype, pd.PeriodDtype):
+        period_abbr = get_time_period_dict(time_period)['period_abbr']
+        period_ordinals = pd.PeriodIndex(values, freq = period_abbr).asi8.astype(np.int32)
+    else:
+        period_ordinals = day_ordinals_to_periods(to_day_ordinals(values), time_period)
+    
+    return period_ordinals
+
+
+
+### Output boundary: converts ordinals back to Periods of type time_period
+def ordinals_to_periods(period_ordinals, time_period):
+    
+    period_abbr = get_time_period_dict(time_period)['period_abbr']
+    
+    return pd.arrays.PeriodArray(np.asarray(period_ordinals, dtype = np.int64), 
+                                 dtype = pd.PeriodDtype(period_abbr))
+
+
+
+### Output boundary: converts day ordinals back to datetime.date objects
+def day_ordinals_to_dates(day_ordinals):
+    
+    return np.asarray(day_ordinals, dtype = np.int64).astype('datetime64[D]').astype(object)
+
+
+
+### Input boundary: converts a column of date strings (or Timestamps) to 
+### datetime.date objects, as pd.to_datetime(values, format = date_format)
+### .dt.date does, but parsing each distinct value only once. Transaction 
+### logs repeat the same dates (or timestamps) many times, so this is much 
+### faster. With a known date_format, e.g. '%Y-%m-%d %H:%M:%S.%f UTC', 
+### pandas does not have to infer the format of the values either. Missing
+### values become NaT.
+def parse_activity_dates(values, date_format = None):
+    
+    values = pd.Series(values)
+    
+    codes, uniques = pd.factorize(values)
+    unique_dates = pd.DatetimeIndex(pd.to_datetime(uniques, format = date_format)).date
+    
+    # The code of a missing value is -1, which picks the NaT on the end
+    dates = np.append(unique_dates, pd.NaT)[codes]
+    
+    return pd.Series(dates, index = values.index, name = values.name)
+
+
+
 # The create_dau_df function takes as inputs a dataframe of transactions and 
 # the names of the three key event log columns: User ID, Activity Date, and 
 # Income Amount (could be revenue or contribution margin). It can handle a 
@@ -84,42 +246,58 @@ def create_dau_df(transactions,
                   activity_date = 'activity_date', 
                   inc_amt = 'inc_amt', 
                   segment_col = None,
-                  include_zero_inc = False):
+                  include_zero_inc = False,
+                  compact_dtypes = False,
+                  date_format = None):
     
     # Ensure correct data types
     # If the activity_date is in date-time format, it gets rolled up into the
-    # day on which that event occurred. 
-    transactions[activity_date] = pd.to_datetime(transactions[activity_date]).dt.date
-    transactions[user_id] = transactions[user_id].astype('str')
+    # day on which that event occurred. date_format is the format of the 
+    # activity_date strings, if known. The typed columns go in a new 
+    # dataframe of just the columns needed, so the caller's transactions 
+    # are left as they are.
+    trans_df = pd.DataFrame({user_id : transactions[user_id].astype('str'),
+                             activity_date : parse_activity_dates(transactions[activity_date], date_format)},
+                            index = transactions.index)
     
     # If there is no inc_amt available in the data set, add a column of ones
     # Set the value of the inc_amt variable to 'inc_amt'
     if inc_amt is None:
-        transactions['inc_amt'] = 1
         inc_amt = 'inc_amt'
-    
-    # By default, this function only allows transactions where the inc_amt > 0
-    # This means it excludes things with negative amounts, like returns, for
-    # example. The include_zero_inc allows us to include those transactions
-    # if we see fit
-    if include_zero_inc:
-        trans_df = transactions
+        trans_df[inc_amt] = 1
     else:
-        trans_df = transactions.loc[transactions[inc_amt] > 0]
+        trans_df[inc_amt] = transactions[inc_amt]
         
     # By default we group by user_id and activity_date. If a segment column is
     # specified when the function is called, we include that column's name in
-    # the groupby as well. We also make sure that the segment is a string type
+    # the groupby as well. We also make sure that the segment is a string 
+    # type. Missing segments stay missing, and the groupby drops their rows.
     groupby_cols = [user_id, activity_date]
-    if segment_col is not None:
+    if isinstance(segment_col, list):
+        # A list of segment columns keeps all of them, under their own names,
+        # for create_multi_segment_dau_decorated_df. Their rows with missing
+        # segments are kept here, so that the unsegmented DAU still counts
+        # them; each segmentation drops its own missing segments when the
+        # DAU rows are stacked.
+        groupby_cols += segment_col
+    elif segment_col is not None:
         groupby_cols += [segment_col]
-        transactions[segment_col] = transactions[segment_col].astype('str')
+    for c in groupby_cols[2:]:
+        trans_df[c] = transactions[c].astype('str').where(transactions[c].notna())
+    
+    # By default, this function only allows transactions where the inc_amt > 0
+    # This means it excludes things with negative amounts, like returns, for
+    # example. The include_zero_inc allows us to include those transactions
+    # if we see fit
+    if not include_zero_inc:
+        trans_df = trans_df.loc[trans_df[inc_amt] > 0]
     
     
     # Group by user_id and activity_date, calculate the sum of the inc_amt
     # and return standardized names for each column
     dau = (trans_df
-           .groupby(groupby_cols, as_index = False)
+           .groupby(groupby_cols, as_index = False, observed = True,
+                    dropna = not isinstance(segment_col, list))
            .agg({inc_amt : 'sum'})
            .rename(columns = {user_id : 'user_id', 
                               activity_date : 'activity_date', 
@@ -127,39 +305,221 @@ def create_dau_df(transactions,
                         )
 
     # If we are using a segment column, it gets its own standardized name 'segment'
-    if segment_col is not None:
+    if segment_col is not None and not isinstance(segment_col, list):
         dau = dau.rename(columns = {segment_col : 'segment'})
+    
+    # With compact_dtypes, return the DAU dataframe with user_id codes and
+    # categorical segments, and the lookup table of the original user IDs
+    if compact_dtypes:
+        return compact_dau_df(dau)
+        
+    return dau
+
+
+
+
+# The create_dau_df_from_csv function produces the same DAU dataframe as
+# create_dau_df, but reads the transactions straight from a CSV file (or URL)
+# in chunks of chunksize rows instead of needing the whole transaction log in
+# memory. Only the user_id, activity_date, inc_amt and segment columns are 
+# read, with explicit types. Each chunk goes through create_dau_df to get its
+# own partial DAU sums. Those are collected and summed into the running DAU
+# dataframe whenever they have as many rows as it does, so each row is only
+# summed again a few times, and memory is bounded by about twice the number 
+# of distinct User ID / Activity Date (/ Segment) combinations rather than 
+# the number of transactions.
+
+def create_dau_df_from_csv(filepath, 
+                           user_id = 'user_id', 
+                           activity_date = 'activity_date', 
+                           inc_amt = 'inc_amt', 
+                           segment_col = None,
+                           include_zero_inc = False,
+                           chunksize = 1000000,
+                           compact_dtypes = False,
+                           date_format = None):
+    
+    # Read only the columns we need, with user_id and segment as strings and
+    # inc_amt as a float
+    usecols = [user_id, activity_date]
+    dtypes = {user_id : 'str'}
+    if inc_amt is not None:
+        usecols += [inc_amt]
+        dtypes[inc_amt] = 'float64'
+    if isinstance(segment_col, list):
+        segment_cols = segment_col
+    elif segment_col is not None:
+        segment_cols = [segment_col]
+    else:
+        segment_cols = []
+    usecols += segment_cols
+    dtypes.update({c : 'str' for c in segment_cols})
+    
+    groupby_cols = ['user_id', 'activity_date']
+    if isinstance(segment_col, list):
+        groupby_cols += segment_col
+    elif segment_col is not None:
+        groupby_cols += ['segment']
+    dropna = not isinstance(segment_col, list)
+    
+    # With compact_dtypes, each chunk's user IDs are swapped for codes as 
+    # soon as the chunk is aggregated, so the running DAU dataframe never 
+    # holds the ID strings. Codes are handed out in the order the IDs are 
+    # first seen and renumbered in sorted order at the end.
+    dau = None
+    dau_parts = []
+    n_part_rows = 0
+    user_id_lookup = pd.Index([], dtype = 'object')
+    for chunk in pd.read_csv(filepath, usecols = usecols, dtype = dtypes, 
+                             chunksize = chunksize):
+        
+        # Aggregate the chunk to its own DAU rows
+        chunk_dau = create_dau_df(chunk, 
+                                  user_id = user_id, 
+                                  activity_date = activity_date, 
+                                  inc_amt = inc_amt, 
+                                  segment_col = segment_col,
+                                  include_zero_inc = include_zero_inc,
+                                  date_format = date_format)
+        
+        if compact_dtypes:
+            new_ids = pd.Index(chunk_dau['user_id'].unique()).difference(user_id_lookup, sort = False)
+            user_id_lookup = user_id_lookup.append(new_ids)
+            chunk_dau['user_id'] = user_id_lookup.get_indexer(chunk_dau['user_id']).astype(np.int32)
+            for c in groupby_cols[2:]:
+                chunk_dau[c] = chunk_dau[c].astype('category')
         
+        # Merge the chunks' partial sums into the running DAU dataframe once
+        # they have as many rows as it does. A user's activity on one day 
+        # can be split across chunks, so the combined rows are summed again.
+        dau_parts.append(chunk_dau)
+        n_part_rows += len(chunk_dau)
+        if dau is None or n_part_rows >= len(dau):
+            dau = sum_dau_parts([dau] + dau_parts if dau is not None else dau_parts, 
+                                groupby_cols, compact_dtypes, dropna)
+            dau_parts = []
+            n_part_rows = 0
+    
+    if len(dau_parts) > 0:
+        dau = sum_dau_parts([dau] + dau_parts, groupby_cols, compact_dtypes, dropna)
+    
+    if compact_dtypes:
+        # Renumber the codes in the sorted order of the user IDs, and sort
+        # the rows as create_dau_df's groupby would have
+        order = np.argsort(user_id_lookup.values)
+        new_codes = np.empty(len(order), dtype = np.int32)
+        new_codes[order] = np.arange(len(order), dtype = np.int32)
+        dau['user_id'] = new_codes[dau['user_id'].values]
+        dau = dau.sort_values(groupby_cols, kind = 'stable').reset_index(drop = True)
+        return dau, user_id_lookup.values[order]
+    
     return dau
 
 
 
+### Sums the partial DAU dataframes of create_dau_df_from_csv into one. 
+### Rows with missing segments are dropped, unless dropna is False (for a 
+### list of segment columns, as in create_dau_df).
+def sum_dau_parts(dau_parts, groupby_cols, compact_dtypes = False, dropna = True):
+    
+    if len(dau_parts) == 1:
+        return dau_parts[0]
+    
+    if compact_dtypes:
+        unify_categories(dau_parts, groupby_cols[2:])
+    
+    return (pd.concat(dau_parts, ignore_index = True)
+            .groupby(groupby_cols, as_index = False, observed = True,
+                     dropna = dropna)
+            .agg({'inc_amt' : 'sum'})
+            )
+
+
+
+
+# Compact dtypes. User IDs are often long strings (hashes, emails...), and 
+# the object columns holding them are both the biggest part of a DAU 
+# dataframe's memory and the slowest thing to group and merge on. The 
+# compact_dau_df function swaps the user_id column for int32 codes, numbered
+# in the sorted order of the original IDs so that every result comes out in
+# the same order as with the strings, and stores the segment column(s) as 
+# pandas Categoricals. It returns the compact DAU dataframe and the 
+# user_id_lookup array, in which the original ID of code c is 
+# user_id_lookup[c]. The functions below keep these dtypes as they are, and 
+# decode_user_ids turns the codes back into IDs in any output that has a 
+# user_id column.
+
+def compact_dau_df(dau_df):
+    log_progress('Compacting DAU dataframe')
+    
+    codes, user_id_lookup = pd.factorize(dau_df['user_id'], sort = True)
+    
+    compact_dau = dau_df.assign(user_id = codes.astype(np.int32))
+    for c in compact_dau.columns:
+        if c not in ['user_id', 'activity_date', 'inc_amt']:
+            compact_dau[c] = compact_dau[c].astype('category')
+    
+    return compact_dau, np.asarray(user_id_lookup, dtype = 'object')
+
+
+
+### Returns a copy of df with the user_id codes replaced by the original IDs
+### and any categorical segment columns turned back into strings
+def decode_user_ids(df, user_id_lookup, user_id_col = 'user_id'):
+    
+    decoded = df.copy()
+    if user_id_col in decoded.columns:
+        decoded[user_id_col] = user_id_lookup[decoded[user_id_col].values]
+    for c in decoded.columns:
+        if isinstance(decoded[c].dtype, pd.CategoricalDtype):
+            decoded[c] = decoded[c].astype('str')
+    
+    return decoded
+
+
+
+### Sets the categories of the categorical column(s) cols of every dataframe
+### in dfs to the sorted union of their categories, so that concatenating
+### them keeps the columns categorical instead of falling back to objects
+def unify_categories(dfs, cols):
+    
+    for c in cols:
+        categories = dfs[0][c].cat.categories
+        for df in dfs[1:]:
+            categories = categories.union(df[c].cat.categories)
+        for df in dfs:
+            df[c] = df[c].cat.set_categories(categories)
+
+
+
 
 # The create_first_dt_df function takes as its input the DAU dataframe created
-# above. After creating a copy of the original DAU dataframe so as not to 
-# affect the original, it creates a new first_dt dataframe. Using the groupby
-# and agg functions, it finds the minimum Activity Date for each User ID. Then 
-# it specifies the week ('first_week') and month ('first_month') in which the 
-# first Activity Date is found. 
+# above. It creates a new first_dt dataframe from just the user_id and 
+# activity_date columns, so the original DAU dataframe is not affected. Using 
+# the groupby and agg functions, it finds the minimum Activity Date for each 
+# User ID. Then it specifies the week ('first_week') and month ('first_month') 
+# in which the first Activity Date is found. 
 
 def create_first_dt_df(dau_df):
-    print('Creating first_dt dataframe')
+    log_progress('Creating first_dt dataframe')
     
-    # Create copy of input dataframe
-    dau = dau_df.copy()
+    # Take the user_id and the activity_date as an integer day ordinal, which
+    # is much cheaper to group than date objects
+    dau = pd.DataFrame({'user_id' : dau_df['user_id'].values,
+                        'first_dt' : to_day_ordinals(dau_df['activity_date'])})
     
     # Use groupby to find the minimum activity_date for each user_id
     first_dt = (dau.groupby(['user_id'], as_index = False)
-                .agg({'activity_date' : 'min'})
-                .rename(columns = { 'activity_date' : 'first_dt' })
+                .agg({'first_dt' : 'min'})
                )
     
-    # Ensure that the first_dt field is a date
-    first_dt['first_dt'] = pd.to_datetime(first_dt['first_dt']).dt.date
-    
     # Add two new columns with the first_week and first_month of the first_dt
-    first_dt['first_week'] = pd.to_datetime(first_dt['first_dt']).dt.to_period('W')
-    first_dt['first_month'] = pd.to_datetime(first_dt['first_dt']).dt.to_period('M')
+    first_days = first_dt['first_dt'].values
+    first_dt['first_week'] = ordinals_to_periods(day_ordinals_to_periods(first_days, 'week'), 'week')
+    first_dt['first_month'] = ordinals_to_periods(day_ordinals_to_periods(first_days, 'month'), 'month')
+    
+    # Ensure that the first_dt field is a date
+    first_dt['first_dt'] = day_ordinals_to_dates(first_days)
     
     return first_dt
 
@@ -173,7 +533,7 @@ def create_first_dt_df(dau_df):
 # create_first_dt_df so it has something to merge to the DAU dataframe.
 
 def create_dau_decorated_df(dau_df, first_dt_df = None):
-    print('Creating DAU Decorated dataframe')
+    log_progress('Creating DAU Decorated dataframe')
     
     # If no first_dt_df is provided, create it
     if first_dt_df is None:
@@ -182,8 +542,10 @@ def create_dau_decorated_df(dau_df, first_dt_df = None):
     # Do a left merge of first_dt_df into dau_df on User ID
     dau_decorated_df = dau_df.merge(first_dt_df, how = 'left', on = 'user_id')
 
-    # If segment is included in this dataframe, ensure that it is a string type
-    if 'segment' in dau_decorated_df.columns:
+    # If segment is included in this dataframe, ensure that it is a string 
+    # type, unless it is a compact categorical segment
+    if ('segment' in dau_decorated_df.columns and 
+        not isinstance(dau_decorated_df['segment'].dtype, pd.CategoricalDtype)):
         dau_decorated_df['segment'] = dau_decorated_df['segment'].astype('str')
     
     return dau_decorated_df
@@ -193,30 +555,15 @@ def create_dau_decorated_df(dau_df, first_dt_df = None):
 
 
 ### This is another helper function that allows us to determine the next week
-### or month for any given week of month. We need these because the Pandas
-### date math is not consistent. You can use timedelta to add weeks, but you 
-### have to use DateOffset to add months.
+### or month for any given week of month. Rather than doing date math on the
+### start of each period (which needs timedelta to add weeks but DateOffset 
+### to add months), it adds one to the period ordinals.
 def increment_period(xau_grouping_col, time_period):
-  
-    # Call the get_time_period_dict function above, passing in the time period
-    time_fields = get_time_period_dict(time_period)
     
-    # Set the one-letter period abbreviation to whatever that function returns
-    period_abbr = time_fields['period_abbr']
-    
-    # Depending on the time period, increment the week or month by one after
-    # first converting it to the date time of the start of the period
-    if time_period == 'week':
-        start_of_next_period = pd.to_datetime(pd.PeriodIndex(xau_grouping_col).start_time + timedelta(weeks = 1))
-    elif time_period == 'month':
-        start_of_next_period = pd.to_datetime(pd.PeriodIndex(xau_grouping_col, freq = period_abbr).start_time) + pd.DateOffset(months = 1)
-    else:
-        start_of_next_period = None
-        
-    # Convert the date time from the previous step back into the appropriate 
-    # period (week or month) 
-    if start_of_next_period is not None:
-        next_period = pd.Series(start_of_next_period).dt.to_period(period_abbr)
+    # Depending on the time period, increment the week or month by one
+    if time_period in ['week', 'month']:
+        period_ordinals = to_period_ordinals(xau_grouping_col, time_period)
+        next_period = pd.Series(ordinals_to_periods(period_ordinals + 1, time_period))
     else:
         next_period = None
     
@@ -240,7 +587,7 @@ def create_xau_decorated_df(dau_decorated_df, time_period, use_segment):
     period_abbr = time_fields['period_abbr']
     
     # Print a notification message indicating that this function has been called
-    print('Creating ' + frequency + ' Active Users Decorated dataframe')
+    log_progress('Creating ' + frequency + ' Active Users Decorated dataframe')
     
     # We are grouping by the grouping_col (which is either "Week" or "Month_Year"),
     # the user_id, and the first_period_col (either "first_week" or "first_month")
@@ -249,22 +596,31 @@ def create_xau_decorated_df(dau_decorated_df, time_period, use_segment):
     if use_segment: 
         groupby_cols = groupby_cols + ['segment']
         
-    # Start by making a copy of the dataframe that gets passed in so as not to
-    # affect the original
-    dau_decorated = dau_decorated_df.copy()
+    # Start by taking just the columns we need from the dataframe that gets
+    # passed in, so as not to affect the original
+    source_cols = ['user_id', first_period_col, 'inc_amt']
+    if use_segment:
+        source_cols = source_cols + ['segment']
+    dau_decorated = dau_decorated_df[source_cols]
     
-    # Convert the activity_date for each transaction in dau_decorated to a 
-    # period the same timeframe as the period in question (either a week or a 
-    # month)
-    dau_decorated[grouping_col] = pd.to_datetime(dau_decorated['activity_date']).dt.to_period(period_abbr)
+    # Convert the activity_date for each transaction in dau_decorated to the
+    # integer ordinal of the period of the same timeframe as the period in 
+    # question (either a week or a month)
+    dau_decorated = dau_decorated.assign(**{grouping_col : to_period_ordinals(dau_decorated_df['activity_date'], 
+                                                                              time_period)})
     
     # Group dau_decorated into the grouping_cols defined above and aggregate the
     # sum of the inc_amt field
-    xau = (dau_decorated.groupby(groupby_cols, as_index = False)['inc_amt'].sum())
+    xau = (dau_decorated.groupby(groupby_cols, as_index = False, observed = True)['inc_amt'].sum())
     
-    # Set a new column with the next time period by calling the increment_period
-    # function defined above
-    xau['Next_' + grouping_col] = increment_period(xau[grouping_col], time_period)
+    # Set a new column with the next time period, which is one more than
+    # this period's ordinal. Then turn the ordinals back into periods.
+    period_ordinals = xau[grouping_col].values
+    if time_period in ['week', 'month']:
+        xau['Next_' + grouping_col] = ordinals_to_periods(period_ordinals + 1, time_period)
+    else:
+        xau['Next_' + grouping_col] = None
+    xau[grouping_col] = ordinals_to_periods(period_ordinals, time_period)
     
     # Select a subset of the resultant columns from the groupby to output
     output_cols = [grouping_col, 'user_id', 'inc_amt', first_period_col, 'Next_' + grouping_col]
@@ -381,6 +737,87 @@ def calc_rev_ga(x, grouping_col, first_period_col):
 
 
 
+### The vectorized counterpart of calc_user_ga and calc_rev_ga. Rather than
+### running those two functions on every group of xga_interim, it computes 
+### each of their conditions once as a column over the whole merged dataframe
+### and then adds everything up per group with a single groupby. Returns the
+### same user_xga and rev_xga dataframes as the groupby apply calls in 
+### create_growth_accounting_dfs.
+def calc_ga_vectorized(xga_interim, groupby_cols, grouping_col, first_period_col, 
+                       frequency):
+    
+    inc_t = xga_interim['inc_amt.t']
+    inc_l = xga_interim['inc_amt.l']
+    
+    # The same conditions calc_user_ga and calc_rev_ga use to select rows
+    is_active = xga_interim[grouping_col + '.t'].notnull()
+    is_retained = (inc_t > 0) & (inc_l > 0)
+    is_new = xga_interim[first_period_col + '.t'] == xga_interim[grouping_col + '.t']
+    is_not_new = xga_interim[first_period_col + '.t'] != xga_interim[grouping_col + '.t']
+    is_resurrected = is_not_new & ~(inc_l > 0)
+    is_churned = ~(inc_t > 0)
+    is_expansion = is_not_new & is_retained & (inc_t > inc_l)
+    is_contraction = is_not_new & is_retained & (inc_t < inc_l)
+    
+    user_flags = {frequency + ' Active Users' : is_active,
+                  'Retained Users' : is_retained,
+                  'New Users' : is_new,
+                  'Resurrected Users' : is_resurrected,
+                  'Churned Users' : is_churned}
+    
+    # Each user appears at most once per group unless the xAU dataframe has
+    # more than one row per user and period (for example, segments that were
+    # not used in the join). Only then do we need nunique instead of a sum.
+    ga_df = copy_unless_cow(xga_interim[groupby_cols])
+    if xga_interim.duplicated(groupby_cols + ['user_id']).any():
+        user_agg = 'nunique'
+        for name, flag in user_flags.items():
+            ga_df[name] = xga_interim['user_id'].where(flag)
+    else:
+        user_agg = 'sum'
+        for name, flag in user_flags.items():
+            ga_df[name] = flag
+    
+    # Revenue amounts are kept only where the condition holds, so that a 
+    # plain sum per group matches calc_rev_ga. Expansion and contraction sum
+    # the this and last period amounts separately, as calc_rev_ga does.
+    rev_cols = {frequency + ' Revenue' : inc_t.where(is_active),
+                'Retained Revenue' : np.minimum(inc_t, inc_l).where(is_retained),
+                'New Revenue' : inc_t.where(is_new),
+                'Resurrected Revenue' : inc_t.where(is_resurrected),
+                'exp.t' : inc_t.where(is_expansion),
+                'exp.l' : inc_l.where(is_expansion),
+                'con.t' : inc_t.where(is_contraction),
+                'con.l' : inc_l.where(is_contraction),
+                'Churned Revenue' : inc_l.where(is_churned)}
+    for name, values in rev_cols.items():
+        ga_df[name] = values
+    
+    agg_dict = {name : user_agg for name in user_flags}
+    agg_dict.update({name : 'sum' for name in rev_cols})
+    ga_df = ga_df.groupby(groupby_cols, observed = True).agg(agg_dict).reset_index()
+    ga_df = ga_df.rename(columns = {grouping_col + '_join' : grouping_col})
+    
+    ga_df['Churned Users'] = -1 * ga_df['Churned Users']
+    ga_df['Expansion Revenue'] = ga_df['exp.t'] - ga_df['exp.l']
+    ga_df['Contraction Revenue'] = ga_df['con.t'] - ga_df['con.l']
+    ga_df['Churned Revenue'] = -1 * ga_df['Churned Revenue']
+    
+    output_key_cols = [grouping_col] + groupby_cols[1:]
+    user_xga = ga_df[output_key_cols + list(user_flags)]
+    rev_xga = ga_df[output_key_cols + [frequency + ' Revenue',
+                                       'Retained Revenue',
+                                       'New Revenue',
+                                       'Resurrected Revenue',
+                                       'Expansion Revenue',
+                                       'Contraction Revenue',
+                                       'Churned Revenue']]
+    
+    return user_xga, rev_xga
+
+
+
+
 ### Produces the "final" growth accounting dataframe with both user and
 ### revenue numbers for each time period in the "decorated" dataframe
 def create_growth_accounting_dfs(xau_decorated_df, 
@@ -389,22 +826,53 @@ def create_growth_accounting_dfs(xau_decorated_df,
                                  keep_last_period = True, 
                                  date_limit = None,
                                  add_hours = False,
-                                 include_zero_inc = False):
-    print('Creating Growth Accounting dataframes')
+                                 include_zero_inc = False,
+                                 use_vectorized = False):
+    log_progress('Creating Growth Accounting dataframes')
+    
+    user_xga, rev_xga = calc_growth_accounting_base(xau_decorated_df, 
+                                                    time_period, 
+                                                    use_segment, 
+                                                    use_vectorized)
+    
+    return finish_growth_accounting_dfs(user_xga, rev_xga, time_period, 
+                                        keep_last_period, date_limit, 
+                                        add_hours, include_zero_inc)
+
+
+
+
+### The first half of create_growth_accounting_dfs: the user and revenue
+### growth accounting of every period, including the periods after the last
+### activity that only have churned users, before any rows are filtered out.
+### tvc_incremental keeps these between runs.
+def calc_growth_accounting_base(xau_decorated_df, 
+                                time_period, 
+                                use_segment = False,
+                                use_vectorized = False):
+    
     time_fields = get_time_period_dict(time_period)
     grouping_col = time_fields['grouping_col']
     first_period_col = time_fields['first_period_col']
     frequency = time_fields['frequency']
     
-    xau_decorated_df_last = xau_decorated_df.copy()
-    xau_decorated_df_last[grouping_col + '_join'] = xau_decorated_df_last['Next_' + grouping_col]
-    xau_decorated_df[grouping_col + '_join'] = xau_decorated_df[grouping_col]
+    # Take just the columns the growth accounting needs, each with its own
+    # join column: this period for the "this period" side and the next 
+    # period for the "last period" side. The caller's dataframe is left as
+    # it is.
+    ga_cols = [grouping_col, 'user_id', 'inc_amt', first_period_col]
+    if use_segment:
+        ga_cols = ga_cols + ['segment']
+    xau_decorated_df_this = xau_decorated_df.reindex(columns = ga_cols)
+    xau_decorated_df_this[grouping_col + '_join'] = xau_decorated_df[grouping_col]
+    xau_decorated_df_last = xau_decorated_df.reindex(columns = ga_cols)
+    xau_decorated_df_last[grouping_col + '_join'] = xau_decorated_df['Next_' + grouping_col]
     
     interim_join_cols = ['user_id', grouping_col + '_join']
     if use_segment:
         interim_join_cols = interim_join_cols + ['segment']
     
-    xga_interim = pd.merge(xau_decorated_df, xau_decorated_df_last, 
+    xga_interim = pd.merge(xau_decorated_df_this, xau_decorated_df_last, 
                            suffixes = ['.t', '.l'],
                            how = 'outer', 
                            left_on = interim_join_cols, 
@@ -414,34 +882,59 @@ def create_growth_accounting_dfs(xau_decorated_df,
     if use_segment:
         groupby_cols = groupby_cols + ['segment']
         
-    user_xga = (xga_interim.groupby(groupby_cols)
-                .apply(lambda x: pd.Series(calc_user_ga(x, 
-                                                        grouping_col, 
-                                                        first_period_col),
-                                           index = [frequency + ' Active Users', 
-                                                    'Retained Users', 
-                                                    'New Users', 
-                                                    'Resurrected Users',
-                                                    'Churned Users'
-                                                    ]))
-                .reset_index()
-                .rename(columns = {grouping_col + '_join' : grouping_col}))
-                
-    rev_xga = (xga_interim.groupby(groupby_cols)
-                .apply(lambda x: pd.Series(calc_rev_ga(x, 
-                                                       grouping_col, 
-                                                       first_period_col),
-                                           index = [frequency + ' Revenue',
-                                                    'Retained Revenue',
-                                                    'New Revenue',
-                                                    'Resurrected Revenue',
-                                                    'Expansion Revenue',
-                                                    'Contraction Revenue',
-                                                    'Churned Revenue'
-                                                    ]))
-                .reset_index()
-                .rename(columns = {grouping_col + '_join' : grouping_col}))
+    if use_vectorized:
+        user_xga, rev_xga = calc_ga_vectorized(xga_interim, groupby_cols, grouping_col, 
+                                               first_period_col, frequency)
+    else:
+        user_xga = (xga_interim.groupby(groupby_cols, observed = True)
+                    .apply(lambda x: pd.Series(calc_user_ga(x, 
+                                                            grouping_col, 
+                                                            first_period_col),
+                                               index = [frequency + ' Active Users', 
+                                                        'Retained Users', 
+                                                        'New Users', 
+                                                        'Resurrected Users',
+                                                        'Churned Users'
+                                                        ]))
+                    .reset_index()
+                    .rename(columns = {grouping_col + '_join' : grouping_col}))
                 
+        rev_xga = (xga_interim.groupby(groupby_cols, observed = True)
+                    .apply(lambda x: pd.Series(calc_rev_ga(x, 
+                                                           grouping_col, 
+                                                           first_period_col),
+                                               index = [frequency + ' Revenue',
+                                                        'Retained Revenue',
+                                                        'New Revenue',
+                                                        'Resurrected Revenue',
+                                                        'Expansion Revenue',
+                                                        'Contraction Revenue',
+                                                        'Churned Revenue'
+                                                        ]))
+                    .reset_index()
+                    .rename(columns = {grouping_col + '_join' : grouping_col}))
+    
+    return user_xga, rev_xga
+
+
+
+
+### Filters the user and revenue growth accounting dataframes down to the 
+### periods with activity and applies the presentation options. Split out of
+### create_growth_accounting_dfs so that growth accounting kept from earlier
+### runs (see tvc_incremental) can be finished the same way.
+def finish_growth_accounting_dfs(user_xga, 
+                                 rev_xga, 
+                                 time_period, 
+                                 keep_last_period = True, 
+                                 date_limit = None,
+                                 add_hours = False,
+                                 include_zero_inc = False):
+    
+    time_fields = get_time_period_dict(time_period)
+    grouping_col = time_fields['grouping_col']
+    frequency = time_fields['frequency']
+    
     user_xga = user_xga[user_xga[frequency + ' Active Users'] > 0]
     if not include_zero_inc:
         rev_xga = rev_xga[rev_xga[frequency + ' Revenue'] > 0]
@@ -469,7 +962,12 @@ def create_growth_accounting_dfs(xau_decorated_df,
 def calc_user_ga_ratios(user_xga_df, 
                         time_period, 
                         use_segment = False, 
-                        growth_rate_periods = 12):
+                        growth_rate_periods = 12,
+                        use_vectorized = False):
+    
+    if use_vectorized:
+        return calc_user_ga_ratios_vectorized(user_xga_df, time_period, 
+                                              use_segment, growth_rate_periods)
     
     time_fields = get_time_period_dict(time_period)
     frequency = time_fields['frequency']
@@ -483,9 +981,9 @@ def calc_user_ga_ratios(user_xga_df,
     ratio_df = pd.DataFrame()    
     for s in segments:
         if s != 'All':
-            this_ratio_df = user_xga_df.copy().loc[user_xga_df['segment'] == s].reset_index(drop=True)
+            this_ratio_df = user_xga_df.loc[user_xga_df['segment'] == s].reset_index(drop=True)
         else:
-            this_ratio_df = user_xga_df.copy().reset_index(drop=True)
+            this_ratio_df = user_xga_df.reset_index(drop=True)
             this_ratio_df['segment'] = s
             
         this_ratio_df['Users BOP'] = this_ratio_df[frequency + ' Active Users'].shift(1)
@@ -513,7 +1011,12 @@ def calc_user_ga_ratios(user_xga_df,
 ### Using the numbers in the "final" growth accounting dataframe, calculate
 ### the revenue at the beginning of the period (BOP), the  
 ### period-over-period revenue retention ratio, and the revenue quick ratio
-def calc_rev_ga_ratios(rev_xga_df, time_period, use_segment = False, growth_rate_periods = 12):
+def calc_rev_ga_ratios(rev_xga_df, time_period, use_segment = False, growth_rate_periods = 12,
+                       use_vectorized = False):
+    
+    if use_vectorized:
+        return calc_rev_ga_ratios_vectorized(rev_xga_df, time_period, 
+                                             use_segment, growth_rate_periods)
     
     time_fields = get_time_period_dict(time_period)
     frequency = time_fields['frequency']
@@ -527,9 +1030,9 @@ def calc_rev_ga_ratios(rev_xga_df, time_period, use_segment = False, growth_rate
     ratio_df = pd.DataFrame()
     for s in segments:
         if s!= 'All':
-            this_ratio_df = rev_xga_df.copy().loc[rev_xga_df['segment'] == s].reset_index()
+            this_ratio_df = rev_xga_df.loc[rev_xga_df['segment'] == s].reset_index()
         else:
-            this_ratio_df = rev_xga_df.copy().reset_index()
+            this_ratio_df = rev_xga_df.reset_index()
             this_ratio_df['segment'] = s
             
         this_ratio_df['Revenue BOP'] = this_ratio_df[frequency + ' Revenue'].shift(1)
@@ -552,6 +1055,111 @@ def calc_rev_ga_ratios(rev_xga_df, time_period, use_segment = False, growth_rate
 
 
 
+### Vectorized versions of calc_user_ga_ratios and calc_rev_ga_ratios that
+### return the same dataframes. Instead of looping over the segments and 
+### applying calc_user_qr / calc_rev_qr to every row, the rows of all the 
+### segments are put in the order the loops return them (segment by segment,
+### in the order the segments first appear) and the ratios are calculated 
+### for all of them at once, shifting within each segment with groupby.
+def select_ratio_segments(xga_df, use_segment):
+    
+    # xga_df is a new dataframe from reset_index, so it can be modified
+    if not use_segment:
+        xga_df['segment'] = 'All'
+        return xga_df
+    
+    # Rows with a missing segment match no segment in the loops, so they
+    # are left out
+    seg_codes = pd.factorize(xga_df['segment'])[0]
+    keep = np.flatnonzero(seg_codes >= 0)
+    order = keep[np.argsort(seg_codes[keep], kind = 'stable')]
+    
+    return xga_df.take(order).reset_index(drop = True)
+
+
+
+def shift_within_segments(ratio_df, col, periods, use_segment):
+    if use_segment:
+        return ratio_df.groupby('segment', sort = False, observed = True)[col].shift(periods)
+    return ratio_df[col].shift(periods)
+
+
+
+def calc_user_ga_ratios_vectorized(user_xga_df, 
+                                   time_period, 
+                                   use_segment = False, 
+                                   growth_rate_periods = 12):
+    
+    time_fields = get_time_period_dict(time_period)
+    frequency = time_fields['frequency']
+    per = time_fields['period_abbr']
+    active_col = frequency + ' Active Users'
+    
+    ratio_df = select_ratio_segments(user_xga_df.reset_index(drop = True), use_segment)
+    
+    ratio_df['Users BOP'] = shift_within_segments(ratio_df, active_col, 1, use_segment)
+    ratio_df[per + 'o' + per + ' User Retention'] = ratio_df['Retained Users'] / ratio_df['Users BOP']
+    
+    # The user quick ratio, as calc_user_qr calculates it for each row
+    new_users = ratio_df['New Users'].fillna(0)
+    res_users = ratio_df['Resurrected Users'].fillna(0)
+    churned_users = ratio_df['Churned Users'].fillna(0)
+    ratio_df['User Quick Ratio'] = (-1 * (new_users + res_users) / churned_users).where(churned_users < 0)
+    
+    cgr_col = 'User C%sGR%s' % (per, growth_rate_periods)
+    ratio_df[cgr_col] = np.power((ratio_df[active_col] / \
+                 shift_within_segments(ratio_df, active_col, growth_rate_periods, use_segment)), 
+                 1/growth_rate_periods)-1
+    
+    # The Growth Threshold and growth rate target are constants for display purposes
+    ratio_df['Growth Threshold'] = 1.0
+    ratio_df[cgr_col + ' Target'] = 0.1
+    
+    return ratio_df
+
+
+
+def calc_rev_ga_ratios_vectorized(rev_xga_df, 
+                                  time_period, 
+                                  use_segment = False, 
+                                  growth_rate_periods = 12):
+    
+    time_fields = get_time_period_dict(time_period)
+    frequency = time_fields['frequency']
+    per = time_fields['period_abbr']
+    rev_col = frequency + ' Revenue'
+    
+    # Like calc_rev_ga_ratios, this keeps the original index as an 'index'
+    # column, and numbers the rows of each segment from 0
+    ratio_df = select_ratio_segments(rev_xga_df.reset_index(), use_segment)
+    
+    ratio_df['Revenue BOP'] = shift_within_segments(ratio_df, rev_col, 1, use_segment)
+    ratio_df[per + 'o' + per + ' Revenue Retention'] = ratio_df['Retained Revenue'] / ratio_df['Revenue BOP']
+    
+    # The revenue quick ratio, as calc_rev_qr calculates it for each row
+    new_rev = ratio_df['New Revenue'].fillna(0)
+    res_rev = ratio_df['Resurrected Revenue'].fillna(0)
+    churned_rev = ratio_df['Churned Revenue'].fillna(0)
+    expansion_rev = ratio_df['Expansion Revenue'].fillna(0)
+    contraction_rev = ratio_df['Contraction Revenue'].fillna(0)
+    lost_rev = churned_rev + contraction_rev
+    ratio_df['Revenue Quick Ratio'] = (-1 * (new_rev + res_rev + expansion_rev) / lost_rev).where(lost_rev < 0)
+    ratio_df['Net Expansion Revenue'] = ratio_df['Expansion Revenue'] + \
+                                        ratio_df['Contraction Revenue']
+    
+    cgr_col = 'Revenue C%sGR%s' % (per, growth_rate_periods)
+    ratio_df[cgr_col] = np.power((ratio_df[rev_col] / \
+            shift_within_segments(ratio_df, rev_col, growth_rate_periods, use_segment)), 
+            1/growth_rate_periods)-1
+    
+    if use_segment:
+        ratio_df.index = ratio_df.groupby('segment', sort = False, observed = True).cumcount().values
+    
+    return ratio_df
+
+
+
+
 ### Join the user growth accounting dataframe with the revenue growth accounting
 ### dataframe
 def consolidate_ga_dfs(user_ga_df, rev_ga_df, time_period):
@@ -559,7 +1167,7 @@ def consolidate_ga_dfs(user_ga_df, rev_ga_df, time_period):
     time_fields = get_time_period_dict(time_period)
     grouping_col = time_fields['grouping_col']
     
-    print('Joining user and revenue dataframes')
+    log_progress('Joining user and revenue dataframes')
     
     consolidated_ga_df = pd.merge(user_ga_df, rev_ga_df,
                                   how = 'inner', on = [grouping_col, 'segment'])
@@ -578,13 +1186,35 @@ def consolidate_all_ga(xau_decorated_df,
                        date_limit = None,
                        include_zero_inc = False,
                        add_hours = False,
-                       use_standard_col_names = True):
+                       use_standard_col_names = True,
+                       use_vectorized = False):
     
     user_ga, rev_ga = create_growth_accounting_dfs(xau_decorated_df, time_period, 
                                                    use_segment, keep_last_period, 
-                                                   date_limit, add_hours, include_zero_inc)
-    user_ga_with_ratios = calc_user_ga_ratios(user_ga, time_period, use_segment, growth_rate_periods)
-    rev_ga_with_ratios = calc_rev_ga_ratios(rev_ga, time_period, use_segment, growth_rate_periods)
+                                                   date_limit, add_hours, include_zero_inc,
+                                                   use_vectorized)
+    
+    return consolidate_ga_with_ratios(user_ga, rev_ga, time_period, use_segment,
+                                      growth_rate_periods, use_standard_col_names,
+                                      use_vectorized)
+
+
+
+
+### Adds the ratios to the user and revenue growth accounting dataframes and 
+### joins them into the complete dataframe that consolidate_all_ga returns
+def consolidate_ga_with_ratios(user_ga, 
+                               rev_ga, 
+                               time_period, 
+                               use_segment = False, 
+                               growth_rate_periods = 12,
+                               use_standard_col_names = True,
+                               use_vectorized = False):
+    
+    user_ga_with_ratios = calc_user_ga_ratios(user_ga, time_period, use_segment, 
+                                              growth_rate_periods, use_vectorized)
+    rev_ga_with_ratios = calc_rev_ga_ratios(rev_ga, time_period, use_segment, 
+                                            growth_rate_periods, use_vectorized)
     all_ga_df = consolidate_ga_dfs(user_ga_with_ratios, rev_ga_with_ratios, time_period)
     
     time_fields = get_time_period_dict(time_period)
@@ -619,14 +1249,24 @@ def consolidate_all_ga(xau_decorated_df,
 
 
 
+### Adds a '<unit> n' column for each value n of since_col (in the order the
+### values first appear) holding cum_inc_per_cohort_cust in the rows where
+### since_col is n and NaN elsewhere, with zeros as NaN too. The columns are
+### filled in one step, by placing each row's value in its own column of a 
+### rows x values array, instead of one pass over the rows per column.
 def add_period_n_cum_inc_per_cohort_cust_columns(cohort_df, since_col, unit):
-    c_df = cohort_df.copy()
-    since_vector = c_df[since_col].unique()
-    for n in since_vector:
-        new_column_name = unit + ' %s' % n
-        c_df[new_column_name] = c_df['cum_inc_per_cohort_cust'] * (c_df[since_col] == n)
-        c_df[new_column_name] = c_df[new_column_name].replace(0, np.nan)
-    return c_df
+    
+    since_codes, since_vector = pd.factorize(cohort_df[since_col])
+    values = cohort_df['cum_inc_per_cohort_cust'].values.astype(np.float64)
+    
+    period_n = np.full((len(cohort_df), len(since_vector)), np.nan)
+    period_n[np.arange(len(cohort_df)), since_codes] = np.where(values == 0, np.nan, values)
+    
+    period_n_df = pd.DataFrame(period_n, 
+                               index = cohort_df.index,
+                               columns = [unit + ' %s' % n for n in since_vector])
+    
+    return pd.concat([cohort_df, period_n_df], axis = 1)
     
 
 
@@ -652,26 +1292,63 @@ def create_xau_cohort_df(xau_decorated_df,
         
     # If a date_limit is set, set that date as the max date in the 
     # dau_decorated_df dataframe passed into the function.
-    # Otherwise, make a copy of the entire input dau_decorated_df.
     if date_limit is not None:
-        xau_d = (xau_decorated_df[pd.PeriodIndex(xau_decorated_df[grouping_col], 
-                                                 freq = period_abbr)
-                                  .start_time <= date_limit]
-                 .copy()
-                )
+        xau_d = xau_decorated_df[pd.PeriodIndex(xau_decorated_df[grouping_col], 
+                                                freq = period_abbr)
+                                 .start_time <= date_limit]
     else:
-        xau_d = xau_decorated_df.copy()
+        xau_d = xau_decorated_df
+    
+    # Aggregate the xAU rows into one row per cohort, period (and segment),
+    # then add the cohort-level calculations and presentation columns
+    xau_d = calc_xau_cohort_base(xau_d, time_period, use_segment)
+    
+    return finish_xau_cohort_df(xau_d, 
+                                time_period, 
+                                use_segment,
+                                recent_periods_back_to_exclude,
+                                create_period_n_inc_cols,
+                                add_hours,
+                                use_standard_col_names)
+
+
+
+
+### The first half of create_xau_cohort_df: the sum of inc_amt and the number
+### of unique users per cohort (first period), period, periods since first,
+### and segment. These sums only depend on the xAU rows of each period, so 
+### they can be kept between runs and added to (see tvc_incremental).
+def calc_xau_cohort_base(xau_decorated_df, time_period, use_segment = False):
+    
+    time_fields = get_time_period_dict(time_period)
+    grouping_col = time_fields['grouping_col']
+    first_period_col = time_fields['first_period_col']
+    unit = time_fields['unit']
+    
+    # Make a copy of just the columns we need so as not to affect the original
+    cohort_cols = [grouping_col, first_period_col, 'user_id', 'inc_amt']
+    if use_segment:
+        cohort_cols = cohort_cols + ['segment']
+    xau_d = copy_unless_cow(xau_decorated_df[cohort_cols])
     
     # Set the since_col variable to say "Months Since First" or "Weeks Since First"
     since_col = '%ss Since First' % unit
     
-    # Convert periods to datetime (start of the period) if not already done
-    xau_d[grouping_col] = pd.to_datetime(xau_d[grouping_col].dt.start_time)
-    xau_d[first_period_col] = pd.to_datetime(xau_d[first_period_col].dt.start_time)
+    # Convert periods to integer ordinals, and from those to datetime (start 
+    # of the period)
+    period_ordinals = to_period_ordinals(xau_d[grouping_col], time_period)
+    first_period_ordinals = to_period_ordinals(xau_d[first_period_col], time_period)
+    xau_d[grouping_col] = (period_ordinals_to_start_days(period_ordinals, time_period)
+                           .astype('datetime64[D]').astype('datetime64[ns]'))
+    xau_d[first_period_col] = (period_ordinals_to_start_days(first_period_ordinals, time_period)
+                               .astype('datetime64[D]').astype('datetime64[ns]'))
 
     # Calculate the value in the since_col to be the number of periods between
-    # the current period and the user's first period
-    xau_d[since_col] = [date_difference(g, f, time_period) for g, f in zip(xau_d[first_period_col], xau_d[grouping_col])]
+    # the current period and the user's first period. With both periods as
+    # ordinals, that is a subtraction over the whole column, and it gives the
+    # same number of days, weeks or months as date_difference.
+    xau_d[since_col] = (period_ordinals.astype(np.int64) - 
+                        first_period_ordinals.astype(np.int64))
 
     # Since we are aggregating it all by the cohort of users that started in a
     # particular period, we set the group by columns for the first aggregation
@@ -688,11 +1365,34 @@ def create_xau_cohort_df(xau_decorated_df,
     
     # Group xau_d by the first_groupby_cols to find the sum of inc_amt and
     # the number of unique user_ids in each grouping
-    xau_d = xau_d.groupby(first_groupby_cols)\
+    xau_d = xau_d.groupby(first_groupby_cols, observed = True)\
                     .agg({'inc_amt' : 'sum', 
                           'user_id' : 'nunique'})\
                     .rename(columns = { 'user_id' : 'cust_ct' })
-                    
+    
+    return xau_d
+
+
+
+
+### The second half of create_xau_cohort_df: takes the output of 
+### calc_xau_cohort_base and adds the cohort-level calculations, the 
+### presentation columns and the column names
+def finish_xau_cohort_df(xau_d, 
+                         time_period, 
+                         use_segment = False,
+                         recent_periods_back_to_exclude = 1, 
+                         create_period_n_inc_cols = False,
+                         add_hours = False,
+                         use_standard_col_names = False):
+    
+    time_fields = get_time_period_dict(time_period)
+    grouping_col = time_fields['grouping_col']
+    first_period_col = time_fields['first_period_col']
+    unit = time_fields['unit']
+    period_abbr = time_fields['period_abbr']
+    since_col = '%ss Since First' % unit
+    
     # For the second groupby, we reduce the columns down to the first_period_col
     # and the segment (if applicable)
     second_groupby_cols = [first_period_col]
@@ -703,11 +1403,11 @@ def create_xau_cohort_df(xau_decorated_df,
     # rather than at the individual period level
     # The first of such calculations is to take the first value for cust_ct
     # (customer count) as being the number of customers in the cohort
-    xau_d['cohort_cust_ct'] = xau_d.groupby(second_groupby_cols)['cust_ct'].transform('first')
+    xau_d['cohort_cust_ct'] = xau_d.groupby(second_groupby_cols, observed = True)['cust_ct'].transform('first')
     
     # The second calculation at the cohort level is to get the cumulative sum
     # of the inc_amt for each period's cohort
-    xau_d['cum_inc_amt'] = xau_d.groupby(second_groupby_cols)['inc_amt'].cumsum()
+    xau_d['cum_inc_amt'] = xau_d.groupby(second_groupby_cols, observed = True)['inc_amt'].cumsum()
     
     # These ratios are calculated per period using the per-cohort numbers calculated
     # using the second groupby
@@ -760,7 +1460,7 @@ def create_xau_cohort_df(xau_decorated_df,
         if use_segment:
             xau_d['segment_first_' + time_period] = (xau_d[first_period_col]
                                                      .dt
-                                                     .strftime('%Y-%m') + '-' + xau_d['segment'])  
+                                                     .strftime('%Y-%m') + '-' + xau_d['segment'].astype('str'))  
         
         # If we want to add new columns for weekly trend analysis, we would do
         # so by setting the create_period_n_inc_cols equal to True, which would
@@ -773,7 +1473,7 @@ def create_xau_cohort_df(xau_decorated_df,
         
         # In the case of days, excluding the last period involves using 
         # timedelta to subtract days from today's date
-        last_period = (datetime.today() - timedelta(days = recent_periods_back_to_exclude)).date()
+        last_period = pd.Timestamp((datetime.today() - timedelta(days = recent_periods_back_to_exclude)).date())
         xau_d = xau_d.loc[xau_d[grouping_col] <= last_period]
         
         # The add_hours piece uses timedelta(hours = 7)
@@ -781,15 +1481,15 @@ def create_xau_cohort_df(xau_decorated_df,
             xau_d[first_period_col] = xau_d[first_period_col] + timedelta(hours = 7)
             xau_d[grouping_col] = xau_d[grouping_col] + timedelta(hours = 7)
             
-        # Change the data type on the since_col to be a number and not a timedelta    
-        xau_d[since_col] = xau_d[since_col].astype(timedelta).map(lambda x: np.nan if pd.isnull(x) else x.days)
+        # The since_col already holds the number of days as an integer, as
+        # computed from the day ordinals above, so it needs no conversion
         
         # Using the segment column requires us to specify which segment each
         # first_period_col goes with. 
         if use_segment:
             xau_d['segment_first_' + time_period] = (xau_d[first_period_col]
                                                      .dt
-                                                     .strftime('%Y-%m-%d') + '-' + xau_d['segment'])
+                                                     .strftime('%Y-%m-%d') + '-' + xau_d['segment'].astype('str'))
         
         # Similar to above for adding weekly trend analysis, we would do
         # so by setting the create_period_n_inc_cols equal to True, which would
@@ -913,9 +1613,12 @@ def classify_users_and_revenue(x):
 ### one row per segment
 def calc_ga_for_window(dau_decorated_df, last_date, window_days, use_segment):
     window_start_date = last_date - timedelta(days = 2*window_days-1)
-    dau_dec = (dau_decorated_df
-            .loc[(dau_decorated_df['activity_date'] >= window_start_date) & (dau_decorated_df['activity_date'] <= last_date)]
-            .copy()
+    window_cols = ['user_id', 'activity_date', 'inc_amt', 'first_dt']
+    if use_segment:
+        window_cols = window_cols + ['segment']
+    dau_dec = copy_unless_cow(dau_decorated_df
+            .loc[(dau_decorated_df['activity_date'] >= window_start_date) & (dau_decorated_df['activity_date'] <= last_date),
+                 window_cols]
             )
     
     dau_dec['ga_date_range'] = dau_dec.apply(lambda x: assign_ga_date_range(x, last_date, window_days), axis = 1)
@@ -924,7 +1627,7 @@ def calc_ga_for_window(dau_decorated_df, last_date, window_days, use_segment):
         dau_dec['segment'] = 'All'
         
     groupings = ['user_id', 'segment', 'ga_date_range']
-    dau_grouped = (dau_dec.groupby(groupings)['inc_amt']
+    dau_grouped = (dau_dec.groupby(groupings, observed = True)['inc_amt']
                                 .sum()
                                 .unstack()
                                 .reset_index()
@@ -939,7 +1642,11 @@ def calc_ga_for_window(dau_decorated_df, last_date, window_days, use_segment):
                                                              axis = 1, 
                                                              result_type='expand')
 
-    dau_grouped_2 = dau_grouped.groupby('segment').sum().reset_index()
+    # Summing the user_id strings lists every user in the window. Compact 
+    # user_id codes cannot be summed that way, so they are left out.
+    if dau_grouped['user_id'].dtype != 'object':
+        dau_grouped = dau_grouped.drop(columns = ['user_id'])
+    dau_grouped_2 = dau_grouped.groupby('segment', observed = True).sum().reset_index()
     dau_grouped_2['window_end_date'] = last_date
     
     this_per_users = dau_grouped_2['retained_users'] + dau_grouped_2['new_users'] + dau_grouped_2['resurrected_users']
@@ -972,9 +1679,20 @@ def calc_ga_for_window(dau_decorated_df, last_date, window_days, use_segment):
 def calc_rolling_qr_window(dau_decorated_df, 
                            window_days = 28, 
                            use_segment = False,
-                           use_final_day = True
+                           use_final_day = True,
+                           use_vectorized = False,
+                           use_parallel = False,
+                           max_workers = None
                            ):
     
+    # The vectorized version below handles every window at once, so hand off
+    # to it if requested
+    if use_vectorized:
+        return calc_rolling_qr_window_vectorized(dau_decorated_df, 
+                                                 window_days = window_days, 
+                                                 use_segment = use_segment,
+                                                 use_final_day = use_final_day)
+    
     if use_final_day:
         end_dt = max(dau_decorated_df['activity_date'])
     else:
@@ -984,20 +1702,293 @@ def calc_rolling_qr_window(dau_decorated_df,
     
     date_range = pd.date_range(start = start_dt, end = end_dt, freq = 'D')
 
-    rolling_qr_df = pd.DataFrame()
+    # Each window looks back 2*window_days days from its end date. In 
+    # parallel, the date range is split into shards, one per worker.
+    if use_parallel:
+        rolling_qr_df = calc_windows_in_parallel(calc_qr_windows_for_dates,
+                                                 dau_decorated_df,
+                                                 date_range,
+                                                 2*window_days,
+                                                 max_workers,
+                                                 window_days = window_days,
+                                                 use_segment = use_segment)
+    else:
+        rolling_qr_df = calc_qr_windows_for_dates(dau_decorated_df, date_range, 
+                                                  window_days, use_segment)
+        
+    rolling_qr_df['window_end_date'] = pd.to_datetime(rolling_qr_df['window_end_date'])
+    return rolling_qr_df
+
+
+
+### Calls calc_ga_for_window for each of the window end dates in date_range
+### and concatenates the windows once at the end
+def calc_qr_windows_for_dates(dau_decorated_df, date_range, window_days, use_segment):
+    
+    windows = []
     for d in date_range:
         d2 = d.date()
-        print(window_days, d2)
-        this_window = calc_ga_for_window(dau_decorated_df, d2, window_days, use_segment)
-        rolling_qr_df = pd.concat([rolling_qr_df, this_window])
+        log_progress('%s-day window ending %s' % (window_days, d2), logging.DEBUG)
+        windows.append(calc_ga_for_window(dau_decorated_df, d2, window_days, use_segment))
+    
+    return concat_windows(windows)
+
+
+
+### Concatenates the dataframes of a list of windows, in the same way as 
+### concatenating them one at a time onto an empty dataframe
+def concat_windows(windows):
+    
+    if len(windows) == 0:
+        return pd.DataFrame()
+    
+    return pd.concat(windows)
+
+
+
+### Splits date_range into one contiguous shard of window end dates per 
+### worker and runs window_function (calc_qr_windows_for_dates or 
+### calc_xau_windows_for_dates) on each shard in a process pool. Each worker 
+### only gets the rows of dau_decorated_df that its windows need: the ones 
+### from lookback_days - 1 days before its first end date to its last one.
+### The shards' windows are concatenated once, in date order.
+def calc_windows_in_parallel(window_function, 
+                             dau_decorated_df, 
+                             date_range, 
+                             lookback_days, 
+                             max_workers = None, 
+                             **kwargs):
+    
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    n_shards = max(min(max_workers, len(date_range)), 1)
+    
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        futures = []
+        for shard in np.array_split(np.arange(len(date_range)), n_shards):
+            if len(shard) == 0:
+                continue
+            shard_dates = date_range[shard]
+            shard_start = (shard_dates[0] - timedelta(days = lookback_days - 1)).date()
+            shard_end = shard_dates[-1].date()
+            dau_slice = dau_decorated_df.loc[(dau_decorated_df['activity_date'] >= shard_start) & 
+                                             (dau_decorated_df['activity_date'] <= shard_end)]
+            futures.append(executor.submit(window_function, dau_slice, shard_dates, **kwargs))
         
-    rolling_qr_df['window_end_date'] = pd.to_datetime(rolling_qr_df['window_end_date'])
+        return concat_windows([f.result() for f in futures])
+
+
+
+### Helper for the vectorized and incremental window functions below. Encodes
+### dau_decorated_df as integer arrays: each activity_date becomes its day 
+### number counted from the first activity_date, and each user (or user and
+### segment pair) becomes a key number. Without segments, every user falls in
+### the single 'All' segment. Like groupby, rows with a missing user_id or 
+### segment are dropped; keep marks the rows that remain.
+def encode_dau_keys(dau_decorated_df, use_segment):
+    
+    activity_days = to_day_ordinals(dau_decorated_df['activity_date']).astype(np.int64)
+    days = activity_days - activity_days.min()
+    
+    user_codes = pd.factorize(dau_decorated_df['user_id'])[0]
+    if use_segment:
+        seg_codes, seg_labels = pd.factorize(dau_decorated_df['segment'], sort = True)
+    else:
+        seg_codes = np.zeros(len(days), dtype = np.int64)
+        seg_labels = ['All']
+    n_segs = len(seg_labels)
+    
+    keep = (user_codes >= 0) & (seg_codes >= 0)
+    user_seg = user_codes[keep].astype(np.int64) * n_segs + seg_codes[keep]
+    key_values, row_keys = np.unique(user_seg, return_inverse = True)
+    key_seg = key_values % n_segs
+    
+    return days[keep], row_keys, key_seg, seg_labels, keep
+
+
+
+
+### The vectorized version of calc_rolling_qr_window. Instead of calling 
+### calc_ga_for_window (and its two row-wise applies) once per day, it lays 
+### out each user's daily inc_amt as a dense user x day matrix, takes 
+### cumulative sums along the days, and reads the "this window", "last 
+### window", and "first this window" amounts for every end date at once as 
+### differences of those sums. Users are then classified with boolean masks 
+### following the same rules as assign_ga_date_range and 
+### classify_users_and_revenue. The matrix is built max_block_cells cells at
+### a time so memory stays bounded however many users there are.
+###
+### Revenue figures can differ from calc_rolling_qr_window in the last few
+### digits because they come from differences of cumulative sums. The 
+### 'user_id' column, which the per-day version fills with every user_id in
+### the window concatenated together, is left out.
+def calc_rolling_qr_window_vectorized(dau_decorated_df, 
+                                      window_days = 28, 
+                                      use_segment = False,
+                                      use_final_day = True,
+                                      max_block_cells = 2000000
+                                      ):
+    
+    # Same window end dates as calc_rolling_qr_window
+    if use_final_day:
+        end_dt = max(dau_decorated_df['activity_date'])
+    else:
+        end_dt = max(dau_decorated_df['activity_date']) - timedelta(days = 1)
+    
+    start_dt = min(dau_decorated_df['activity_date']) + timedelta(days = 2*window_days)
+    
+    date_range = pd.date_range(start = start_dt, end = end_dt, freq = 'D')
+    log_progress('Calculating rolling %s-day growth accounting for %s windows' % (window_days, len(date_range)))
+    
+    # Encode the days, users and segments as integers, and find each user 
+    # key's first_dt as a day number on the same scale
+    days, row_keys, key_seg, seg_labels, keep = encode_dau_keys(dau_decorated_df, 
+                                                                use_segment)
+    first_day = pd.Timestamp(min(dau_decorated_df['activity_date']))
+    n_days = (pd.Timestamp(max(dau_decorated_df['activity_date'])) - first_day).days + 1
+    n_segs = len(seg_labels)
+    n_keys = len(key_seg)
+    
+    row_first_days = (to_day_ordinals(dau_decorated_df['first_dt']).astype(np.int64) - 
+                      to_day_ordinals([first_day])[0])[keep]
+    key_first_days = np.full(n_keys, np.iinfo(np.int64).max)
+    np.minimum.at(key_first_days, row_keys, row_first_days)
+    
+    inc_amts = np.nan_to_num(dau_decorated_df['inc_amt'].values[keep].astype(np.float64))
+    
+    # Day numbers of each window's end, and of the first days of this window
+    # and the last window
+    end_days = (date_range - first_day).days.values
+    curr_start_days = end_days - window_days + 1
+    prev_start_days = end_days - 2*window_days + 1
+    
+    # Per segment and window totals, filled one block of user keys at a time
+    sum_names = ['first_this_period', 'last_period', 'this_period',
+                 'retained_users', 'new_users', 'resurrected_users',
+                 'churned_users', 'retained_revenue', 'new_revenue', 
+                 'resurrected_revenue', 'expansion_revenue', 'churned_revenue',
+                 'contraction_revenue', 'window_users']
+    sums = {name : np.zeros((n_segs, len(end_days))) for name in sum_names}
+    
+    # Sort the rows by key so each block of keys is a contiguous run of rows
+    order = np.argsort(row_keys, kind = 'stable')
+    row_keys = row_keys[order]
+    days = days[order]
+    inc_amts = inc_amts[order]
+    
+    block_keys = max(1, max_block_cells // (n_days + 1))
+    for block_start in range(0, n_keys, block_keys):
+        block_end = min(block_start + block_keys, n_keys)
+        n_block = block_end - block_start
+        row_start, row_end = np.searchsorted(row_keys, [block_start, block_end])
+        cells = (row_keys[row_start:row_end] - block_start) * n_days + days[row_start:row_end]
+        
+        # Dense user x day matrices of inc_amt and of whether the user had a
+        # DAU row that day, with a leading column of zeros before the cumsum
+        cum_inc = np.zeros((n_block, n_days + 1))
+        cum_inc[:, 1:] = np.bincount(cells, weights = inc_amts[row_start:row_end], 
+                                     minlength = n_block * n_days).reshape(n_block, n_days)
+        np.cumsum(cum_inc, axis = 1, out = cum_inc)
+        cum_rows = np.zeros((n_block, n_days + 1), dtype = np.int32)
+        cum_rows[:, 1:] = np.bincount(cells, minlength = n_block * n_days).reshape(n_block, n_days)
+        np.cumsum(cum_rows, axis = 1, out = cum_rows)
+        
+        # Amounts and activity in this window and the last window, for every
+        # user in the block and every window end date
+        this_amt = cum_inc[:, end_days + 1] - cum_inc[:, curr_start_days]
+        last_amt = cum_inc[:, curr_start_days] - cum_inc[:, prev_start_days]
+        is_this = (cum_rows[:, end_days + 1] - cum_rows[:, curr_start_days]) > 0
+        is_last = (cum_rows[:, curr_start_days] - cum_rows[:, prev_start_days]) > 0
+        
+        # A user whose first_dt falls in this window is new, and all of their
+        # activity is "first this period" rather than "this period"
+        is_first_this = (key_first_days[block_start:block_end, None] >= curr_start_days) & is_this
+        is_this = is_this & ~is_first_this
+        
+        is_res = is_this & ~is_last
+        is_churned = is_last & ~is_this
+        is_ret = is_last & is_this
+        diff = this_amt - last_amt
+        is_exp = is_ret & (diff >= 0)
+        
+        block_values = {'first_this_period' : this_amt * is_first_this,
+                        'last_period' : last_amt,
+                        'this_period' : this_amt * is_this,
+                        'retained_users' : is_ret,
+                        'new_users' : is_first_this,
+                        'resurrected_users' : is_res,
+                        'churned_users' : -1.0 * is_churned,
+                        'retained_revenue' : np.where(is_exp, last_amt, this_amt) * is_ret,
+                        'new_revenue' : this_amt * is_first_this,
+                        'resurrected_revenue' : this_amt * is_res,
+                        'expansion_revenue' : diff * is_exp,
+                        'churned_revenue' : -1.0 * last_amt * is_churned,
+                        'contraction_revenue' : diff * (is_ret & ~is_exp),
+                        'window_users' : is_first_this | is_this | is_last
+                        }
+        
+        # Add each block's figures to its segments with a one-hot matrix
+        seg_onehot = np.zeros((n_segs, n_block))
+        seg_onehot[key_seg[block_start:block_end], np.arange(n_block)] = 1
+        for name in sum_names:
+            sums[name] += seg_onehot @ block_values[name]
+    
+    # Keep the segments that had any activity in each window, ordered by
+    # window end date and then segment like calc_rolling_qr_window
+    window_idx, seg_idx = np.nonzero(sums['window_users'].T > 0)
+    row_index = pd.Series(window_idx).groupby(window_idx).cumcount().values
+    
+    rolling_qr_df = pd.DataFrame({'segment' : np.asarray(seg_labels, dtype = object)[seg_idx]}, 
+                                 index = row_index)
+    for name in sum_names[:-1]:
+        rolling_qr_df[name] = sums[name][seg_idx, window_idx]
+    rolling_qr_df['window_end_date'] = date_range[window_idx]
+    
+    this_per_users = rolling_qr_df['retained_users'] + rolling_qr_df['new_users'] + rolling_qr_df['resurrected_users']
+    last_per_users = rolling_qr_df['retained_users'] - rolling_qr_df['churned_users']
+    
+    rolling_qr_df['active_users'] = this_per_users
+    rolling_qr_df['user_quick_ratio'] = (-1 * (rolling_qr_df['new_users'] + rolling_qr_df['resurrected_users']) / 
+                                         rolling_qr_df['churned_users'].where(rolling_qr_df['churned_users'] < 0))
+    rolling_qr_df['user_retention_rate'] = rolling_qr_df['retained_users'] / last_per_users
+    rolling_qr_df['pop_user_growth_rate'] = this_per_users / last_per_users - 1
+    
+    this_per_rev = rolling_qr_df['this_period'] + rolling_qr_df['first_this_period']
+    last_per_rev = rolling_qr_df['last_period']
+    lost_rev = rolling_qr_df['churned_revenue'] + rolling_qr_df['contraction_revenue']
+    
+    rolling_qr_df['revenue_quick_ratio'] = (-1 * (rolling_qr_df['new_revenue'] + rolling_qr_df['resurrected_revenue'] + 
+                                                  rolling_qr_df['expansion_revenue']) / lost_rev.where(lost_rev < 0))
+    rolling_qr_df['revenue_retention_rate'] = rolling_qr_df['retained_revenue'] / last_per_rev
+    rolling_qr_df['pop_revenue_growth_rate'] = this_per_rev / last_per_rev - 1
+    
+    # calc_ga_for_window only has a revenue column for a kind of activity
+    # that some user in the window had, so when no segment has it that 
+    # window's figure is NaN rather than 0
+    for name, user_names in [('first_this_period', ['new_users']),
+                             ('this_period', ['retained_users', 'resurrected_users']),
+                             ('last_period', ['retained_users', 'churned_users'])]:
+        window_has_users = (sum(np.abs(sums[u]) for u in user_names).sum(axis = 0) > 0)[window_idx]
+        rolling_qr_df[name] = rolling_qr_df[name].where(window_has_users)
+    
+    rolling_qr_df['window_days'] = window_days
+    rolling_qr_df['Growth Threshold'] = 1
+    
     return rolling_qr_df
 
 
+
     
     
   
+# The check_activity_index function makes sure a TVCActivityIndex passed to
+# the engagement functions was built with the same use_segment as the call,
+# since its users would otherwise not line up with the segments asked for.
+def check_activity_index(activity_index, use_segment):
+    if activity_index.use_segment != use_segment:
+        raise ValueError('The activity index was built with use_segment = %s, but the call has use_segment = %s.'
+                         % (activity_index.use_segment, use_segment))
+
 # The calc_user_periodic_usage function takes the dau_decorated dataframe 
 # calculated above, determines a range of dates using the last_date and 
 # window_days inputs, and calculates the total number of active periods
@@ -1008,22 +1999,76 @@ def calc_user_periodic_usage(dau_decorated_df,
                              last_date, 
                              window_days, 
                              breakouts, 
-                             use_segment 
+                             use_segment,
+                             activity_index = None
                              ):
     
+    # These are the parameters that are set from the get_time_period_dict 
+    # function above
+    time_fields = get_time_period_dict(time_period)
+    period_abbr = time_period[0] # first letter of the time period (lowercase)
+    active_col_name = 'active_' + time_period + 's'
+    if time_fields is None:
+        period_days = 1
+    else:
+        period_days = time_fields['days']
+    
+    # With a TVCActivityIndex (see tvc_activity_index) built from 
+    # dau_decorated_df, the active periods of every user come from popcounts
+    # over its activity bitsets, and the inc_amt from its sparse per-day rows,
+    # instead of the steps below
+    if activity_index is not None:
+        check_activity_index(activity_index, use_segment)
+        xau_grouped = activity_index.user_periodic_usage(time_period, last_date, window_days)
+    else:
+        xau_grouped = calc_user_periodic_usage_from_df(dau_decorated_df, 
+                                                       time_period, 
+                                                       last_date, 
+                                                       window_days, 
+                                                       use_segment)
+    
+    # Breakouts allow us to see very easily which users are above the number
+    # of periods specified in the breakout list. For example, if I want to know
+    # which users are active 2+ periods and also 4+ periods, I would set
+    # breakouts = [2,4]. 
+    for b in breakouts:
+        col_name = '%s%s+ users' % (b, period_abbr)
+        xau_grouped[col_name] = (xau_grouped[active_col_name] >= b)
+        
+    # Before returning the dataframe to the calling function, sort the values
+    # in descending order of inc_amt
+    xau_grouped_sorted = xau_grouped.sort_values('inc_amt', ascending = False)  
+    
+    return xau_grouped_sorted     
+
+
+
+
+### The part of calc_user_periodic_usage that filters dau_decorated_df down
+### to the window and counts the active periods and inc_amt of each user
+def calc_user_periodic_usage_from_df(dau_decorated_df, 
+                                     time_period, 
+                                     last_date, 
+                                     window_days, 
+                                     use_segment):
+    
     # We need to know the start date of our window. We calculate it by
     # subtracting window_days-1 days from the last_date input parameter
     
     window_start_date = last_date - timedelta(days = window_days-1)
     
-    # Create a copy of the dau_decorated_df input dataframe that isolates the
-    # activity_dates between the start and end dates of the window. Call it xau.
+    # Create a copy of the columns of the dau_decorated_df input dataframe we 
+    # need, isolating the activity_dates between the start and end dates of 
+    # the window. Call it xau.
     
-    xau = (dau_decorated_df
-           .loc[(dau_decorated_df['activity_date'] >= window_start_date) & 
-                (dau_decorated_df['activity_date'] <= last_date)]
-           .copy()
-           )
+    window_cols = ['user_id', 'activity_date', 'inc_amt']
+    if use_segment:
+        window_cols = window_cols + ['segment']
+    xau = copy_unless_cow(dau_decorated_df
+                          .loc[(dau_decorated_df['activity_date'] >= window_start_date) & 
+                               (dau_decorated_df['activity_date'] <= last_date),
+                               window_cols]
+                          )
     
     # Make sure the activity_date column is a datetime type
     xau['activity_date'] = pd.to_datetime(xau['activity_date'])
@@ -1062,34 +2107,23 @@ def calc_user_periodic_usage(dau_decorated_df,
     # the number of periods per user/segment. After that we just reset the 
     # index and clean up column names
     xau_grouped = (xau.merge(periods_df, on = 'activity_date', how = 'left')
-                    .groupby(['user_id', 'window_period_number', 'segment'], as_index = False)
+                    .groupby(['user_id', 'window_period_number', 'segment'], as_index = False, observed = True)
                     ['inc_amt'].sum()
-                    .groupby(['user_id', 'segment'])
+                    .groupby(['user_id', 'segment'], observed = True)
                     ['inc_amt'].agg(['count', 'sum'])
                     .reset_index()
                     .rename(columns = {'count' : active_col_name, 'sum' : 'inc_amt'})
                     )
     
-    # Breakouts allow us to see very easily which users are above the number
-    # of periods specified in the breakout list. For example, if I want to know
-    # which users are active 2+ periods and also 4+ periods, I would set
-    # breakouts = [2,4]. 
-    for b in breakouts:
-        col_name = '%s%s+ users' % (b, period_abbr)
-        xau_grouped[col_name] = (xau_grouped[active_col_name] >= b)
-        
-    # Before returning the dataframe to the calling function, sort the values
-    # in descending order of inc_amt
-    xau_grouped_sorted = xau_grouped.sort_values('inc_amt', ascending = False)  
-    
-    return xau_grouped_sorted     
+    return xau_grouped
     
 
 
 
 def calc_inc_dist(dau_decorated_df, 
                   window_days, 
-                  use_segment
+                  use_segment,
+                  activity_index = None
                   ):
     
     xau_grouped = calc_user_periodic_usage(dau_decorated_df = dau_decorated_df,
@@ -1097,18 +2131,19 @@ def calc_inc_dist(dau_decorated_df,
                                            last_date = dau_decorated_df['activity_date'].max(),
                                            window_days = window_days,
                                            breakouts = [],
-                                           use_segment = use_segment
+                                           use_segment = use_segment,
+                                           activity_index = activity_index
                                            )
     
     
     xau_grouped_sorted = xau_grouped.sort_values('inc_amt', ascending = False)  
     xau_grouped_sorted['cum_inc_amt'] = (xau_grouped_sorted
-                                          .groupby(['segment'])
+                                          .groupby(['segment'], observed = True)
                                           .agg({'inc_amt' : 'cumsum'})
                                           )
     
     total_inc_amt_df = (xau_grouped_sorted
-                        .groupby(['segment'])['inc_amt']
+                        .groupby(['segment'], observed = True)['inc_amt']
                         .agg(['sum', 'count'])
                         .reset_index()
                         .rename(columns = {'sum' : 'total_inc_amt',
@@ -1123,7 +2158,7 @@ def calc_inc_dist(dau_decorated_df,
                                                       xau_grouped_sorted.total_inc_amt)
     
     revenue_80pct_df = (xau_grouped_sorted[xau_grouped_sorted.cum_inc_amt_pct_of_total <= .80]
-                        .groupby(['segment'])['cum_inc_amt_pct_of_total']
+                        .groupby(['segment'], observed = True)['cum_inc_amt_pct_of_total']
                         .count()
                         .reset_index()
                         .rename(columns = {'cum_inc_amt_pct_of_total' : 'revenue_80pct_user_count'})
@@ -1144,7 +2179,188 @@ def calc_inc_dist(dau_decorated_df,
 
 
 
-def calc_xau_hist(dau_decorated, time_period, last_date, window_days, use_segment):
+### The inc_amt of every user active in the window of window_days days that
+### ends on last_date (the last activity_date by default), as a dataframe 
+### with the user_id, segment and inc_amt columns of calc_user_periodic_usage.
+### Only the totals are needed for revenue concentration, so the users are 
+### numbered with factorize and summed with bincount instead of grouping.
+### Like groupby, rows with a missing user_id or segment are left out.
+def calc_user_window_inc(dau_decorated_df, 
+                         window_days, 
+                         use_segment, 
+                         last_date = None
+                         ):
+    
+    day_ordinals = to_day_ordinals(dau_decorated_df['activity_date'])
+    if last_date is None:
+        last_day = day_ordinals.max() if len(day_ordinals) > 0 else 0
+    else:
+        last_day = to_day_ordinals([last_date])[0]
+    in_window = (day_ordinals > last_day - window_days) & (day_ordinals <= last_day)
+    xau = dau_decorated_df.loc[in_window]
+    
+    # The users are left in order of appearance, which saves sorting them
+    user_codes, user_labels = pd.factorize(xau['user_id'])
+    if use_segment:
+        seg_codes, seg_labels = pd.factorize(xau['segment'], sort = True)
+    else:
+        seg_codes = np.zeros(len(xau), dtype = np.int64)
+        seg_labels = pd.Index(['All'])
+    
+    keep = (user_codes >= 0) & (seg_codes >= 0)
+    user_seg = user_codes[keep].astype(np.int64) * len(seg_labels) + seg_codes[keep]
+    key_values, row_keys = np.unique(user_seg, return_inverse = True)
+    inc_amt = np.nan_to_num(xau['inc_amt'].values[keep].astype(np.float64))
+    
+    return pd.DataFrame({'user_id' : np.asarray(user_labels)[key_values // len(seg_labels)],
+                         'segment' : np.asarray(seg_labels, dtype = object)[key_values % len(seg_labels)],
+                         'inc_amt' : np.bincount(row_keys, weights = inc_amt, minlength = len(key_values))})
+
+
+
+### Revenue concentration of each segment from one value per user: how many
+### of the top users make up 80% of inc_amt, the share of inc_amt of each 
+### n_quantiles-quantile of users, the Gini coefficient and the Lorenz curve.
+### Each value can stand for several users with the same value through
+### user_weights (the quantile sketches of tvc_inc_sketch do this), else
+### every value is one user. 
+###
+### All segments are handled in one pass: a single sort by segment and 
+### inc_amt, and one cumulative sum of inc_amt and users, from which each
+### segment's running totals are taken by subtracting the sums before its
+### first row. Those give each user's point on the segment's Lorenz curve
+### (share of users, share of inc_amt, from the smallest users up), so:
+###   - the users within the top 80% of inc_amt are those whose inc_amt from
+###     them up is at most 80% of the total, as in calc_inc_dist
+###   - quantile shares are differences of the Lorenz curve at 1/n_quantiles
+###     steps, interpolated linearly between users. Quantile n_quantiles is
+###     the top one, as decile 10 is in calc_inc_dist.
+###   - the Gini coefficient is 1 minus twice the area under the curve
+###
+### Returns the concentration dataframe, one row per segment, and the Lorenz
+### curve dataframe, lorenz_points + 1 evenly spaced user shares per segment.
+def summarize_inc_concentration(inc_amt, 
+                                segments, 
+                                user_weights = None,
+                                n_quantiles = 10,
+                                lorenz_points = 100
+                                ):
+    
+    inc_amt = np.asarray(inc_amt, dtype = np.float64)
+    seg_codes, seg_labels = pd.factorize(pd.Series(segments), sort = True)
+    if user_weights is None:
+        user_weights = np.ones(len(inc_amt))
+    else:
+        user_weights = np.asarray(user_weights, dtype = np.float64)
+    
+    keep = seg_codes >= 0
+    order = np.lexsort((inc_amt[keep], seg_codes[keep]))
+    seg_codes = seg_codes[keep][order]
+    inc_amt = inc_amt[keep][order]
+    user_weights = user_weights[keep][order]
+    n_segs = len(seg_labels)
+    
+    # Running totals within each segment, from the cumulative sums over all 
+    # of them
+    seg_starts = np.searchsorted(seg_codes, np.arange(n_segs))
+    # Each value stands for user_weights users
+    seg_inc_amt = inc_amt * user_weights
+    cum_inc_amt = np.cumsum(seg_inc_amt)
+    cum_users = np.cumsum(user_weights)
+    prior_inc_amt = np.concatenate([[0.0], cum_inc_amt])[seg_starts]
+    prior_users = np.concatenate([[0.0], cum_users])[seg_starts]
+    cum_inc_amt = cum_inc_amt - prior_inc_amt[seg_codes]
+    cum_users = cum_users - prior_users[seg_codes]
+    
+    total_inc_amt = np.bincount(seg_codes, weights = seg_inc_amt, minlength = n_segs)
+    total_user_count = np.bincount(seg_codes, weights = user_weights, minlength = n_segs)
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        user_share = cum_users / total_user_count[seg_codes]
+        inc_share = cum_inc_amt / total_inc_amt[seg_codes]
+        
+        # The Lorenz curve just before each user: 0 at a segment's first
+        prev_user_share = np.concatenate([[0.0], user_share])[:-1]
+        prev_inc_share = np.concatenate([[0.0], inc_share])[:-1]
+        prev_user_share[seg_starts[seg_starts < len(seg_codes)]] = 0.0
+        prev_inc_share[seg_starts[seg_starts < len(seg_codes)]] = 0.0
+        
+        # inc_amt from each user up, as a share of the total, is 1 minus the
+        # share of the users below it
+        in_top_80pct = (1 - prev_inc_share) <= .80
+        revenue_80pct_user_count = np.bincount(seg_codes[in_top_80pct], 
+                                               weights = user_weights[in_top_80pct], 
+                                               minlength = n_segs)
+        
+        lorenz_area = np.bincount(seg_codes,
+                                  weights = (user_share - prev_user_share) * (inc_share + prev_inc_share) / 2,
+                                  minlength = n_segs)
+        
+        concentration_df = pd.DataFrame({'segment' : np.asarray(seg_labels, dtype = object),
+                                         'total_inc_amt' : total_inc_amt,
+                                         'total_user_count' : total_user_count,
+                                         'revenue_80pct_user_count' : revenue_80pct_user_count,
+                                         'revenue_80pct_ratio' : revenue_80pct_user_count / total_user_count,
+                                         'gini' : 1 - 2 * lorenz_area})
+    
+    # The Lorenz curve of each segment at evenly spaced user shares
+    lorenz_user_share = np.linspace(0, 1, lorenz_points + 1)
+    quantile_user_share = np.linspace(0, 1, n_quantiles + 1)
+    lorenz_inc_share = np.empty((n_segs, lorenz_points + 1))
+    quantile_inc_share = np.empty((n_segs, n_quantiles + 1))
+    seg_ends = np.append(seg_starts[1:], len(seg_codes))
+    for s in range(n_segs):
+        xp = np.concatenate([[0.0], user_share[seg_starts[s]:seg_ends[s]]])
+        fp = np.concatenate([[0.0], inc_share[seg_starts[s]:seg_ends[s]]])
+        lorenz_inc_share[s] = np.interp(lorenz_user_share, xp, fp)
+        quantile_inc_share[s] = np.interp(quantile_user_share, xp, fp)
+    
+    quantile_shares = np.diff(quantile_inc_share, axis = 1)
+    for q in range(n_quantiles):
+        concentration_df['quantile_%s_inc_share' % (q + 1)] = quantile_shares[:, q]
+    
+    lorenz_df = pd.DataFrame({'segment' : np.repeat(concentration_df['segment'].values, lorenz_points + 1),
+                              'user_share' : np.tile(lorenz_user_share, n_segs),
+                              'inc_share' : lorenz_inc_share.ravel()})
+    
+    return concentration_df, lorenz_df
+
+
+
+### A faster revenue concentration analysis than calc_inc_dist, per segment
+### rather than per user: the inc_amt of each user in the window (from
+### calc_user_window_inc, or from activity_index if given) summarized by
+### summarize_inc_concentration. Returns the concentration and Lorenz curve
+### dataframes. For more users than fit in memory at once, see 
+### tvc_inc_sketch.sketch_inc_concentration.
+def calc_inc_concentration(dau_decorated_df, 
+                           window_days, 
+                           use_segment,
+                           last_date = None,
+                           activity_index = None,
+                           n_quantiles = 10,
+                           lorenz_points = 100
+                           ):
+    
+    log_progress('Calculating revenue concentration')
+    
+    if activity_index is not None:
+        check_activity_index(activity_index, use_segment)
+        if last_date is None:
+            last_date = dau_decorated_df['activity_date'].max()
+        user_inc = activity_index.user_periodic_usage('day', last_date, window_days)
+    else:
+        user_inc = calc_user_window_inc(dau_decorated_df, window_days, use_segment, last_date)
+    
+    return summarize_inc_concentration(user_inc['inc_amt'].values,
+                                       user_inc['segment'].values,
+                                       n_quantiles = n_quantiles,
+                                       lorenz_points = lorenz_points)
+
+
+
+def calc_xau_hist(dau_decorated, time_period, last_date, window_days, use_segment,
+                  activity_index = None):
     
     # Call calc_user_periodic_usage, the function defined above
     xau_grouped = calc_user_periodic_usage(dau_decorated_df = dau_decorated, 
@@ -1152,7 +2368,8 @@ def calc_xau_hist(dau_decorated, time_period, last_date, window_days, use_segmen
                                            last_date = last_date, 
                                            window_days = window_days, 
                                            breakouts = [],
-                                           use_segment = use_segment
+                                           use_segment = use_segment,
+                                           activity_index = activity_index
                                            )
     
     # Define three column names based on the time period parameter
@@ -1176,7 +2393,7 @@ def calc_xau_hist(dau_decorated, time_period, last_date, window_days, use_segmen
                     #  # .sort_values(active_bin_name, ascending=True)
                     #  )
     else:
-        print(f"Column {active_col_name} not found in DataFrame.")
+        log_progress(f"Column {active_col_name} not found in DataFrame.", logging.WARNING)
         # Handle the error or raise an exception
 
     # Create a blank dataframe with bin names and zeros to handle the cases
@@ -1209,15 +2426,34 @@ def calc_xau_hist(dau_decorated, time_period, last_date, window_days, use_segmen
 
 ### The calc_engagement_ratios_for_window function runs calc_user_periodic_usage
 ### on one window, which has a length defined by window_days. It then calculates
-### summary statistics and stores them in a small dataframe just for that window
+### summary statistics and stores them in a small dataframe just for that window.
+### With user_sketches, a tvc_hll.TVCActiveUserSketches built with the same
+### use_segment, the user counts are estimated from the sketches instead (and
+### the breakouts are NaN).
 
 def calc_engagement_ratios_for_window(dau_decorated_df, 
                                       time_period, 
                                       last_date, 
                                       window_days, 
                                       breakouts, 
-                                      use_segment
+                                      use_segment,
+                                      activity_index = None,
+                                      user_sketches = None
                                       ):
+    
+    if user_sketches is not None:
+        window_counts = user_sketches.window_counts(pd.DatetimeIndex([last_date]),
+                                                    time_period,
+                                                    window_days,
+                                                    breakouts,
+                                                    use_segment)
+        xau_agg = build_window_df(*window_counts,
+                                  time_period = time_period,
+                                  window_days = window_days,
+                                  breakouts = breakouts,
+                                  use_segment = use_segment)
+        xau_agg['window_end_dt'] = last_date
+        return xau_agg
   
     # Call calc_user_periodic_usage, the function defined above
     xau_grouped = calc_user_periodic_usage(dau_decorated_df, 
@@ -1225,7 +2461,8 @@ def calc_engagement_ratios_for_window(dau_decorated_df,
                                            last_date, 
                                            window_days, 
                                            breakouts, 
-                                           use_segment)
+                                           use_segment,
+                                           activity_index)
     
   
     # These are the parameters that are set from the get_time_period_dict 
@@ -1244,7 +2481,7 @@ def calc_engagement_ratios_for_window(dau_decorated_df,
     
     # Set the grouped_df to either be ungrouped or grouped by segment
     if use_segment:
-        grouped_df = xau_grouped.groupby('segment')
+        grouped_df = xau_grouped.groupby('segment', observed = True)
     else:
         grouped_df = xau_grouped
 
@@ -1286,18 +2523,48 @@ def calc_engagement_ratios_for_window(dau_decorated_df,
 ### statistics of each window, as calculated by calc_engagement_ratios_for_window
 ### defined above. Be forewarned, it takes a few minutes to run. That's why
 ### we include progress statements periodically during the loop.
+###
+### For top-line figures over very many users, pass user_sketches, a 
+### tvc_hll.TVCActiveUserSketches built with the same use_segment: the users
+### of each window are then estimated from unions of its days' HyperLogLog 
+### sketches (about 1% error at the default precision), the breakout columns
+### are NaN, and dau_decorated_df is only used for the window end dates.
   
 def create_xau_window_df(dau_decorated_df, 
                          time_period = 'day',
                          window_days = 28, 
                          breakouts = [2, 4], 
                          use_segment = False,
-                         use_final_day = True
+                         use_final_day = True,
+                         use_incremental = False,
+                         start_dt = None,
+                         use_parallel = False,
+                         max_workers = None,
+                         user_sketches = None
                          ):
     
+    # The user sketches and the incremental engine are two different ways 
+    # of counting each window's users, so only one of them can be asked for
+    if use_incremental and user_sketches is not None:
+        raise ValueError('Pass either use_incremental = True or user_sketches, not both.')
+    
+    # The incremental engine below produces the same dataframe without
+    # re-filtering dau_decorated_df for every window, so hand off to it if
+    # requested
+    if use_incremental:
+        return create_xau_window_df_incremental(dau_decorated_df,
+                                                time_period = time_period,
+                                                window_days = window_days,
+                                                breakouts = breakouts,
+                                                use_segment = use_segment,
+                                                use_final_day = use_final_day,
+                                                start_dt = start_dt)
+
     # Set the start date as window_days after the first activity_date in the
-    # dau_decorated_df dataframe.
-    start_dt = dau_decorated_df['activity_date'].min() + timedelta(days = window_days)
+    # dau_decorated_df dataframe, unless a start date is passed in (e.g. to 
+    # only process the windows that end on or after newly arrived days).
+    if start_dt is None:
+        start_dt = dau_decorated_df['activity_date'].min() + timedelta(days = window_days)
     
     # Set the final day as either the last activity_date in the data set
     # or the next-to-last activity_date. (You may want to set use_final_day
@@ -1309,33 +2576,567 @@ def create_xau_window_df(dau_decorated_df,
         
     # Set a Pandas date_range from the start date to the end date, by day
     date_range = pd.date_range(start = start_dt, end = end_dt, freq = 'D')
-
-    # Initialize the dataframe that will house the engagement stats from every
-    # window in the loop
-    rolling_engagement_df = pd.DataFrame()
-    i = 0
     total_dates = len(date_range)
-    print(('%s total ' + time_period + 's to process...') % total_dates)
+    log_progress(('%s total ' + time_period + 's to process...') % total_dates)
+    
+    # Calculate the engagement stats of every window, either from the user
+    # sketches, here, or split into shards of dates across worker processes
+    if user_sketches is not None:
+        window_counts = user_sketches.window_counts(date_range,
+                                                    time_period,
+                                                    window_days,
+                                                    breakouts,
+                                                    use_segment)
+        rolling_engagement_df = build_window_df(*window_counts,
+                                                time_period = time_period,
+                                                window_days = window_days,
+                                                breakouts = breakouts,
+                                                use_segment = use_segment)
+    elif use_parallel:
+        rolling_engagement_df = calc_windows_in_parallel(calc_xau_windows_for_dates,
+                                                         dau_decorated_df,
+                                                         date_range,
+                                                         window_days,
+                                                         max_workers,
+                                                         time_period = time_period,
+                                                         window_days = window_days,
+                                                         breakouts = breakouts,
+                                                         use_segment = use_segment)
+    else:
+        rolling_engagement_df = calc_xau_windows_for_dates(dau_decorated_df, 
+                                                           date_range,
+                                                           time_period = time_period,
+                                                           window_days = window_days,
+                                                           breakouts = breakouts,
+                                                           use_segment = use_segment)
+    log_progress(('Finished processing all %s ' + time_period + 's!') % total_dates)
     
-    # Loop through each date in the date range, calling calc_engagement_ratios_for_window
-    # each time, storing it in the this_window dataframe, and then appending
-    # this_window to rolling_engagement_df
-    for d in date_range:
+    # Make sure the window_end_dt field is a Pandas datetime
+    rolling_engagement_df['window_end_dt'] = pd.to_datetime(rolling_engagement_df['window_end_dt'])
+    
+    return rolling_engagement_df
+
+
+
+
+### Loops through each date in date_range, calling calc_engagement_ratios_for_window
+### each time, and concatenates the windows once at the end
+def calc_xau_windows_for_dates(dau_decorated_df, 
+                               date_range,
+                               time_period = 'day',
+                               window_days = 28, 
+                               breakouts = [2, 4], 
+                               use_segment = False):
+    
+    windows = []
+    total_dates = len(date_range)
+    for i, d in enumerate(date_range):
         if i % 100 == 0:
-          print(('Processing ' + time_period + ' %s of %s...') % (i, total_dates))
+          log_progress(('Processing ' + time_period + ' %s of %s...') % (i, total_dates), logging.DEBUG)
       
         d2 = d.date()
-        this_window = calc_engagement_ratios_for_window(dau_decorated_df, 
-                                                    time_period = time_period,
-                                                    last_date = d2, 
-                                                    window_days = window_days, 
-                                                    breakouts = breakouts,
-                                                    use_segment = use_segment)
-        rolling_engagement_df = pd.concat([rolling_engagement_df, this_window])
-        i+=1
-    print(('Finished processing all %s ' + time_period + 's!') % total_dates)
+        windows.append(calc_engagement_ratios_for_window(dau_decorated_df, 
+                                                         time_period = time_period,
+                                                         last_date = d2, 
+                                                         window_days = window_days, 
+                                                         breakouts = breakouts,
+                                                         use_segment = use_segment))
     
-    # Make sure the window_end_dt field is a Pandas datetime
-    rolling_engagement_df['window_end_dt'] = pd.to_datetime(rolling_engagement_df['window_end_dt'])
+    return concat_windows(windows)
+
+
+
+
+### Helper for create_xau_window_df_incremental. Adds (step = 1) or removes 
+### (step = -1) one day of DAU rows to or from the running window counters. 
+### day_counts holds, for each user key, the number of active days the user 
+### has in each period of the window. A user's number of active periods only 
+### changes when one of those day counts moves between zero and one, and when
+### it does we move the user to the right bin of the per-segment histogram.
+def update_window_counters(day, slot, step, day_bounds, row_keys, key_seg,
+                           day_counts, active_periods, hist):
+    
+    # Days before the first or after the last activity_date have no users
+    if day < 0 or day >= len(day_bounds) - 1:
+        return
+    
+    keys = row_keys[day_bounds[day]:day_bounds[day + 1]]
+    before = day_counts[keys, slot]
+    day_counts[keys, slot] = before + step
+    
+    if step > 0:
+        changed = keys[before == 0]
+    else:
+        changed = keys[before == 1]
+    
+    np.subtract.at(hist, (key_seg[changed], active_periods[changed]), 1)
+    active_periods[changed] += step
+    np.add.at(hist, (key_seg[changed], active_periods[changed]), 1)
+
+
+
+
+### The create_xau_window_df_incremental function returns the same dataframe 
+### as create_xau_window_df, but rather than re-filtering and re-grouping
+### dau_decorated_df for every window, it slides the window forward, adding
+### the users of the days entering the window and dropping the users of the
+### days leaving it. Each window is then summarized from a histogram of
+### active periods per segment, so a run takes time proportional to the
+### number of DAU rows instead of days x rows.
+###
+### calc_user_periodic_usage numbers the periods of a window from the window's
+### first day, so a week (or 28-day month) starts on a different weekday for
+### each window end date. Windows whose first days are a whole number of
+### periods apart do share period boundaries, though, so we slide through
+### those windows together: one pass per day of the period, stepping
+### period_days days at a time. For time_period = 'day' that is a single pass.
+
+def create_xau_window_df_incremental(dau_decorated_df, 
+                                     time_period = 'day',
+                                     window_days = 28, 
+                                     breakouts = [2, 4], 
+                                     use_segment = False,
+                                     use_final_day = True,
+                                     start_dt = None
+                                     ):
+    
+    window_counts = calc_window_counts(dau_decorated_df, 
+                                       time_period = time_period,
+                                       window_days = window_days,
+                                       breakouts = breakouts,
+                                       use_segment = use_segment,
+                                       use_final_day = use_final_day,
+                                       start_dt = start_dt)
+    rolling_engagement_df = build_window_df(*window_counts, 
+                                            time_period = time_period,
+                                            window_days = window_days,
+                                            breakouts = breakouts,
+                                            use_segment = use_segment)
+    log_progress(('Finished processing all %s ' + time_period + 's!') % len(window_counts[0]))
+    
+    return rolling_engagement_df
+
+
+
+
+### The sliding part of create_xau_window_df_incremental. Returns the window 
+### end dates, the segment labels, and arrays with the active periods, users
+### and breakout users of every window (rows) and segment (columns).
+def calc_window_counts(dau_decorated_df, 
+                       time_period = 'day',
+                       window_days = 28, 
+                       breakouts = [2, 4], 
+                       use_segment = False,
+                       use_final_day = True,
+                       start_dt = None
+                       ):
+    
+    # These are the parameters that are set from the get_time_period_dict 
+    # function above, in the same way as calc_engagement_ratios_for_window
+    time_fields = get_time_period_dict(time_period)
+    if time_fields is None:
+        period_days = 1
+    else:
+        period_days = time_fields['days']
+    
+    # The number of periods that fit in a window, counting a partial last one
+    n_periods = (window_days - 1) // period_days + 1
+    
+    # Same window end dates as create_xau_window_df
+    if start_dt is None:
+        start_dt = dau_decorated_df['activity_date'].min() + timedelta(days = window_days)
+    if use_final_day:
+        end_dt = dau_decorated_df['activity_date'].max()
+    else:
+        end_dt = dau_decorated_df['activity_date'].max() - timedelta(days = 1)
+    
+    date_range = pd.date_range(start = start_dt, end = end_dt, freq = 'D')
+    total_dates = len(date_range)
+    log_progress(('%s total ' + time_period + 's to process...') % total_dates)
+    
+    # Encode the days, users and segments as integers
+    days, row_keys, key_seg, seg_labels = encode_dau_keys(dau_decorated_df, 
+                                                          use_segment)[:4]
+    first_day = dau_decorated_df['activity_date'].min()
+    n_days = (pd.Timestamp(dau_decorated_df['activity_date'].max()) - pd.Timestamp(first_day)).days + 1
+    n_segs = len(seg_labels)
+    n_keys = len(key_seg)
+    
+    # Keep one row per user key and day, sorted by day, and note where each
+    # day's rows start and end
+    day_keys = np.unique(days * n_keys + row_keys)
+    row_days = day_keys // n_keys
+    row_keys = day_keys % n_keys
+    day_bounds = np.searchsorted(row_days, np.arange(n_days + 1))
+    
+    # The running counters. day_counts has one column per period of the
+    # window plus one spare, so that the period entering the window never
+    # shares a column with a period that is still in it. hist counts the users
+    # of each segment by their number of active periods.
+    n_slots = n_periods + 1
+    day_counts = np.zeros((n_keys, n_slots), dtype = np.int32)
+    active_periods = np.zeros(n_keys, dtype = np.int64)
+    hist = np.zeros((n_segs, n_periods + 1), dtype = np.int64)
+    
+    # Arrays to collect the figures of every window and segment
+    active_by_seg = np.zeros((total_dates, n_segs), dtype = np.int64)
+    users_by_seg = np.zeros((total_dates, n_segs), dtype = np.int64)
+    breakouts_by_seg = np.zeros((len(breakouts), total_dates, n_segs), dtype = np.int64)
+    period_numbers = np.arange(1, n_periods + 1)
+    
+    if total_dates > 0:
+        first_window_start = (date_range[0] - pd.Timestamp(first_day)).days - window_days + 1
+    
+    for offset in range(min(period_days, total_dates)):
+        day_counts[:] = 0
+        active_periods[:] = 0
+        hist[:] = 0
+        pass_start = first_window_start + offset
+        
+        for i in range(offset, total_dates, period_days):
+            window_start = first_window_start + i
+            
+            # The first window of a pass is filled from scratch. After that,
+            # drop the days of the previous window that are not in this one
+            # and add the days of this window that were not in the previous
+            if i == offset:
+                leaving = range(0)
+                entering = range(window_start, window_start + window_days)
+            else:
+                prev_start = window_start - period_days
+                leaving = range(prev_start, min(window_start, prev_start + window_days))
+                entering = range(max(window_start, prev_start + window_days), 
+                                 window_start + window_days)
+            
+            for step, day_list in [(-1, leaving), (1, entering)]:
+                for d in day_list:
+                    slot = ((d - pass_start) // period_days) % n_slots
+                    update_window_counters(d, slot, step, day_bounds, row_keys, 
+                                           key_seg, day_counts, active_periods, 
+                                           hist)
+            
+            # Summarize the window from the histogram (column 0 holds the 
+            # users with no active periods, who are not in the window)
+            users_by_seg[i] = hist[:, 1:].sum(axis = 1)
+            active_by_seg[i] = hist[:, 1:] @ period_numbers
+            for k, b in enumerate(breakouts):
+                breakouts_by_seg[k, i] = hist[:, max(int(math.ceil(b)), 1):].sum(axis = 1)
+    
+    return date_range, seg_labels, active_by_seg, users_by_seg, breakouts_by_seg
+
+
+
+
+### Builds the create_xau_window_df dataframe from the output of 
+### calc_window_counts: one row per window, or one row per window and segment
+### with users in it
+def build_window_df(date_range, 
+                    seg_labels, 
+                    active_by_seg, 
+                    users_by_seg, 
+                    breakouts_by_seg,
+                    time_period = 'day',
+                    window_days = 28, 
+                    breakouts = [2, 4], 
+                    use_segment = False):
+    
+    time_fields = get_time_period_dict(time_period)
+    period_abbr = time_period[0]
+    active_col_name = 'active_' + time_period + 's'
+    if time_fields is None:
+        period_days = 1
+    else:
+        period_days = time_fields['days']
+    total_users_col = '1' + period_abbr + '+ users'
+    total_dates = len(date_range)
+    
+    # Pick out one row per window, or one row per window and segment with
+    # users in it, in the order create_xau_window_df produces them
+    if use_segment:
+        window_idx, seg_idx = np.nonzero(users_by_seg > 0)
+        row_index = pd.Series(window_idx).groupby(window_idx).cumcount().values
+        first_col = {'segment' : np.asarray(seg_labels, dtype = object)[seg_idx]}
+    else:
+        window_idx = np.arange(total_dates)
+        seg_idx = np.zeros(total_dates, dtype = np.int64)
+        row_index = np.zeros(total_dates, dtype = np.int64)
+        first_col = {'index' : row_index}
+    
+    rolling_engagement_df = pd.DataFrame(first_col, index = row_index)
+    rolling_engagement_df[active_col_name] = active_by_seg[window_idx, seg_idx]
+    rolling_engagement_df[total_users_col] = users_by_seg[window_idx, seg_idx]
+    rolling_engagement_df[period_abbr + 'au_window_ratio'] = (rolling_engagement_df[active_col_name] / (window_days/period_days)) / rolling_engagement_df[total_users_col]
+    rolling_engagement_df['window_frequency'] = rolling_engagement_df[period_abbr + 'au_window_ratio'] * (window_days/period_days)
+    
+    for k, b in enumerate(breakouts):
+        col_name = '%s%s+ users' % (b, period_abbr)
+        rolling_engagement_df[col_name] = breakouts_by_seg[k, window_idx, seg_idx]
+        ratio_col_name = '%s%s+ users / total %sd users' % (b, period_abbr, window_days)
+        rolling_engagement_df[ratio_col_name] = rolling_engagement_df[col_name] / rolling_engagement_df[total_users_col]
+    
+    rolling_engagement_df['window_end_dt'] = date_range[window_idx]
     
     return rolling_engagement_df
+
+
+
+
+### The functions below compute several segmentations of the same data (for
+### example 'Unsegmented', 'Channel' and 'Country') in one pass, instead of
+### running the whole pipeline once per segmentation. A segmentations dict 
+### maps each segmentation name to its segment column, or to None for the 
+### unsegmented figures, e.g. {'Unsegmented' : None, 'Channel' : 'channel'}.
+###
+### The DAU dataframe is built once with all the segment columns (pass the
+### list of them as segment_col to create_dau_df). The first_dt table is also
+### built once, from every user's activity. Then the DAU rows of every 
+### segmentation are stacked into one DAU Decorated dataframe whose 'segment' 
+### column holds the segmentation name and the segment together, so that the
+### xAU decoration, growth accounting, cohorts and rolling windows each run 
+### once over all the segmentations with use_segment = True. The results are
+### split back up by segmentation and returned with a 'segmentation' column.
+
+SEGMENTATION_SEP = '\x1f'
+
+
+### Splits the combined segmentation and segment labels back into the
+### segmentation names and the segments
+def split_segmentation_labels(labels):
+    
+    parts = pd.Series(labels, dtype = 'str').str.split(SEGMENTATION_SEP, n = 1, expand = True)
+    
+    return parts[0], parts[1]
+
+
+
+### Builds the stacked DAU Decorated dataframe for all the segmentations from
+### a DAU dataframe that has all of their segment columns
+def create_multi_segment_dau_decorated_df(dau_df, segmentations, first_dt_df = None):
+    log_progress('Creating multi-segment DAU Decorated dataframe')
+    
+    for name in segmentations:
+        if SEGMENTATION_SEP in name:
+            raise ValueError('Segmentation names cannot contain the separator %r.' % SEGMENTATION_SEP)
+    
+    # The unsegmented DAU rows: one per user and day, whatever their segments
+    dau_all = (dau_df.groupby(['user_id', 'activity_date'], as_index = False)
+               .agg({'inc_amt' : 'sum'}))
+    
+    # If no first_dt_df is provided, create it from every user's activity
+    all_first_dt_df = first_dt_df
+    if all_first_dt_df is None:
+        all_first_dt_df = create_first_dt_df(dau_all)
+    
+    # Stack one copy of the DAU rows per segmentation, with the segmentation
+    # name in front of the segment. Compact categorical segment columns stay
+    # categorical, with the segmentation name put in front of each category.
+    # The rows with no segment in a segmentation are left out of it (they
+    # only count in the unsegmented rows), so that segmentation's users are
+    # dated from their rows that do have a segment, as they would be on 
+    # their own.
+    compact = any(isinstance(dau_df[c].dtype, pd.CategoricalDtype) 
+                  for c in segmentations.values() if c is not None)
+    stacked = []
+    for name, segment_col in segmentations.items():
+        seg_first_dt_df = all_first_dt_df
+        if segment_col is None:
+            seg_dau = dau_all.assign(segment = name + SEGMENTATION_SEP + 'All')
+        else:
+            seg_dau = (dau_df.groupby(['user_id', 'activity_date', segment_col], as_index = False, observed = True)
+                       .agg({'inc_amt' : 'sum'})
+                       .rename(columns = {segment_col : 'segment'}))
+            if first_dt_df is None and dau_df[segment_col].isna().any():
+                seg_first_dt_df = create_first_dt_df(seg_dau)
+            if isinstance(seg_dau['segment'].dtype, pd.CategoricalDtype):
+                categories = seg_dau['segment'].cat.categories.astype('str')
+                seg_dau['segment'] = seg_dau['segment'].cat.rename_categories(name + SEGMENTATION_SEP + categories)
+            else:
+                seg_dau['segment'] = name + SEGMENTATION_SEP + seg_dau['segment'].astype('str')
+        if compact:
+            seg_dau['segment'] = seg_dau['segment'].astype('category')
+        stacked.append((seg_dau, seg_first_dt_df))
+    
+    if compact:
+        unify_categories([seg_dau for seg_dau, _ in stacked], ['segment'])
+    
+    return pd.concat([create_dau_decorated_df(seg_dau, seg_first_dt_df) 
+                      for seg_dau, seg_first_dt_df in stacked],
+                     ignore_index = True)
+
+
+
+### Stacks the result dataframes of the segmentations ({segmentation name : 
+### dataframe}) into one, with a 'segmentation' column in front. Each 
+### segmentation's own columns, in their own order, are kept in the stacked
+### dataframe's attrs for split_segmentation_dfs.
+def stack_segmentation_dfs(seg_dfs, ignore_index = True):
+    
+    stacked = pd.concat([seg_df.assign(segmentation = name)
+                         .reindex(columns = ['segmentation'] + list(seg_df.columns))
+                         for name, seg_df in seg_dfs.items()],
+                        ignore_index = ignore_index)
+    stacked.attrs['segmentation_columns'] = {name : list(seg_df.columns) 
+                                             for name, seg_df in seg_dfs.items()}
+    
+    return stacked
+
+
+
+### Yields (segmentation name, dataframe) for each segmentation of a result
+### of stack_segmentation_dfs, each with just its own columns. If the 
+### stacked dataframe has lost its attrs, an unsegmented segmentation's 
+### dataframe just drops the segment column.
+def split_segmentation_dfs(stacked_df, segmentations):
+    
+    seg_columns = stacked_df.attrs.get('segmentation_columns', {})
+    for name, segment_col in segmentations.items():
+        seg_df = stacked_df[stacked_df['segmentation'] == name].drop(columns = ['segmentation'])
+        if name in seg_columns:
+            seg_df = seg_df.reindex(columns = seg_columns[name])
+        elif segment_col is None and 'segment' in seg_df.columns:
+            seg_df = seg_df.drop(columns = ['segment'])
+        yield name, seg_df
+
+
+
+### Returns the rows of df that belong to one segmentation, with the 
+### segmentation name taken off the segment column, or with no segment 
+### column at all for an unsegmented segmentation
+def select_segmentation_rows(df, name, segment_col, seg_names, segments):
+    
+    is_this_seg = (seg_names == name).values
+    seg_df = df[is_this_seg].reset_index(drop = True)
+    if segment_col is None:
+        seg_df = seg_df.drop(columns = ['segment'])
+    else:
+        seg_df['segment'] = segments.values[is_this_seg]
+    
+    return seg_df
+
+
+
+### consolidate_all_ga for every segmentation of a stacked xAU Decorated 
+### dataframe (built with create_xau_decorated_df(..., use_segment = True)
+### from the output of create_multi_segment_dau_decorated_df)
+def consolidate_all_ga_multi_segment(xau_decorated_df, 
+                                     time_period, 
+                                     segmentations,
+                                     growth_rate_periods = 12, 
+                                     keep_last_period = True, 
+                                     date_limit = None, 
+                                     add_hours = False,
+                                     include_zero_inc = False,
+                                     use_standard_col_names = True):
+    
+    # The growth accounting sums for all the segmentations in one pass. The
+    # options that drop rows are applied per segmentation below, so each
+    # segmentation's rows are numbered as they would be on their own.
+    user_xga, rev_xga = calc_growth_accounting_base(xau_decorated_df, time_period, 
+                                                    use_segment = True,
+                                                    use_vectorized = True)
+    user_seg_names, user_segments = split_segmentation_labels(user_xga['segment'])
+    rev_seg_names, rev_segments = split_segmentation_labels(rev_xga['segment'])
+    
+    all_ga_dfs = {}
+    for name, segment_col in segmentations.items():
+        use_segment = segment_col is not None
+        user_ga, rev_ga = finish_growth_accounting_dfs(select_segmentation_rows(user_xga, name, segment_col, 
+                                                                                user_seg_names, user_segments),
+                                                       select_segmentation_rows(rev_xga, name, segment_col, 
+                                                                                rev_seg_names, rev_segments),
+                                                       time_period, keep_last_period, date_limit, 
+                                                       add_hours, include_zero_inc)
+        all_ga_df = consolidate_ga_with_ratios(user_ga, rev_ga, time_period, use_segment,
+                                               growth_rate_periods, use_standard_col_names,
+                                               use_vectorized = True)
+        all_ga_dfs[name] = all_ga_df
+    
+    return stack_segmentation_dfs(all_ga_dfs)
+
+
+
+### create_xau_cohort_df for every segmentation of a stacked xAU Decorated 
+### dataframe
+def create_xau_cohort_df_multi_segment(xau_decorated_df, 
+                                       time_period, 
+                                       segmentations,
+                                       recent_periods_back_to_exclude = 1, 
+                                       create_period_n_inc_cols = False,
+                                       date_limit = None,
+                                       add_hours = False,
+                                       use_standard_col_names = False):
+    
+    time_fields = get_time_period_dict(time_period)
+    grouping_col = time_fields['grouping_col']
+    period_abbr = time_fields['period_abbr']
+    
+    if date_limit is not None:
+        xau_decorated_df = xau_decorated_df[pd.PeriodIndex(xau_decorated_df[grouping_col], 
+                                                           freq = period_abbr)
+                                            .start_time <= date_limit]
+    
+    # The cohort sums for all the segmentations in one pass
+    cohort_base = calc_xau_cohort_base(xau_decorated_df, time_period, use_segment = True)
+    seg_names, segments = split_segmentation_labels(cohort_base.index.get_level_values('segment'))
+    
+    cohort_dfs = {}
+    for name, segment_col in segmentations.items():
+        is_this_seg = (seg_names == name).values
+        seg_base = cohort_base[is_this_seg]
+        if segment_col is None:
+            seg_base = seg_base.droplevel('segment')
+        else:
+            seg_index = seg_base.index.remove_unused_levels()
+            seg_levels = split_segmentation_labels(seg_index.levels[-1])[1]
+            seg_base.index = seg_index.set_levels(seg_levels.values, level = 'segment')
+        cohort_df = finish_xau_cohort_df(copy_unless_cow(seg_base), 
+                                         time_period, 
+                                         segment_col is not None,
+                                         recent_periods_back_to_exclude,
+                                         create_period_n_inc_cols,
+                                         add_hours,
+                                         use_standard_col_names)
+        cohort_dfs[name] = cohort_df
+    
+    return stack_segmentation_dfs(cohort_dfs)
+
+
+
+### create_xau_window_df (with use_incremental = True) for every segmentation
+### of a stacked DAU Decorated dataframe
+def create_xau_window_df_multi_segment(dau_decorated_df, 
+                                       segmentations,
+                                       time_period = 'day',
+                                       window_days = 28, 
+                                       breakouts = [2, 4], 
+                                       use_final_day = True):
+    
+    # The window counts for all the segmentations in one pass
+    date_range, seg_labels, active_by_seg, users_by_seg, breakouts_by_seg = \
+        calc_window_counts(dau_decorated_df, 
+                           time_period = time_period,
+                           window_days = window_days,
+                           breakouts = breakouts,
+                           use_segment = True,
+                           use_final_day = use_final_day)
+    seg_names, segments = split_segmentation_labels(seg_labels)
+    
+    window_dfs = {}
+    for name, segment_col in segmentations.items():
+        seg_idx = np.nonzero((seg_names == name).values)[0]
+        if segment_col is None:
+            # An unsegmented segmentation has a single segment, 'All'
+            seg_idx = seg_idx[:1]
+        window_df = build_window_df(date_range, 
+                                    segments.values[seg_idx],
+                                    active_by_seg[:, seg_idx], 
+                                    users_by_seg[:, seg_idx], 
+                                    breakouts_by_seg[:, :, seg_idx],
+                                    time_period = time_period,
+                                    window_days = window_days,
+                                    breakouts = breakouts,
+                                    use_segment = segment_col is not None)
+        window_dfs[name] = window_df
+    log_progress(('Finished processing all %s ' + time_period + 's!') % len(date_range))
+    
+    return stack_segmentation_dfs(window_dfs, ignore_index = False)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+### Uploads dataframes to Google Sheets in the background, so that a
+### pipeline can keep computing while its results are written, and several
+### worksheets are written at the same time. Each submitted dataframe is
+### uploaded by a thread of a bounded pool, through the TVCLoad it is given:
+### only the blocks of rows that changed since the last upload are written
+### (see TVCLoad.flush), in requests of at most max_batch_cells cells, so a
+### very large dataframe is written in several range writes.
+###
+### Every request waits for a token from a token bucket that refills at
+### requests_per_minute, so the uploads stay within the Sheets API quota
+### (by default 60 write requests per minute per user). A request that is
+### refused anyway for being over quota (HTTP 429), or that fails with a
+### temporary server error, is retried after an exponentially growing,
+### jittered delay, up to max_retries times.
+###
+###   with TVCUploader(tvcl, requests_per_minute = 60) as uploader:
+###       for stage_name, result in tvcpar.run_stages(stages, inputs):
+###           uploader.submit(result, stage_name, GOOGLE_SPREADSHEET_KEY)
+###
+### Leaving the with block waits for every upload to finish, raises the
+### first error if any failed, and saves the block hashes. The uploads can be
+### tried out offline with a tvc_fake_gspread.FakeClient, which can add
+### latency and refuse requests with 429 errors.
+
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import tvc_load_service_account as tvcload
+import tvc_transform as tvct
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+### Hands out requests_per_minute tokens per minute, with up to burst of
+### them at once. acquire reserves the next token and sleeps until it is
+### due, so waiting threads are served in the order they asked.
+class TVCTokenBucket:
+    def __init__(self, requests_per_minute = 60, burst = 5):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+
+    def acquire(self):
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+
+class TVCUploader:
+    def __init__(self,
+                 tvcl,
+                 max_workers = 4,
+                 requests_per_minute = 60,
+                 burst = 5,
+                 max_retries = 6,
+                 backoff_seconds = 1.0,
+                 max_backoff_seconds = 64.0,
+                 max_batch_cells = 50000,
+                 only_changed = True):
+
+        self.tvcl = tvcl
+        self.bucket = TVCTokenBucket(requests_per_minute, burst)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_batch_cells = max_batch_cells
+        self.only_changed = only_changed
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.futures = []
+        self.n_retries = 0
+
+        # The TVCLoad dictionaries are shared by the threads, and only 
+        # looked up and updated under lock, never while a request is made.
+        # Each spreadsheet is opened by one upload at a time, and each 
+        # worksheet is written by one upload at a time.
+        self.lock = threading.Lock()
+        self.spreadsheet_locks = {}
+        self.worksheet_locks = {}
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not start the uploads that have not started yet, but let
+            # the running ones finish so the sheets are not left half written
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait = True)
+            self.tvcl.write_block_hashes()
+        return False
+
+
+
+    ### Starts uploading dataframe to the worksheet, and returns the Future
+    ### of the upload. The dataframe is converted to cell values right away,
+    ### so it can be changed or freed once this returns.
+    def submit(self, dataframe, worksheet_name, spreadsheet_key):
+
+        values = tvcload.dataframe_to_values(dataframe)
+        future = self.executor.submit(self.upload, values, worksheet_name, spreadsheet_key)
+        self.futures.append(future)
+
+        return future
+
+
+
+    ### Waits for every upload submitted so far, saves the block hashes, and
+    ### raises the error of the first upload that failed, if any
+    def wait(self):
+
+        wait(self.futures)
+        self.tvcl.write_block_hashes()
+        futures = self.futures
+        self.futures = []
+
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                raise error
+
+
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+
+    def upload(self, values, worksheet_name, spreadsheet_key):
+
+        key = self.tvcl.hash_key(spreadsheet_key, worksheet_name)
+        with self.lock:
+            spreadsheet_lock = self.spreadsheet_locks.setdefault(spreadsheet_key, threading.Lock())
+            worksheet_lock = self.worksheet_locks.setdefault(key, threading.Lock())
+
+        with worksheet_lock:
+            # Opening the spreadsheet and adding the worksheet are requests
+            # too, made the first time they are needed. As in 
+            # TVCLoad.get_spreadsheet, the spreadsheet is only kept once its
+            # worksheets are listed too.
+            with spreadsheet_lock:
+                with self.lock:
+                    sh = self.tvcl.spreadsheets.get(spreadsheet_key)
+                if sh is None:
+                    sh = self.call(self.tvcl.gc.open_by_key, spreadsheet_key)
+                    worksheets = {ws.title : ws for ws in self.call(sh.worksheets)}
+                    with self.lock:
+                        self.tvcl.spreadsheets[spreadsheet_key] = sh
+                        self.tvcl.worksheets[spreadsheet_key] = worksheets
+
+            with self.lock:
+                has_worksheet = worksheet_name in self.tvcl.worksheets[spreadsheet_key]
+            if not has_worksheet:
+                ws = self.call(sh.add_worksheet, worksheet_name, "1", "1")
+                with self.lock:
+                    self.tvcl.worksheets[spreadsheet_key][worksheet_name] = ws
+
+            resize_request, value_ranges, block_hashes = self.tvcl.worksheet_updates(spreadsheet_key,
+                                                                                     worksheet_name,
+                                                                                     values,
+                                                                                     self.only_changed)
+
+            try:
+                if resize_request is not None:
+                    self.call(sh.batch_update, {'requests' : [resize_request]})
+                for batch in tvcload.batch_value_ranges(value_ranges, self.max_batch_cells):
+                    self.call(sh.values_batch_update, {'valueInputOption' : 'USER_ENTERED',
+                                                       'data' : batch})
+            except Exception:
+                # The sheet may be partly written, so forget its hashes and
+                # write all of it next time
+                with self.lock:
+                    self.tvcl.block_hashes.pop(key, None)
+                raise
+            with self.lock:
+                self.tvcl.block_hashes[key] = block_hashes
+
+        tvct.log_progress('Uploaded worksheet %s (%s ranges)' % (worksheet_name, len(value_ranges)))
+
+
+
+    ### Makes one request, waiting for a token first, and retries it with
+    ### exponential backoff if it is refused for being over quota or fails
+    ### with a temporary server error
+    def call(self, function, *args):
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return function(*args)
+            except Exception as error:
+                status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+                if status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    raise
+
+            delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt)
+            with self.lock:
+                self.n_retries += 1
+            time.sleep(delay * random.uniform(0.5, 1.0))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+### The modules in python/ import each other by name, as the notebooks and
+### servbiz_example_pipeline.py do from that directory, so the tests put it
+### on the path. The ServBiz sample is small enough to run everything on.
+
+import os
+import sys
+import pandas as pd
+import pytest
+
+PYTHON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python')
+DATA_DIR = os.path.join(os.path.dirname(PYTHON_DIR), 'data')
+sys.path.insert(0, PYTHON_DIR)
+
+SERVBIZ_COLUMNS = {'user_id' : 'client_id',
+                   'activity_date' : 'date',
+                   'inc_amt' : 'value_usd',
+                   'segment_col' : 'segment'}
+
+
+@pytest.fixture(scope = 'session')
+def servbiz_transactions():
+    return pd.read_csv(os.path.join(DATA_DIR, 'ServBiz_transactions_sample.csv'))
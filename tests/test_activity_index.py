@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+### The engagement functions must give the same results from a
+### TVCActivityIndex as from the dataframe, and refuse an index built with a
+### different use_segment than the call
+
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_activity_index as tvcai
+from conftest import SERVBIZ_COLUMNS
+
+
+@pytest.fixture(scope = 'module')
+def dau_decorated(servbiz_transactions):
+    return tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+
+
+@pytest.mark.parametrize('use_segment', [False, True])
+def test_index_matches_dataframe(dau_decorated, use_segment):
+
+    activity_index = tvcai.TVCActivityIndex(dau_decorated, use_segment = use_segment)
+    last_date = dau_decorated['activity_date'].max()
+    expected = tvct.calc_xau_hist(dau_decorated, 'week', last_date, 28, use_segment)
+    hist = tvct.calc_xau_hist(dau_decorated, 'week', last_date, 28, use_segment,
+                              activity_index = activity_index)
+
+    pd.testing.assert_frame_equal(hist, expected, check_dtype = False)
+
+
+def test_rejects_index_with_other_use_segment(dau_decorated):
+
+    activity_index = tvcai.TVCActivityIndex(dau_decorated, use_segment = False)
+    last_date = dau_decorated['activity_date'].max()
+    with pytest.raises(ValueError):
+        tvct.calc_xau_hist(dau_decorated, 'day', last_date, 28, True, activity_index = activity_index)
+    with pytest.raises(ValueError):
+        tvct.calc_inc_concentration(dau_decorated, 28, True, activity_index = activity_index)
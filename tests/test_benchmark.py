@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+### The benchmark harness must time each stage several times after a
+### warm-up, record the spread, and only report a regression when the new
+### times are out of the old ones' spread
+
+import copy
+import tvc_benchmark as tvcb
+
+
+def test_records_repeated_times():
+
+    results = tvcb.run_benchmarks([2000], stages = ['create_dau_df', 'create_dau_decorated_df'],
+                                  repeat = 3, profile_memory = False)
+
+    assert results['repeat'] == 3
+    for result in results['results']:
+        assert len(result['times']) == 3
+        assert result['seconds'] == min(result['times'])
+        assert result['seconds'] <= result['seconds_median'] <= result['seconds_max']
+
+
+def make_results(times):
+    return {'results' : [{'n_events' : 1000, 'stage' : 'create_dau_df', 'seconds' : min(times),
+                          'seconds_median' : sorted(times)[len(times) // 2], 'seconds_max' : max(times),
+                          'times' : times, 'peak_memory_mb' : 10.0}]}
+
+
+def test_noise_is_not_a_regression():
+
+    old_results = make_results([1.0, 1.2, 1.1])
+
+    # 15% slower at best, but within the spread of the old runs
+    noisy = tvcb.compare_results(old_results, make_results([1.15, 1.18, 1.3]))
+    assert not noisy['regression'].any()
+
+    slower = tvcb.compare_results(old_results, make_results([1.5, 1.6, 1.55]))
+    assert slower['regression'].all()
+
+    bigger_results = copy.deepcopy(old_results)
+    bigger_results['results'][0]['peak_memory_mb'] = 12.0
+    assert tvcb.compare_results(old_results, bigger_results)['regression'].all()
+
+
+def test_compares_results_from_single_runs():
+
+    old_results = make_results([1.0])
+    del old_results['results'][0]['seconds_max']
+
+    comparison = tvcb.compare_results(old_results, make_results([1.05, 1.2, 1.1]))
+    assert not comparison['regression'].any()
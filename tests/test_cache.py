@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+### TVCCache must give back the dataframes create_dau_df and
+### create_dau_decorated_df build, in both file formats, serve them from disk
+### while the source and the parameters stay the same, and rebuild them when
+### either changes. A URL source is fingerprinted from its headers, without
+### downloading it.
+
+import os
+import shutil
+import threading
+import functools
+import http.server
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_cache as tvccache
+from conftest import DATA_DIR, SERVBIZ_COLUMNS
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / 'transactions.csv')
+    shutil.copy(os.path.join(DATA_DIR, 'ServBiz_transactions_sample.csv'), path)
+    return path
+
+
+### Counts the DAU dataframes built from the source, as opposed to read
+### from the cache
+@pytest.fixture
+def n_builds(monkeypatch):
+    builds = []
+    create_dau_df_from_csv = tvct.create_dau_df_from_csv
+
+    def counting_create_dau_df_from_csv(*args, **kwargs):
+        builds.append(args)
+        return create_dau_df_from_csv(*args, **kwargs)
+
+    monkeypatch.setattr(tvct, 'create_dau_df_from_csv', counting_create_dau_df_from_csv)
+    return builds
+
+
+@pytest.mark.parametrize('file_format', ['feather', 'parquet'])
+@pytest.mark.parametrize('compact_dtypes', [False, True])
+def test_round_trip(source, tmp_path, n_builds, file_format, compact_dtypes):
+
+    expected_dau = tvct.create_dau_df(pd.read_csv(source), compact_dtypes = compact_dtypes,
+                                      **SERVBIZ_COLUMNS)
+    if compact_dtypes:
+        expected_dau, expected_lookup = expected_dau
+    expected_dau_decorated = tvct.create_dau_decorated_df(expected_dau)
+
+    tvcc = tvccache.TVCCache(str(tmp_path / 'cache'), file_format = file_format)
+    for run in range(2):
+        dau = tvcc.get_dau_df(source, compact_dtypes = compact_dtypes, **SERVBIZ_COLUMNS)
+        dau_decorated = tvcc.get_dau_decorated_df(source, compact_dtypes = compact_dtypes,
+                                                  **SERVBIZ_COLUMNS)
+        if compact_dtypes:
+            dau, user_id_lookup = dau
+            dau_decorated, decorated_lookup = dau_decorated
+            assert list(user_id_lookup) == list(expected_lookup)
+            assert list(decorated_lookup) == list(expected_lookup)
+
+        pd.testing.assert_frame_equal(dau, expected_dau, check_categorical = False)
+        pd.testing.assert_frame_equal(dau_decorated, expected_dau_decorated, check_categorical = False)
+
+    # Only the first run built anything
+    assert len(n_builds) == 1
+
+
+def test_hit_is_read_from_disk(source, tmp_path, n_builds):
+
+    tvcc = tvccache.TVCCache(str(tmp_path / 'cache'))
+    dau_decorated = tvcc.get_dau_decorated_df(source, **SERVBIZ_COLUMNS)
+    cached_files = sorted(os.listdir(str(tmp_path / 'cache')))
+
+    # A new cache object, as a new run would make, finds the files
+    cached = tvccache.TVCCache(str(tmp_path / 'cache')).get_dau_decorated_df(source, **SERVBIZ_COLUMNS)
+
+    assert len(n_builds) == 1
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == cached_files
+    assert not cached['inc_amt'].values.flags.writeable
+    pd.testing.assert_frame_equal(cached, dau_decorated)
+
+
+@pytest.mark.parametrize('change', ['contents', 'mtime', 'user_id', 'activity_date', 'inc_amt',
+                                    'segment_col', 'include_zero_inc', 'compact_dtypes', 'date_format'])
+def test_change_forces_rebuild(source, tmp_path, n_builds, change):
+
+    tvcc = tvccache.TVCCache(str(tmp_path / 'cache'))
+    transactions = pd.read_csv(source)
+    transactions['amount'] = transactions['value_usd']
+    transactions['day'] = transactions['date']
+    transactions['client'] = transactions['client_id']
+    transactions.to_csv(source, index = False)
+    kwargs = dict(SERVBIZ_COLUMNS)
+    tvcc.get_dau_df(source, **kwargs)
+
+    if change == 'contents':
+        # Same size, so only the hash of the contents tells them apart
+        stat = os.stat(source)
+        transactions.assign(value_usd = transactions['value_usd'][::-1].values).to_csv(source, index = False)
+        assert os.stat(source).st_size == stat.st_size
+        os.utime(source, ns = (stat.st_atime_ns, stat.st_mtime_ns))
+    elif change == 'mtime':
+        stat = os.stat(source)
+        os.utime(source, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    elif change == 'user_id':
+        kwargs['user_id'] = 'client'
+    elif change == 'activity_date':
+        kwargs['activity_date'] = 'day'
+    elif change == 'inc_amt':
+        kwargs['inc_amt'] = 'amount'
+    elif change == 'segment_col':
+        kwargs['segment_col'] = None
+    elif change == 'include_zero_inc':
+        kwargs['include_zero_inc'] = True
+    elif change == 'compact_dtypes':
+        kwargs['compact_dtypes'] = True
+    elif change == 'date_format':
+        kwargs['date_format'] = '%Y-%m-%d'
+
+    tvcc.get_dau_df(source, **kwargs)
+    assert len(n_builds) == 2
+
+
+### Serves the directory of the source file, counting the GET requests
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+    n_gets = 0
+
+    def do_GET(self):
+        CountingHandler.n_gets += 1
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_url_hit_does_not_download(source, tmp_path, n_builds):
+
+    handler = functools.partial(CountingHandler, directory = os.path.dirname(source))
+    server = http.server.HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%s/%s' % (server.server_address[1], os.path.basename(source))
+        tvcc = tvccache.TVCCache(str(tmp_path / 'cache'))
+
+        dau = tvcc.get_dau_df(url, **SERVBIZ_COLUMNS)
+        n_gets = CountingHandler.n_gets
+        cached = tvcc.get_dau_df(url, **SERVBIZ_COLUMNS)
+
+        assert CountingHandler.n_gets == n_gets
+        assert len(n_builds) == 1
+        pd.testing.assert_frame_equal(cached, dau)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+### TVCCohortMatrix must report the same cohort sizes, retention and
+### cumulative LTV as create_xau_cohort_df for every cohort, age (and
+### segment) the cohort dataframe has a row for, and no active users at the
+### ages it has no row for
+
+import numpy as np
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_cohort_matrix as tvccm
+from conftest import SERVBIZ_COLUMNS
+
+
+@pytest.fixture(scope = 'module')
+def dau_decorated(servbiz_transactions):
+    return tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+
+
+@pytest.mark.parametrize('time_period', ['week', 'month'])
+@pytest.mark.parametrize('use_segment', [False, True])
+def test_matrix_matches_cohort_df(dau_decorated, time_period, use_segment):
+
+    xau_decorated = tvct.create_xau_decorated_df(dau_decorated, time_period, use_segment)
+    cohort_df = tvct.create_xau_cohort_df(xau_decorated, time_period, use_segment,
+                                          recent_periods_back_to_exclude = 0)
+    matrix = tvccm.TVCCohortMatrix(xau_decorated, time_period, use_segment)
+    first_period_col = tvct.get_time_period_dict(time_period)['first_period_col']
+    since_col = matrix.ages.name
+    if not use_segment:
+        cohort_df = cohort_df.assign(segment = 'All')
+
+    # Indexing the matrices at the cohort dataframe's rows
+    seg_idx = matrix.segments.get_indexer(cohort_df['segment'])
+    cohort_idx = tvct.to_period_ordinals(cohort_df[first_period_col], time_period) - matrix.first_cohort
+    age_idx = cohort_df[since_col].values
+    assert (seg_idx >= 0).all()
+    np.testing.assert_array_equal(matrix.retention(all_segments = True)[seg_idx, cohort_idx, age_idx],
+                                  cohort_df['cust_ret_pct'].values)
+    np.testing.assert_array_equal(matrix.cum_ltv(all_segments = True)[seg_idx, cohort_idx, age_idx],
+                                  cohort_df['cum_inc_per_cohort_cust'].values)
+    np.testing.assert_array_equal(matrix.cohort_cust_ct[seg_idx, cohort_idx],
+                                  cohort_df['cohort_cust_ct'].values)
+
+    # The same through the long frame, which also has the ages with no
+    # active users in between
+    long_df = matrix.to_long_frame()
+    long_df[first_period_col] = long_df[first_period_col].dt.to_timestamp()
+    merged = long_df.merge(cohort_df, on = ['segment', first_period_col, since_col], how = 'left',
+                           suffixes = ('', '_expected'), indicator = True)
+    assert (merged['_merge'] == 'both').sum() == len(cohort_df)
+
+    in_cohort_df = merged[merged['_merge'] == 'both']
+    for col, expected_col in [('retention', 'cust_ret_pct'), ('cum_ltv', 'cum_inc_per_cohort_cust'),
+                              ('cohort_cust_ct', 'cohort_cust_ct_expected'), ('cust_ct', 'cust_ct_expected')]:
+        np.testing.assert_array_equal(in_cohort_df[col].values, in_cohort_df[expected_col].values)
+
+    not_in_cohort_df = merged[merged['_merge'] == 'left_only']
+    assert (not_in_cohort_df['cust_ct'] == 0).all()
+    assert (not_in_cohort_df['retention'] == 0).all()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+### Reading the transactions from a CSV file in chunks must give the same DAU
+### dataframe as create_dau_df on all of them at once, however a user's
+### activity on a day is split across the chunks
+
+import pytest
+import pandas as pd
+import tvc_transform as tvct
+
+COLUMNS = {'user_id' : 'client_id', 'activity_date' : 'date', 'inc_amt' : 'value_usd'}
+
+
+@pytest.fixture(scope = 'module')
+def shuffled_csv(servbiz_transactions, tmp_path_factory):
+    path = tmp_path_factory.mktemp('csv') / 'transactions.csv'
+    servbiz_transactions.sample(frac = 1, random_state = 0).to_csv(path, index = False)
+    return str(path)
+
+
+@pytest.mark.parametrize('segment_col', [None, 'segment', ['segment']])
+@pytest.mark.parametrize('compact_dtypes', [False, True])
+def test_chunks_match_whole_file(servbiz_transactions, shuffled_csv, segment_col, compact_dtypes):
+
+    expected = tvct.create_dau_df(servbiz_transactions, segment_col = segment_col,
+                                  compact_dtypes = compact_dtypes, **COLUMNS)
+    dau = tvct.create_dau_df_from_csv(shuffled_csv, segment_col = segment_col, chunksize = 3000,
+                                      compact_dtypes = compact_dtypes, **COLUMNS)
+
+    if compact_dtypes:
+        expected, expected_lookup = expected
+        dau, user_id_lookup = dau
+        assert list(user_id_lookup) == list(expected_lookup)
+        pd.testing.assert_frame_equal(dau, expected, check_categorical = False)
+    else:
+        pd.testing.assert_frame_equal(dau, expected)
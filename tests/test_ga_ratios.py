@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+### The vectorized growth accounting ratios must give the same dataframes
+### as the per-segment loops that apply calc_user_qr and calc_rev_qr to
+### every row: the same rows in the same order, index included, and the
+### same BOP, retention, quick ratio and CxGR columns
+
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+from conftest import SERVBIZ_COLUMNS
+
+
+@pytest.fixture(scope = 'module')
+def dau_decorated(servbiz_transactions):
+    return tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+
+
+@pytest.mark.parametrize('time_period', ['week', 'month'])
+@pytest.mark.parametrize('use_segment', [False, True])
+def test_vectorized_ratios_match_row_wise(dau_decorated, time_period, use_segment):
+
+    xau_decorated = tvct.create_xau_decorated_df(dau_decorated, time_period, use_segment)
+    user_ga, rev_ga = tvct.create_growth_accounting_dfs(xau_decorated, time_period, use_segment,
+                                                        keep_last_period = False)
+    per = tvct.get_time_period_dict(time_period)['period_abbr']
+
+    user_ratios = tvct.calc_user_ga_ratios(user_ga, time_period, use_segment)
+    user_vectorized = tvct.calc_user_ga_ratios(user_ga, time_period, use_segment, use_vectorized = True)
+    for col in ['Users BOP', per + 'o' + per + ' User Retention', 'User Quick Ratio', 'User C%sGR12' % per]:
+        assert user_ratios[col].notna().any()
+    pd.testing.assert_frame_equal(user_vectorized, user_ratios)
+
+    rev_ratios = tvct.calc_rev_ga_ratios(rev_ga, time_period, use_segment)
+    rev_vectorized = tvct.calc_rev_ga_ratios(rev_ga, time_period, use_segment, use_vectorized = True)
+    for col in ['Revenue BOP', per + 'o' + per + ' Revenue Retention', 'Revenue Quick Ratio',
+                'Net Expansion Revenue', 'Revenue C%sGR12' % per]:
+        assert rev_ratios[col].notna().any()
+    pd.testing.assert_frame_equal(rev_vectorized, rev_ratios)
+
+    pd.testing.assert_frame_equal(tvct.consolidate_ga_with_ratios(user_ga, rev_ga, time_period, use_segment,
+                                                                  use_vectorized = True),
+                                  tvct.consolidate_ga_with_ratios(user_ga, rev_ga, time_period, use_segment))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+### The HyperLogLog user counts must stay within the error bound documented
+### in tvc_hll (1.04 / sqrt(m) standard error) of the exact counts, and give
+### the same dataframes, segments in the same order, as the exact functions
+
+import numpy as np
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_hll as tvchll
+from conftest import SERVBIZ_COLUMNS
+
+P = 14
+
+### Three standard errors: far enough out that no window of the sample
+### should miss it by chance
+MAX_RELATIVE_ERROR = 3 * 1.04 / np.sqrt(2 ** P)
+
+
+@pytest.fixture(scope = 'module')
+def dau_decorated(servbiz_transactions):
+    return tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+
+
+def assert_within_bound(exact, approximate):
+    assert list(exact.columns) == list(approximate.columns)
+    assert len(exact) == len(approximate)
+    error = (approximate / exact - 1).abs()
+    assert error.max().max() <= MAX_RELATIVE_ERROR
+
+
+@pytest.mark.parametrize('time_period', ['day', 'week'])
+def test_window_counts_within_bound(dau_decorated, time_period):
+
+    user_sketches = tvchll.TVCActiveUserSketches(dau_decorated, use_segment = True, p = P)
+    exact = tvct.create_xau_window_df(dau_decorated, time_period, 28, [2, 4], True, use_incremental = True)
+    approximate = tvct.create_xau_window_df(dau_decorated, time_period, 28, [2, 4], True,
+                                            user_sketches = user_sketches)
+
+    pd.testing.assert_series_equal(exact['segment'], approximate['segment'])
+    count_cols = ['active_%ss' % time_period, '%sau_window_ratio' % time_period[0]]
+    assert_within_bound(exact[count_cols], approximate[count_cols])
+
+
+def test_period_counts_within_bound(dau_decorated):
+
+    user_sketches = tvchll.TVCActiveUserSketches(dau_decorated, use_segment = True, p = P)
+    approximate = user_sketches.period_counts('month')
+    exact = (dau_decorated.assign(Month_Year = pd.PeriodIndex(dau_decorated['activity_date'], freq = 'M'))
+             .groupby(['segment', 'Month_Year'])['user_id'].nunique().reset_index(name = 'users'))
+
+    pd.testing.assert_frame_equal(exact[['Month_Year', 'segment']], approximate[['Month_Year', 'segment']],
+                                  check_dtype = False)
+    assert_within_bound(exact[['users']], approximate[['users']])
+
+
+def test_segments_sorted_whatever_order_they_arrive(dau_decorated):
+
+    # The first chunk only has the last segment in sorted order
+    last_segment = dau_decorated['segment'].max()
+    first_chunk = dau_decorated['segment'] == last_segment
+    user_sketches = tvchll.TVCActiveUserSketches(dau_decorated[first_chunk], use_segment = True, p = P)
+    user_sketches.add(dau_decorated[~first_chunk])
+
+    all_at_once = tvchll.TVCActiveUserSketches(dau_decorated, use_segment = True, p = P)
+    assert user_sketches.segments == sorted(dau_decorated['segment'].unique())
+    assert user_sketches.segments == all_at_once.segments
+    assert np.array_equal(user_sketches.registers, all_at_once.registers)
+
+
+def test_adding_day_by_day_grows_by_doubling(dau_decorated):
+
+    dates = sorted(dau_decorated['activity_date'].unique())[:100]
+    user_sketches = tvchll.TVCActiveUserSketches(use_segment = True, p = 10)
+    n_reallocations = 0
+    for date in dates:
+        register_buffer = user_sketches.register_buffer
+        user_sketches.add(dau_decorated[dau_decorated['activity_date'] == date])
+        n_reallocations += user_sketches.register_buffer is not register_buffer
+
+    in_dates = dau_decorated['activity_date'].isin(dates)
+    all_at_once = tvchll.TVCActiveUserSketches(dau_decorated[in_dates], use_segment = True, p = 10)
+    assert user_sketches.segments == all_at_once.segments
+    assert user_sketches.n_days == all_at_once.n_days
+    assert np.array_equal(user_sketches.registers, all_at_once.registers)
+    assert user_sketches.register_buffer.shape[1] < 2 * len(dates)
+    assert n_reallocations <= 12
+
+
+def test_window_df_rejects_sketches_with_incremental(dau_decorated):
+
+    user_sketches = tvchll.TVCActiveUserSketches(dau_decorated, use_segment = False, p = P)
+    with pytest.raises(ValueError):
+        tvct.create_xau_window_df(dau_decorated, 'day', 28, [2, 4], False, use_incremental = True,
+                                  user_sketches = user_sketches)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+### The sketched revenue concentration, fed one partition of users at a
+### time from disk, must stay close to tvct.calc_inc_concentration: exact
+### totals, quantile shares within a couple of points and the 80% user
+### count within 10%, even with sketches small enough to be compacting all
+### the time, and the same figures with sketches big enough to keep every
+### user
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_inc_sketch as tvcis
+from conftest import DATA_DIR, SERVBIZ_COLUMNS
+
+SOURCE = os.path.join(DATA_DIR, 'ServBiz_transactions_sample.csv')
+
+
+@pytest.fixture(scope = 'module')
+def partition_paths(tmp_path_factory):
+    return tvcis.partition_transactions_csv(SOURCE, str(tmp_path_factory.mktemp('partitions')),
+                                            n_partitions = 8, user_id = 'client_id', chunksize = 7000)
+
+
+def test_partitions_split_users(servbiz_transactions, partition_paths):
+
+    partitions = [pd.read_csv(path, dtype = {'client_id' : 'str'}) for path in partition_paths]
+    user_sets = [set(partition['client_id']) for partition in partitions]
+
+    assert sum(len(partition) for partition in partitions) == len(servbiz_transactions)
+    assert sum(len(users) for users in user_sets) == servbiz_transactions['client_id'].nunique()
+    assert set.union(*user_sets) == set(servbiz_transactions['client_id'])
+
+
+@pytest.mark.parametrize('window_days', [28, 365])
+@pytest.mark.parametrize('k, top_k, max_share_error, max_count_error',
+                         [(32, 16, 0.02, 0.1), (1000, 1000, 1e-9, 0)])
+def test_sketch_within_bound(servbiz_transactions, partition_paths, window_days,
+                             k, top_k, max_share_error, max_count_error):
+
+    dau = tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS)
+    last_date = dau['activity_date'].max()
+    exact, exact_lorenz = tvct.calc_inc_concentration(dau, window_days, True)
+
+    daus = (tvct.create_dau_df_from_csv(path, **SERVBIZ_COLUMNS) for path in partition_paths)
+    approximate, lorenz = tvcis.sketch_inc_concentration(daus, window_days, True, last_date = last_date,
+                                                         k = k, top_k = top_k)
+
+    assert list(approximate.columns) == list(exact.columns)
+    assert list(approximate['segment']) == list(exact['segment'])
+    np.testing.assert_allclose(approximate['total_inc_amt'], exact['total_inc_amt'])
+    np.testing.assert_allclose(approximate['total_user_count'], exact['total_user_count'])
+
+    quantile_cols = [c for c in exact.columns if c.startswith('quantile_')]
+    assert np.abs(approximate[quantile_cols].values - exact[quantile_cols].values).max() <= max_share_error
+    assert np.abs(lorenz['inc_share'].values - exact_lorenz['inc_share'].values).max() <= max_share_error
+    count_error = (approximate['revenue_80pct_user_count'] / exact['revenue_80pct_user_count'] - 1).abs()
+    assert count_error.max() <= max_count_error
+
+
+def test_chunks_need_last_date(partition_paths):
+
+    daus = (tvct.create_dau_df_from_csv(path, **SERVBIZ_COLUMNS) for path in partition_paths)
+    with pytest.raises(ValueError):
+        tvcis.sketch_inc_concentration(daus, 28, True)
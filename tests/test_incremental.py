@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+### TVCIncrementalPipeline must give the same growth accounting, cohorts and
+### rolling windows as a full run over all the transactions it was given
+
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_incremental as tvci
+
+WINDOWS = [{'time_period' : 'day', 'window_days' : 28, 'breakouts' : [2, 4]},
+           {'time_period' : 'week', 'window_days' : 28, 'breakouts' : [2, 3, 4]}]
+
+
+### Runs the incremental pipeline on the transactions in batches split at
+### split_dates, leaving out the days in gap_dates, and compares it with a
+### full run over the same transactions
+def check_incremental(transactions, state_dir, split_dates, gap_dates, segment_col):
+
+    use_segment = segment_col is not None
+    days = transactions['date'].str[:10]
+    transactions = transactions[~days.isin(gap_dates)]
+    days = days[~days.isin(gap_dates)]
+
+    tvcip = None
+    bounds = [None] + split_dates + [None]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        batch = transactions[((days >= start) if start else True) & ((days < end) if end else True)]
+        tvcip = tvci.TVCIncrementalPipeline(state_dir, 'client_id', 'date', 'value_usd', segment_col,
+                                            history_days = 60, windows = WINDOWS)
+        tvcip.update(batch.copy())
+
+    dau = tvct.create_dau_df(transactions.copy(), user_id = 'client_id', activity_date = 'date',
+                             inc_amt = 'value_usd', segment_col = segment_col)
+    dau_decorated = tvct.create_dau_decorated_df(dau)
+
+    for time_period in ['week', 'month']:
+        xau_decorated = tvct.create_xau_decorated_df(dau_decorated, time_period, use_segment)
+        full = tvct.consolidate_all_ga(xau_decorated.copy(), time_period, use_segment = use_segment,
+                                       keep_last_period = False, use_vectorized = True)
+        pd.testing.assert_frame_equal(full.reset_index(drop = True),
+                                      tvcip.get_growth_accounting(time_period, keep_last_period = False)
+                                      .reset_index(drop = True),
+                                      rtol = 1e-12)
+        full = tvct.create_xau_cohort_df(xau_decorated.copy(), time_period, use_segment)
+        pd.testing.assert_frame_equal(full.reset_index(drop = True),
+                                      tvcip.get_cohorts(time_period).reset_index(drop = True),
+                                      rtol = 1e-12)
+
+    for window in WINDOWS:
+        full = tvct.create_xau_window_df(dau_decorated, window['time_period'], window['window_days'],
+                                         window['breakouts'], use_segment, use_incremental = True)
+        pd.testing.assert_frame_equal(full, tvcip.get_window_df(window['time_period'], window['window_days']))
+
+
+@pytest.fixture
+def recent_transactions(servbiz_transactions):
+    return servbiz_transactions[servbiz_transactions['date'] >= '2023-06-01']
+
+
+@pytest.mark.parametrize('segment_col', [None, 'segment'])
+def test_incremental_matches_full_run(recent_transactions, tmp_path, segment_col):
+    days = sorted(recent_transactions['date'].str[:10].unique())
+    split_dates = [days[len(days) // 2], days[len(days) // 2 + 17], days[-3]]
+    check_incremental(recent_transactions, str(tmp_path), split_dates, [], segment_col)
+
+
+### The new data starts after a day with no transactions at all, so the
+### window ending on that day has to be computed by the second update
+@pytest.mark.parametrize('segment_col', [None, 'segment'])
+def test_incremental_after_gap_day(recent_transactions, tmp_path, segment_col):
+    days = sorted(recent_transactions['date'].str[:10].unique())
+    gap_date = days[len(days) // 2]
+    next_date = days[len(days) // 2 + 1]
+    check_incremental(recent_transactions, str(tmp_path), [next_date], [gap_date], segment_col)
+
+
+### A gap of more than a week, so a whole week has no transactions
+def test_incremental_after_gap_week(recent_transactions, tmp_path):
+    days = sorted(recent_transactions['date'].str[:10].unique())
+    gap_dates = days[len(days) // 2:len(days) // 2 + 9]
+    next_date = days[len(days) // 2 + 9]
+    check_incremental(recent_transactions, str(tmp_path), [next_date], gap_dates, 'segment')
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+### Every local sink must give back the growth accounting and cohort
+### dataframes it was given, replace an output when it is written again,
+### and leave no temporary files, directories or tables behind, including
+### the directory swap of a partitioned Parquet output
+
+import os
+import sqlite3
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_load_local as tvcloadlocal
+from conftest import SERVBIZ_COLUMNS
+
+
+@pytest.fixture(scope = 'module')
+def outputs(servbiz_transactions):
+    dau_decorated = tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+    mau_decorated = tvct.create_xau_decorated_df(dau_decorated, 'month', True)
+    return {'Monthly Growth Accounting' : tvct.consolidate_all_ga(mau_decorated, 'month', use_segment = True,
+                                                                  use_vectorized = True),
+            'Monthly Cohorts' : tvct.create_xau_cohort_df(mau_decorated, 'month', True)}
+
+
+### Reads an output back from the sink's files or database, parsing the
+### datetime columns SQLite stores as text
+def read_back(sink_type, path, name, expected):
+
+    if sink_type == 'parquet':
+        return pd.read_parquet(os.path.join(path, tvcloadlocal.file_name(name) + '.parquet'))
+    if sink_type == 'feather':
+        return pd.read_feather(os.path.join(path, tvcloadlocal.file_name(name) + '.feather'))
+
+    datetime_cols = [c for c in expected.columns if pd.api.types.is_datetime64_any_dtype(expected[c])]
+    query = 'SELECT * FROM %s' % tvcloadlocal.quote_identifier(name)
+    if sink_type == 'sqlite':
+        with sqlite3.connect(path) as connection:
+            return pd.read_sql(query, connection, parse_dates = datetime_cols)
+    import duckdb
+    with duckdb.connect(path) as connection:
+        return connection.execute(query).df()
+
+
+def sink_path(sink_type, tmp_path):
+    if sink_type in ['sqlite', 'duckdb']:
+        return str(tmp_path / 'output' / ('tvc.' + sink_type))
+    return str(tmp_path / 'output')
+
+
+@pytest.mark.parametrize('sink_type', ['parquet', 'feather', 'sqlite', 'duckdb'])
+def test_write_overwrite_and_read_back(outputs, tmp_path, sink_type):
+
+    if sink_type == 'duckdb':
+        pytest.importorskip('duckdb')
+    path = sink_path(sink_type, tmp_path)
+
+    # The growth accounting is written twice, the second time with only one
+    # segment's rows, which must replace the first
+    b2b_ga = outputs['Monthly Growth Accounting']
+    b2b_ga = b2b_ga[b2b_ga['segment'] == 'B2B']
+    with tvcloadlocal.create_sink(sink_type, path) as sink:
+        for name, dataframe in outputs.items():
+            sink.write(dataframe, name)
+        sink.write(b2b_ga, 'Monthly Growth Accounting')
+
+    for name, expected in [('Monthly Growth Accounting', b2b_ga),
+                           ('Monthly Cohorts', outputs['Monthly Cohorts'])]:
+        if sink_type in ['sqlite', 'duckdb']:
+            expected = tvcloadlocal.periods_to_str(expected)
+        pd.testing.assert_frame_equal(read_back(sink_type, path, name, expected),
+                                      expected.reset_index(drop = True),
+                                      check_dtype = sink_type not in ['sqlite', 'duckdb'])
+
+    if sink_type == 'sqlite':
+        with sqlite3.connect(path) as connection:
+            tables = pd.read_sql("SELECT name FROM sqlite_master WHERE type = 'table'", connection)['name']
+        assert sorted(tables) == sorted(outputs)
+    elif sink_type == 'duckdb':
+        import duckdb
+        with duckdb.connect(path) as connection:
+            tables = connection.execute('SHOW TABLES').df()['name']
+        assert sorted(tables) == sorted(outputs)
+    else:
+        assert sorted(os.listdir(path)) == sorted(tvcloadlocal.file_name(name) + '.' + sink_type
+                                                  for name in outputs)
+
+
+def test_partitioned_parquet_directory_is_swapped(outputs, tmp_path):
+
+    cohorts = outputs['Monthly Cohorts']
+    sink = tvcloadlocal.TVCParquetSink(str(tmp_path), partition_cols = ['segment'])
+    sink.write(cohorts, 'Monthly Cohorts')
+    assert sorted(os.listdir(str(tmp_path / 'Monthly_Cohorts'))) == ['segment=B2B', 'segment=B2C']
+
+    # Writing only B2C must leave no B2B partition from the first write
+    b2c_cohorts = cohorts[cohorts['segment'] == 'B2C']
+    sink.write(b2c_cohorts, 'Monthly Cohorts')
+
+    assert sorted(os.listdir(str(tmp_path))) == ['Monthly_Cohorts']
+    assert os.listdir(str(tmp_path / 'Monthly_Cohorts')) == ['segment=B2C']
+    read = pd.read_parquet(str(tmp_path / 'Monthly_Cohorts'))
+    read['segment'] = read['segment'].astype(str)
+    pd.testing.assert_frame_equal(read[cohorts.columns], b2c_cohorts.reset_index(drop = True))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+### TVCLoad's batched writer, against the in-memory tvc_fake_gspread client:
+### the worksheets must end up holding the queued dataframes, with only the
+### changed blocks of rows sent again
+
+import pandas as pd
+import pytest
+import tvc_fake_gspread as fake_gspread
+import tvc_load_service_account as tvcload
+
+SPREADSHEET_KEY = 'test-spreadsheet'
+
+
+def make_df(n_rows):
+    return pd.DataFrame({'week' : ['W%s' % i for i in range(n_rows)],
+                         'active_users' : range(n_rows),
+                         'revenue' : [i * 1.5 for i in range(n_rows)]})
+
+
+def sheet_values(client, worksheet_name):
+    return client.open_by_key(SPREADSHEET_KEY).worksheet(worksheet_name).get_all_values()
+
+
+def test_flush_sends_only_changed_blocks(tmp_path):
+
+    client = fake_gspread.FakeClient()
+    tvcl = tvcload.TVCLoad(None, client = client, hash_file = str(tmp_path / 'hashes.json'), block_rows = 10)
+
+    df = make_df(35)
+    tvcl.queue_dataframe(df, 'Weekly', SPREADSHEET_KEY)
+    tvcl.flush()
+    assert sheet_values(client, 'Weekly') == tvcload.dataframe_to_values(df)
+    assert client.request_counts['values_batch_update'] == 1
+
+    # Nothing changed: nothing is sent
+    tvcl.queue_dataframe(df, 'Weekly', SPREADSHEET_KEY)
+    tvcl.flush()
+    assert client.request_counts['values_batch_update'] == 1
+    assert client.request_counts['batch_update'] == 1
+
+    # One row changed: only its block is sent, and a new TVCLoad reads the
+    # hashes back from the hash file
+    df.loc[15, 'active_users'] = 1000
+    tvcl = tvcload.TVCLoad(None, client = client, hash_file = str(tmp_path / 'hashes.json'), block_rows = 10)
+    tvcl.queue_dataframe(df, 'Weekly', SPREADSHEET_KEY)
+    calls = []
+    sh = tvcl.get_spreadsheet(SPREADSHEET_KEY)
+    values_batch_update = sh.values_batch_update
+    sh.values_batch_update = lambda body: calls.append(body) or values_batch_update(body)
+    tvcl.flush()
+    assert [r['range'] for r in calls[0]['data']] == ["'Weekly'!A12:C21"]
+    assert sheet_values(client, 'Weekly') == tvcload.dataframe_to_values(df)
+
+
+def test_flush_retry_after_failure_writes_everything(tmp_path):
+
+    # The fifth request, the value update of the first flush, is refused
+    client = fake_gspread.FakeClient(rate_limit_every = 5)
+    tvcl = tvcload.TVCLoad(None, client = client, hash_file = str(tmp_path / 'hashes.json'), block_rows = 10)
+
+    df = make_df(25)
+    tvcl.queue_dataframe(df, 'Weekly', SPREADSHEET_KEY)
+    with pytest.raises(fake_gspread.FakeAPIError):
+        tvcl.flush()
+    assert client.n_rate_limited == 1
+    assert sheet_values(client, 'Weekly') != tvcload.dataframe_to_values(df)
+
+    tvcl.flush()
+    assert sheet_values(client, 'Weekly') == tvcload.dataframe_to_values(df)
+    assert tvcl.queue == {}
+
+
+def test_flush_dataframe_with_no_columns():
+
+    client = fake_gspread.FakeClient()
+    tvcl = tvcload.TVCLoad(None, client = client)
+
+    tvcl.queue_dataframe(make_df(3), 'Empty', SPREADSHEET_KEY)
+    tvcl.flush()
+    tvcl.queue_dataframe(pd.DataFrame(index = range(3)), 'Empty', SPREADSHEET_KEY)
+    tvcl.flush()
+    assert sheet_values(client, 'Empty') == [[''], [''], [''], ['']]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+### Memory-lean mode (pandas Copy-on-Write) must not take more memory at its
+### peak than the default mode, and in either mode the functions must leave
+### the dataframes passed in as they are
+
+import os
+import tracemalloc
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+from conftest import DATA_DIR, SERVBIZ_COLUMNS
+
+
+@pytest.fixture(scope = 'module')
+def mau_decorated(servbiz_transactions):
+    dau = tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS)
+    return tvct.create_xau_decorated_df(tvct.create_dau_decorated_df(dau), 'month', True)
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('stage', ['ga', 'cohorts'])
+def test_lean_mode_peak_memory(mau_decorated, stage):
+
+    def run():
+        if stage == 'ga':
+            tvct.consolidate_all_ga(mau_decorated, 'month', use_segment = True, use_vectorized = True)
+        else:
+            tvct.create_xau_cohort_df(mau_decorated, 'month', use_segment = True,
+                                      create_period_n_inc_cols = True)
+
+    default_peak = peak_memory(run)
+    with tvct.memory_lean_mode():
+        lean_peak = peak_memory(run)
+
+    assert lean_peak <= default_peak
+
+
+@pytest.mark.parametrize('copy_on_write', [False, True])
+def test_create_dau_df_leaves_transactions_unchanged(copy_on_write):
+
+    # Read straight from the file, so the check does not depend on what
+    # other tests did with the session's transactions
+    transactions = pd.read_csv(os.path.join(DATA_DIR, 'ServBiz_transactions_sample.csv'))
+    expected = transactions.copy()
+    with pd.option_context('mode.copy_on_write', copy_on_write):
+        tvct.create_dau_df(transactions, **SERVBIZ_COLUMNS)
+    pd.testing.assert_frame_equal(transactions, expected)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+### Running all the segmentations at once, on the stacked DAU Decorated
+### dataframe, must give each segmentation the same results (rows and
+### columns) as running it on its own
+
+import numpy as np
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+
+SEGMENTATIONS = {'Unsegmented' : None, 'Channel' : 'segment', 'Region' : 'region'}
+
+
+### The recent transactions with a second segment column, and some rows
+### with no segment: one of them the first activity of its user
+@pytest.fixture
+def segmented_transactions(servbiz_transactions):
+    transactions = servbiz_transactions[servbiz_transactions['date'] >= '2023-06-01'].copy()
+    transactions['region'] = np.random.default_rng(0).choice(['EU', 'US', 'APAC'], len(transactions))
+    first_row = transactions.sort_values('date').index[0]
+    transactions.loc[first_row, 'segment'] = np.nan
+    transactions.loc[transactions.index[100:103], 'region'] = np.nan
+    return transactions
+
+
+@pytest.mark.parametrize('compact_dtypes', [False, True])
+def test_multi_segment_matches_single_runs(segmented_transactions, compact_dtypes):
+
+    assert segmented_transactions['segment'].isna().sum() > 0
+
+    dau = tvct.create_dau_df(segmented_transactions.copy(), 'client_id', 'date', 'value_usd',
+                             segment_col = ['segment', 'region'], compact_dtypes = compact_dtypes)
+    if compact_dtypes:
+        dau, user_id_lookup = dau
+    dau_decorated = tvct.create_multi_segment_dau_decorated_df(dau, SEGMENTATIONS)
+
+    results = {}
+    singles = {name : {} for name in SEGMENTATIONS}
+    for name, segment_col in SEGMENTATIONS.items():
+        use_segment = segment_col is not None
+        single_dau = tvct.create_dau_df(segmented_transactions.copy(), 'client_id', 'date', 'value_usd',
+                                        segment_col = segment_col)
+        single_decorated = tvct.create_dau_decorated_df(single_dau)
+        for time_period in ['week', 'month']:
+            xau_decorated = tvct.create_xau_decorated_df(single_decorated, time_period, use_segment)
+            singles[name]['ga_' + time_period] = tvct.consolidate_all_ga(xau_decorated.copy(), time_period,
+                                                                         use_segment = use_segment,
+                                                                         keep_last_period = False)
+            singles[name]['cohorts_' + time_period] = tvct.create_xau_cohort_df(xau_decorated.copy(), time_period,
+                                                                                use_segment)
+        singles[name]['window'] = tvct.create_xau_window_df(single_decorated, 'day', 28, [2, 4], use_segment,
+                                                            False, use_incremental = True)
+
+    for time_period in ['week', 'month']:
+        xau_decorated = tvct.create_xau_decorated_df(dau_decorated, time_period, True)
+        results['ga_' + time_period] = tvct.consolidate_all_ga_multi_segment(xau_decorated.copy(), time_period,
+                                                                             SEGMENTATIONS,
+                                                                             keep_last_period = False)
+        results['cohorts_' + time_period] = tvct.create_xau_cohort_df_multi_segment(xau_decorated.copy(),
+                                                                                    time_period, SEGMENTATIONS)
+    results['window'] = tvct.create_xau_window_df_multi_segment(dau_decorated, SEGMENTATIONS, 'day', 28,
+                                                                [2, 4], False)
+
+    for key, result in results.items():
+        for name, seg_df in tvct.split_segmentation_dfs(result, SEGMENTATIONS):
+            single = singles[name][key]
+            if key != 'window':
+                single = single.reset_index(drop = True)
+                seg_df = seg_df.reset_index(drop = True)
+            if compact_dtypes and 'segment' in seg_df.columns:
+                seg_df['segment'] = seg_df['segment'].astype('str')
+            pd.testing.assert_frame_equal(single, seg_df, check_dtype = False, rtol = 1e-10)
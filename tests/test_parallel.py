@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+### run_stages must give the same results as running the stages one after
+### the other, and the results shared with other stages are not sent back
+### from the workers
+
+import os
+import pandas as pd
+import tvc_transform as tvct
+import tvc_parallel as tvcpar
+from conftest import SERVBIZ_COLUMNS
+
+
+def test_run_stage_returns_path_of_shared_result(servbiz_transactions, tmp_path):
+
+    dau_decorated = tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+    input_path = tvcpar.share_df(dau_decorated, str(tmp_path / 'dau_decorated.feather'))
+    output_path = str(tmp_path / 'wau_decorated.feather')
+
+    result = tvcpar.run_stage('create_xau_decorated_df', [input_path],
+                              {'time_period' : 'week', 'use_segment' : True}, output_path)
+
+    assert result == output_path
+    assert os.path.exists(output_path)
+
+
+def test_run_stages_matches_serial_run(servbiz_transactions, tmp_path):
+
+    dau_decorated = tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+    stages = {'wau_decorated' : {'function' : 'create_xau_decorated_df',
+                                 'inputs' : ['dau_decorated'],
+                                 'kwargs' : {'time_period' : 'week', 'use_segment' : True}},
+              'w_ga' : {'function' : 'consolidate_all_ga',
+                        'inputs' : ['wau_decorated'],
+                        'kwargs' : {'time_period' : 'week', 'use_segment' : True,
+                                    'keep_last_period' : False}}}
+
+    results = dict(tvcpar.run_stages(stages, {'dau_decorated' : dau_decorated},
+                                     max_workers = 2, share_dir = str(tmp_path)))
+
+    wau_decorated = tvct.create_xau_decorated_df(dau_decorated, 'week', True)
+    pd.testing.assert_frame_equal(results['wau_decorated'], wau_decorated)
+    pd.testing.assert_frame_equal(results['w_ga'],
+                                  tvct.consolidate_all_ga(wau_decorated, 'week', use_segment = True,
+                                                          keep_last_period = False))
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+### The revenue read off TVCRevenueCube's prefix sums must match summing
+### the DAU Decorated rows of the same days directly, for rolling windows,
+### arbitrary date ranges, calendar periods and single users
+
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+import pytest
+import tvc_transform as tvct
+import tvc_revenue_cube as tvcrc
+from conftest import SERVBIZ_COLUMNS
+
+
+@pytest.fixture(scope = 'module')
+def dau_decorated(servbiz_transactions):
+    return tvct.create_dau_decorated_df(tvct.create_dau_df(servbiz_transactions, **SERVBIZ_COLUMNS))
+
+
+### The inc_amt of each segment (or of 'All') over the rows of dates
+### start_date to end_date, both included
+def direct_segment_revenue(dau_decorated, start_date, end_date, use_segment):
+    dates = pd.to_datetime(dau_decorated['activity_date'])
+    in_range = dau_decorated[(dates >= pd.Timestamp(start_date)) & (dates <= pd.Timestamp(end_date))]
+    if use_segment:
+        return in_range.groupby('segment')['inc_amt'].sum()
+    return pd.Series([in_range['inc_amt'].sum()], index = ['All'])
+
+
+@pytest.mark.parametrize('use_segment', [False, True])
+def test_window_sums_match_groupby(dau_decorated, use_segment):
+
+    cube = tvcrc.TVCRevenueCube(dau_decorated, use_segment = use_segment, include_users = True)
+    dates = pd.to_datetime(dau_decorated['activity_date'])
+    first_date, last_date = dates.min(), dates.max()
+
+    for window_days in [7, 28, 90]:
+        rolling = cube.rolling_segment_revenue(window_days)
+        assert rolling.index[0] == first_date + timedelta(days = window_days - 1)
+        assert rolling.index[-1] == last_date
+        for end_date in list(rolling.index[::97]) + [last_date]:
+            expected = direct_segment_revenue(dau_decorated, end_date - timedelta(days = window_days - 1),
+                                              end_date, use_segment)
+            np.testing.assert_allclose(rolling.loc[end_date].values,
+                                       expected.reindex(rolling.columns, fill_value = 0.0).values,
+                                       rtol = 1e-9, atol = 1e-6)
+
+    # Date ranges that run over the ends of the data, or are empty
+    for start_date, end_date in [(first_date, last_date),
+                                 (first_date - timedelta(days = 5), first_date + timedelta(days = 3)),
+                                 (last_date - timedelta(days = 27), last_date + timedelta(days = 10)),
+                                 (last_date, last_date - timedelta(days = 1))]:
+        revenue = cube.segment_revenue(start_date, end_date)
+        expected = direct_segment_revenue(dau_decorated, start_date, end_date, use_segment)
+        np.testing.assert_allclose(revenue.values,
+                                   expected.reindex(revenue.index, fill_value = 0.0).values,
+                                   rtol = 1e-9, atol = 1e-6)
+
+        user_revenue = cube.user_revenue(start_date, end_date).set_index(['user_id', 'segment'])['inc_amt']
+        in_range = dau_decorated[(dates >= start_date) & (dates <= end_date)]
+        expected = in_range.assign(segment = in_range['segment'] if use_segment else 'All')\
+                           .groupby(['user_id', 'segment'])['inc_amt'].sum()
+        np.testing.assert_allclose(user_revenue.values,
+                                   expected.reindex(user_revenue.index, fill_value = 0.0).values,
+                                   rtol = 1e-9, atol = 1e-6)
+
+
+@pytest.mark.parametrize('time_period', ['week', 'month'])
+def test_period_sums_match_groupby(dau_decorated, time_period):
+
+    cube = tvcrc.TVCRevenueCube(dau_decorated, use_segment = True)
+    revenue = cube.period_segment_revenue(time_period)
+
+    periods = pd.PeriodIndex(pd.to_datetime(dau_decorated['activity_date']),
+                             freq = tvct.get_time_period_dict(time_period)['period_abbr'])
+    expected = dau_decorated.groupby([periods, 'segment'])['inc_amt'].sum().unstack(fill_value = 0.0)
+
+    # The cube also has the periods with no transactions, at zero
+    expected.index = expected.index.astype(str)
+    revenue.index = revenue.index.astype(str)
+    assert set(expected.index) <= set(revenue.index)
+    np.testing.assert_allclose(revenue[expected.columns].values,
+                               expected.reindex(revenue.index, fill_value = 0.0).values,
+                               rtol = 1e-9, atol = 1e-6)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+### The vectorized rolling growth accounting must give the same dataframe as
+### calc_ga_for_window day by day, including the NaN revenue columns of the
+### windows that have no new users
+
+import pandas as pd
+import tvc_transform as tvct
+from conftest import SERVBIZ_COLUMNS
+
+
+def test_vectorized_matches_loop_without_new_users(servbiz_transactions):
+
+    transactions = servbiz_transactions[(servbiz_transactions['date'] >= '2023-01-01') &
+                                        (servbiz_transactions['date'] < '2023-05-01')]
+    dau_decorated = tvct.create_dau_decorated_df(tvct.create_dau_df(transactions, **SERVBIZ_COLUMNS))
+
+    # No users start after January, so the last windows have no new users
+    dau_decorated = dau_decorated[pd.to_datetime(dau_decorated['first_dt']) < '2023-02-01']
+
+    loop = tvct.calc_rolling_qr_window(dau_decorated, 28, True, False)
+    vectorized = tvct.calc_rolling_qr_window(dau_decorated, 28, True, False, use_vectorized = True)
+
+    assert loop['first_this_period'].isna().any()
+    pd.testing.assert_frame_equal(loop[vectorized.columns].reset_index(drop = True),
+                                  vectorized.reset_index(drop = True),
+                                  check_dtype = False, check_names = False, rtol = 1e-9)
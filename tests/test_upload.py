@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+### TVCUploader must write the same worksheets as TVCLoad.flush, even when
+### the API keeps refusing requests with 429 errors, and shut its threads
+### down when the with block ends
+
+import numpy as np
+import pandas as pd
+import tvc_fake_gspread as fake_gspread
+import tvc_load_service_account as tvcload
+import tvc_upload as tvcup
+
+SPREADSHEET_KEY = 'test-spreadsheet'
+
+
+def make_dfs():
+    rng = np.random.default_rng(0)
+    return {'Sheet %s' % i : pd.DataFrame({'a' : rng.random(n),
+                                           'b' : rng.integers(0, 9, n).astype(str),
+                                           'c' : [None] * n})
+            for i, n in enumerate([5, 1200, 3000, 40])}
+
+
+def sheet_values(client):
+    return {ws.title : ws.get_all_values() for ws in client.spreadsheets[SPREADSHEET_KEY].sheets}
+
+
+def test_uploads_under_rate_limiting(tmp_path):
+
+    dfs = make_dfs()
+    expected = {name : tvcload.dataframe_to_values(df) for name, df in dfs.items()}
+
+    # Every fourth request is refused
+    client = fake_gspread.FakeClient(latency = 0.01, rate_limit_every = 4)
+    tvcl = tvcload.TVCLoad(None, client = client, hash_file = str(tmp_path / 'hashes.json'))
+    with tvcup.TVCUploader(tvcl, max_workers = 4, requests_per_minute = 60000, burst = 10,
+                           backoff_seconds = 0.001, max_batch_cells = 5000) as uploader:
+        for name, df in dfs.items():
+            uploader.submit(df, name, SPREADSHEET_KEY)
+
+    assert sheet_values(client) == expected
+    assert client.n_rate_limited > 0
+    assert uploader.n_retries == client.n_rate_limited
+    assert uploader.executor._shutdown
+
+    # The next run only sends the block that changed
+    dfs['Sheet 2'].iloc[2500, 0] = 0.5
+    expected['Sheet 2'] = tvcload.dataframe_to_values(dfs['Sheet 2'])
+    n_value_updates = client.request_counts['values_batch_update']
+    tvcl = tvcload.TVCLoad(None, client = client, hash_file = str(tmp_path / 'hashes.json'))
+    with tvcup.TVCUploader(tvcl, requests_per_minute = 60000, backoff_seconds = 0.001) as uploader:
+        for name, df in dfs.items():
+            uploader.submit(df, name, SPREADSHEET_KEY)
+
+    assert sheet_values(client) == expected
+    assert client.request_counts['values_batch_update'] == n_value_updates + 1